@@ -44,6 +44,10 @@ DATABASES = {
 }
 DATABASES['default']['ATOMIC_REQUESTS'] = True
 
+# REDIS
+# ------------------------------------------------------------------------------
+REDIS_URL = env('REDIS_URL', default='redis://localhost:6379/0')
+
 # URLS
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#root-urlconf
@@ -201,7 +205,15 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_VERSIONING_CLASS': 'rest_framework.versioning.NamespaceVersioning',
     'EXCEPTION_HANDLER': 'safe_notification_service.safe.views.custom_exception_handler',
+    # Number of proxies in front of the service, it must match the deployment (e.g. `1` behind nginx). Client ip
+    # used for throttling is the one added to `X-Forwarded-For` by the last proxy, so clients cannot spoof it. With
+    # `0` the connecting ip is used and `X-Forwarded-For` is ignored
+    'NUM_PROXIES': env.int('NUM_PROXIES', default=0),
 }
+# Token bucket rate limits for auth, pairing and notification endpoints, as `<requests>/<period>` (e.g. `60/minute`).
+# Buckets are stored on Redis and allow bursts of `<requests>`. Not set disables them. They are validated on startup
+THROTTLE_IP_RATE = env('THROTTLE_IP_RATE', default=None)
+THROTTLE_SIGNER_RATE = env('THROTTLE_SIGNER_RATE', default=None)
 
 # LOGGING
 # ------------------------------------------------------------------------------
@@ -266,11 +278,73 @@ LOGGING = {
 # Safe
 # ------------------------------------------------------------------------------
 ETH_HASH_PREFIX = env('ETH_HASH_PREFIX', default='GNO')
+# Backend to recover signers from signatures: `auto` (fastest available), `coincurve` (libsecp256k1) or `legacy`
+ETH_ECRECOVER_BACKEND = env('ETH_ECRECOVER_BACKEND', default='auto')
+# Recover signers of requests with multiple signatures in parallel using threads. Pool size `0` uses one thread per
+# CPU. It has no effect on gevent workers (threads are greenlets there), enable `VERIFICATION_PROCESS_POOL` instead,
+# which takes precedence and recovers every signature of the request at once on the process pool
+ETH_RECOVERY_POOL = env.bool('ETH_RECOVERY_POOL', default=False)
+ETH_RECOVERY_POOL_SIZE = env.int('ETH_RECOVERY_POOL_SIZE', default=0)
+# Run signature verifications on a pool of processes, so CPU bound work doesn't stall gevent workers.
+# Pool size `0` uses one process per CPU
+VERIFICATION_PROCESS_POOL = env.bool('VERIFICATION_PROCESS_POOL', default=False)
+VERIFICATION_PROCESS_POOL_SIZE = env.int('VERIFICATION_PROCESS_POOL_SIZE', default=0)
+# Recovered signers are cached, as the same signatures are sent again and again. `0` disables the cache
+SIGNER_CACHE_MAX_SIZE = env.int('SIGNER_CACHE_MAX_SIZE', default=10000)
+# Share recovered signers between processes using Redis
+SIGNER_CACHE_REDIS = env.bool('SIGNER_CACHE_REDIS', default=False)
+SIGNER_CACHE_REDIS_TIMEOUT_SECONDS = env.int('SIGNER_CACHE_REDIS_TIMEOUT_SECONDS', default=60 * 60 * 24)  # 1 day
 
 # Notifications
 # ------------------------------------------------------------------------------
-NOTIFICATION_MAX_RETRIES = env('NOTIFICATION_MAX_RETRIES', default=3)
-NOTIFICATION_RETRY_DELAY_SECONDS = env('NOTIFICATION_RETRY_DELAY_SECONDS', default=1 * 60)  # 1 minute
+# Allow callers sending the `Prefer: respond-async` header to resolve devices and enqueue notifications on a task,
+# so notification endpoints return `202` without waiting. As devices are not resolved, `404` is not returned if no
+# devices are found. Callers not sending the header are not affected
+NOTIFICATION_DISPATCH_ASYNC = env.bool('NOTIFICATION_DISPATCH_ASYNC', default=False)
+# Store notification tasks on the `NotificationOutbox` table on the request transaction, instead of publishing them.
+# `relay_notification_outbox` command must be running to publish them to the broker
+NOTIFICATION_OUTBOX = env.bool('NOTIFICATION_OUTBOX', default=False)
+NOTIFICATION_OUTBOX_RELAY_BATCH_SIZE = env.int('NOTIFICATION_OUTBOX_RELAY_BATCH_SIZE', default=500)
+NOTIFICATION_OUTBOX_RELAY_INTERVAL_SECONDS = env.float('NOTIFICATION_OUTBOX_RELAY_INTERVAL_SECONDS', default=1.)
+# Route notification tasks to `notifications-high`, `notifications-normal` and `notifications-low` queues depending
+# on the `NotificationType` priority. Workers must be consuming those queues
+NOTIFICATION_PRIORITY_QUEUES = env.bool('NOTIFICATION_PRIORITY_QUEUES', default=False)
+NOTIFICATION_MAX_RETRIES = env.int('NOTIFICATION_MAX_RETRIES', default=3)
+# Retries use exponential backoff with jitter, starting with `NOTIFICATION_RETRY_DELAY_SECONDS`
+NOTIFICATION_RETRY_DELAY_SECONDS = env.int('NOTIFICATION_RETRY_DELAY_SECONDS', default=1 * 60)  # 1 minute
+NOTIFICATION_RETRY_MAX_DELAY_SECONDS = env.int('NOTIFICATION_RETRY_MAX_DELAY_SECONDS', default=15 * 60)  # 15 min
+# Send one Firebase multicast request per message instead of one task and request per push token
+NOTIFICATION_MULTICAST = env.bool('NOTIFICATION_MULTICAST', default=False)
+NOTIFICATION_MULTICAST_MAX_TOKENS = env.int('NOTIFICATION_MULTICAST_MAX_TOKENS', default=500)  # Firebase limit
+# Delay notifications with a `NotificationType` collapse key for this window, so if a newer one is sent to the same
+# device with the same collapse key only the newest one is delivered. `0` disables it
+NOTIFICATION_COALESCE_WINDOW_SECONDS = env.float('NOTIFICATION_COALESCE_WINDOW_SECONDS', default=0.)
+# Cache `NotificationType` rules in every process, invalidated when they change
+NOTIFICATION_TYPES_CACHE = env.bool('NOTIFICATION_TYPES_CACHE', default=True)
+# Max seconds to keep `NotificationType` rules in every process, in case an invalidation is lost
+NOTIFICATION_TYPES_CACHE_LOCAL_TIMEOUT_SECONDS = env.int('NOTIFICATION_TYPES_CACHE_LOCAL_TIMEOUT_SECONDS', default=10)
+# Cache push tokens verified on Firebase, so registering the same push token again doesn't need a Firebase request
+PUSH_TOKEN_VERIFICATION_CACHE_TIMEOUT_SECONDS = env.int(
+    'PUSH_TOKEN_VERIFICATION_CACHE_TIMEOUT_SECONDS', default=60 * 60 * 24)  # 1 day
+# Push tokens not valid are cached for a short time, as they could be registered on Firebase later
+PUSH_TOKEN_VERIFICATION_NEGATIVE_CACHE_TIMEOUT_SECONDS = env.int(
+    'PUSH_TOKEN_VERIFICATION_NEGATIVE_CACHE_TIMEOUT_SECONDS', default=60)  # 1 minute
+# Register push tokens without waiting for Firebase verification, a task will verify them in batches later
+PUSH_TOKEN_ASYNC_VERIFICATION = env.bool('PUSH_TOKEN_ASYNC_VERIFICATION', default=False)
+PUSH_TOKEN_VERIFICATION_DELAY_SECONDS = env.int('PUSH_TOKEN_VERIFICATION_DELAY_SECONDS', default=5)
+PUSH_TOKEN_VERIFICATION_BATCH_SIZE = env.int('PUSH_TOKEN_VERIFICATION_BATCH_SIZE', default=500)
+# Push tokens that could not be verified after this many attempts are removed
+PUSH_TOKEN_VERIFICATION_MAX_ATTEMPTS = env.int('PUSH_TOKEN_VERIFICATION_MAX_ATTEMPTS', default=20)
+# Send notifications to devices with push tokens pending verification
+PUSH_TOKEN_PENDING_VERIFICATION_NOTIFY = env.bool('PUSH_TOKEN_PENDING_VERIFICATION_NOTIFY', default=True)
+# Cache devices paired with a signer, so notifications can be routed without hitting the database
+PAIRING_CACHE = env.bool('PAIRING_CACHE', default=True)
+PAIRING_CACHE_TIMEOUT_SECONDS = env.int('PAIRING_CACHE_TIMEOUT_SECONDS', default=60 * 60)  # 1 hour
+# Per process cache cannot be invalidated from other processes, keep it short
+PAIRING_CACHE_LOCAL_TIMEOUT_SECONDS = env.int('PAIRING_CACHE_LOCAL_TIMEOUT_SECONDS', default=5)
+# Push tokens found invalid when sending are removed from the database in batches, at most once per interval
+INVALID_PUSH_TOKENS_FLUSH_INTERVAL_SECONDS = env.int('INVALID_PUSH_TOKENS_FLUSH_INTERVAL_SECONDS', default=60)
+INVALID_PUSH_TOKENS_FLUSH_BATCH_SIZE = env.int('INVALID_PUSH_TOKENS_FLUSH_BATCH_SIZE', default=1000)
 # To use notification service from another services
 NOTIFICATION_SERVICE_PASS = env('NOTIFICATION_SERVICE_PASS', default=None)
 
@@ -278,6 +352,10 @@ FIREBASE_CREDENTIALS_PATH = env('FIREBASE_CREDENTIALS_PATH', default=None)
 if FIREBASE_CREDENTIALS_PATH:
     import json
     FIREBASE_AUTH_CREDENTIALS = json.load(environ.Path(FIREBASE_CREDENTIALS_PATH).file('firebase-credentials.json'))
+# Send messages using FCM HTTP v1 API over a pool of HTTP/2 connections, with many requests in flight per worker.
+# Requires `NOTIFICATION_MULTICAST`, as only multicast messages are sent concurrently. Ignored otherwise
+FIREBASE_ASYNC_CLIENT = env.bool('FIREBASE_ASYNC_CLIENT', default=False)
+FIREBASE_ASYNC_MAX_CONCURRENCY = env.int('FIREBASE_ASYNC_MAX_CONCURRENCY', default=100)
 
 # Google InApp Billing
 GOOGLE_BILLING_PUBLIC_KEY_BASE64 = env('GOOGLE_BILLING_PUBLIC_KEY_BASE64', default=None)
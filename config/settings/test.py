@@ -54,3 +54,9 @@ EMAIL_PORT = 1025
 # CELERY
 # ------------------------------------------------------------------------------
 CELERY_ALWAYS_EAGER = True
+
+# NOTIFICATIONS
+# ------------------------------------------------------------------------------
+# Database is rolled back between tests without triggering cache invalidation
+NOTIFICATION_TYPES_CACHE = False
+PAIRING_CACHE = False
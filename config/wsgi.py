@@ -18,6 +18,9 @@ import sys
 
 from django.core.wsgi import get_wsgi_application
 
+from safe_notification_service.utils.process_pool import \
+    VerificationProcessPoolProvider
+
 # This allows easy placement of apps within the interior
 # safe_notification_service directory.
 app_path = os.path.abspath(os.path.join(
@@ -36,6 +39,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.production")
 # setting points here.
 application = get_wsgi_application()
 
+# Start the verification process pool when the worker loads the application, instead of on the first request
+VerificationProcessPoolProvider().start()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
@@ -13,4 +13,5 @@ echo "==> $(date +%H:%M:%S) ==> Migrating Django models... "
 python manage.py migrate --noinput
 
 echo "==> $(date +%H:%M:%S) ==> Running Celery worker <=="
-exec celery -A safe_notification_service.taskapp worker --loglevel $log_level -c 4
+exec celery -A safe_notification_service.taskapp worker --loglevel $log_level -c ${CELERY_CONCURRENCY:-4} \
+    -Q ${CELERY_QUEUES:-celery}
@@ -0,0 +1,94 @@
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from logging import getLogger
+
+from django.conf import settings
+
+from ethereum import utils
+
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+logger = getLogger(__name__)
+
+EMPTY_PUBLIC_KEY = b'\x00' * 64
+
+
+class EcrecoverBackend(ABC):
+    name: str
+
+    @abstractmethod
+    def recover_public_key(self, message_hash: bytes, v: int, r: int, s: int) -> bytes:
+        """
+        :param message_hash: 32 bytes hash of the signed message
+        :param v: v parameter of ethereum signing (27 or 28)
+        :param r: r parameter of ethereum signing
+        :param s: s parameter of ethereum signing
+        :return: 64 bytes uncompressed public key without the `0x04` prefix. If signature is not valid, 64 zero bytes
+        are returned, the same as `ethereum.utils.ecrecover_to_pub`
+        """
+        pass
+
+
+class LegacyEcrecoverBackend(EcrecoverBackend):
+    """
+    `ethereum.utils.ecrecover_to_pub`. It uses `coincurve` if installed, but it pays for some conversions in pure
+    Python, and it falls back to a pure Python implementation if not
+    """
+    name = 'legacy'
+
+    def recover_public_key(self, message_hash: bytes, v: int, r: int, s: int) -> bytes:
+        return utils.ecrecover_to_pub(message_hash, v, r, s)
+
+
+class CoincurveEcrecoverBackend(EcrecoverBackend):
+    """
+    Recover using `libsecp256k1` through `coincurve` bindings
+    """
+    name = 'coincurve'
+
+    def __init__(self):
+        if coincurve is None:
+            raise ImportError('coincurve is not installed')
+
+    def recover_public_key(self, message_hash: bytes, v: int, r: int, s: int) -> bytes:
+        try:
+            signature = r.to_bytes(32, 'big') + s.to_bytes(32, 'big') + bytes([v - 27])
+            public_key = coincurve.PublicKey.from_signature_and_message(signature, message_hash, hasher=None)
+        except (ValueError, OverflowError):
+            return EMPTY_PUBLIC_KEY
+        return public_key.format(compressed=False)[1:]
+
+
+ECRECOVER_BACKENDS = {
+    backend.name: backend for backend in (CoincurveEcrecoverBackend, LegacyEcrecoverBackend)
+}
+
+
+@lru_cache(maxsize=None)
+def get_ecrecover_backend() -> EcrecoverBackend:
+    """
+    :return: Backend configured on `ETH_ECRECOVER_BACKEND`. If `auto`, the fastest one available is used
+    """
+    backend_name = settings.ETH_ECRECOVER_BACKEND
+    if backend_name == 'auto':
+        backend_name = CoincurveEcrecoverBackend.name if coincurve else LegacyEcrecoverBackend.name
+    if backend_name not in ECRECOVER_BACKENDS:
+        raise ValueError('Ecrecover backend {} not supported, use one of {}'.format(
+            backend_name, list(ECRECOVER_BACKENDS)))
+    logger.info('Using %s ecrecover backend', backend_name)
+    return ECRECOVER_BACKENDS[backend_name]()
+
+
+def ecrecover_to_address(message_hash: bytes, v: int, r: int, s: int) -> str:
+    """
+    :param message_hash: 32 bytes hash of the signed message
+    :param v: v parameter of ethereum signing
+    :param r: r parameter of ethereum signing
+    :param s: s parameter of ethereum signing
+    :return: checksum encoded address of the signer
+    """
+    public_key = get_ecrecover_backend().recover_public_key(message_hash, v, r, s)
+    return utils.checksum_encode(utils.sha3(public_key)[-20:])
@@ -0,0 +1,154 @@
+import threading
+from collections import OrderedDict
+from logging import getLogger
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+logger = getLogger(__name__)
+
+
+class SignerCacheProvider:
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = SignerCache(settings.SIGNER_CACHE_MAX_SIZE,
+                                       redis=get_redis() if settings.SIGNER_CACHE_REDIS else None,
+                                       redis_timeout=settings.SIGNER_CACHE_REDIS_TIMEOUT_SECONDS)
+        return cls.instance
+
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            del cls.instance
+
+
+class SignerCache:
+    """
+    Bounded LRU cache of the addresses recovered from signatures. Recovery is deterministic, so the same
+    `(message_hash, v, r, s)` always recovers the same address and entries never need to be invalidated.
+    Optionally, a Redis tier can be used to share recovered addresses between processes
+    """
+    KEY_PREFIX = 'signer:'
+
+    def __init__(self, max_size: int, redis: Optional[Redis] = None, redis_timeout: int = 60 * 60 * 24):
+        """
+        :param max_size: Max number of addresses kept on the process. `0` disables the cache
+        :param redis: If provided, addresses are shared between processes using Redis
+        :param redis_timeout: Seconds to keep the addresses on Redis
+        """
+        self.max_size = max_size
+        self.redis = redis
+        self.redis_timeout = redis_timeout
+        self._lock = threading.Lock()
+        self._cache: 'OrderedDict[bytes, str]' = OrderedDict()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _get_key(message_hash: bytes, v: int, r: int, s: int) -> bytes:
+        return message_hash + b'%d:%d:%d' % (v, r, s)
+
+    def _get_from_redis(self, redis_key: str) -> Optional[bytes]:
+        """
+        :param redis_key:
+        :return: Cached address, `None` if not cached or Redis is not available, so it's recovered locally
+        """
+        try:
+            return self.redis.get(redis_key)
+        except RedisError:
+            logger.warning('Cannot get signer from redis', exc_info=True)
+            return None
+
+    def get_cached_signing_address(self, message_hash: bytes, v: int, r: int, s: int) -> Optional[str]:
+        """
+        :param message_hash:
+        :param v:
+        :param r:
+        :param s:
+        :return: Checksummed address of the signer if cached, `None` otherwise
+        """
+        if not self.max_size:
+            return None
+
+        key = self._get_key(message_hash, v, r, s)
+        with self._lock:
+            address = self._cache.get(key)
+            if address is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return address
+
+        address = self._get_from_redis(self.KEY_PREFIX + key.hex()) if self.redis else None
+        if address is None:
+            return None
+        address = address.decode()
+        self.redis_hits += 1
+        self._add_local(key, address)
+        return address
+
+    def add_signing_address(self, message_hash: bytes, v: int, r: int, s: int, address: str):
+        """
+        Cache the address recovered for a signature not cached
+        :param message_hash:
+        :param v:
+        :param r:
+        :param s:
+        :param address: Checksummed address of the signer
+        """
+        if not self.max_size:
+            return
+
+        key = self._get_key(message_hash, v, r, s)
+        self.misses += 1
+        if self.redis:
+            try:
+                self.redis.set(self.KEY_PREFIX + key.hex(), address, ex=self.redis_timeout)
+            except RedisError:
+                logger.warning('Cannot cache signer on redis', exc_info=True)
+        self._add_local(key, address)
+
+    def _add_local(self, key: bytes, address: str):
+        with self._lock:
+            self._cache[key] = address
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def get_signing_address(self, message_hash: bytes, v: int, r: int, s: int, recover: Callable[[], str]) -> str:
+        """
+        :param message_hash:
+        :param v:
+        :param r:
+        :param s:
+        :param recover: Function recovering the address, called if it's not cached
+        :return: Checksummed address of the signer
+        """
+        address = self.get_cached_signing_address(message_hash, v, r, s)
+        if address is None:
+            address = recover()
+            self.add_signing_address(message_hash, v, r, s, address)
+        return address
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        :return: Dictionary with cache `size`, `hits`, `redis_hits`, `misses` and `hit_ratio` (including Redis hits)
+        """
+        hits = self.hits + self.redis_hits
+        total = hits + self.misses
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'hit_ratio': hits / total if total else 0.,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.redis_hits = self.misses = 0
@@ -1,10 +1,22 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
 from django.conf import settings
 
 from ethereum import utils
 
+from safe_notification_service.utils.process_pool import \
+    VerificationProcessPoolProvider
+
+from .ecrecover import ecrecover_to_address
+from .signer_cache import SignerCacheProvider
+
 
 class EthereumSignedMessage:
-    def __init__(self, message: str, v: int, r: int, s: int, hash_prefix: str = settings.ETH_HASH_PREFIX):
+    def __init__(self, message: str, v: int, r: int, s: int, hash_prefix: str = settings.ETH_HASH_PREFIX,
+                 message_hash: Optional[bytes] = None):
         """
         :param message: message
         :type message: str
@@ -16,11 +28,13 @@ class EthereumSignedMessage:
         :type s: int
         :param hash_prefix: hash_prefix of the message to avoid injecting transactions or other payloads
         :type hash_prefix: str
+        :param message_hash: hash of the message if already calculated, so it's not calculated again
+        :type message_hash: bytes
         """
 
         self.hash_prefix = hash_prefix if hash_prefix else ''
         self.message = message
-        self.message_hash = self.calculate_hash(message)
+        self.message_hash = message_hash or self.calculate_hash(message)
         self.v = int(v)
         self.r = int(r)
         self.s = int(s)
@@ -42,9 +56,16 @@ class EthereumSignedMessage:
         :return: checksum encoded address starting by 0x, for example `0x568c93675A8dEb121700A6FAdDdfE7DFAb66Ae4A`
         :rtype: str
         """
-        encoded_64_address = utils.ecrecover_to_pub(self.message_hash, self.v, self.r, self.s)
-        address_bytes = utils.sha3(encoded_64_address)[-20:]
-        return utils.checksum_encode(address_bytes)
+        return SignerCacheProvider().get_signing_address(self.message_hash, self.v, self.r, self.s,
+                                                         self.recover_signing_address)
+
+    def recover_signing_address(self) -> str:
+        """
+        Recover signing address without using the cache. Recovery runs on the verification process pool if enabled
+        :return: checksum encoded address starting by 0x
+        :rtype: str
+        """
+        return VerificationProcessPoolProvider().run(ecrecover_to_address, self.message_hash, self.v, self.r, self.s)
 
     def check_signing_address(self, address: str) -> bool:
         """
@@ -56,6 +77,61 @@ class EthereumSignedMessage:
         return utils.normalize_address(address) == utils.normalize_address(self.get_signing_address())
 
 
+class EthereumMultipleSignedMessage:
+    def __init__(self, message: str, signatures: Sequence[Tuple[int, int, int]],
+                 hash_prefix: str = settings.ETH_HASH_PREFIX):
+        """
+        Same message signed by multiple signers. Message is hashed only once
+        :param message: message
+        :param signatures: list of `(v, r, s)` tuples
+        :param hash_prefix: hash_prefix of the message to avoid injecting transactions or other payloads
+        """
+        self.hash_prefix = hash_prefix if hash_prefix else ''
+        self.message = message
+        self.message_hash = utils.sha3(self.hash_prefix + message)
+        self.signed_messages = [EthereumSignedMessage(message, v, r, s, hash_prefix=hash_prefix,
+                                                      message_hash=self.message_hash)
+                                for v, r, s in signatures]
+
+    def get_signing_addresses(self) -> List[str]:
+        """
+        Signers not cached are recovered in parallel if `VERIFICATION_PROCESS_POOL` is enabled, sending all of them
+        to the process pool at once. Otherwise, they are recovered on threads if `ETH_RECOVERY_POOL` is enabled
+        :return: checksum encoded addresses, in the same order as the signatures
+        :rtype: List[str]
+        """
+        process_pool = VerificationProcessPoolProvider()
+        if process_pool.max_workers and len(self.signed_messages) > 1:
+            signer_cache = SignerCacheProvider()
+            signatures = [(signed_message.message_hash, signed_message.v, signed_message.r, signed_message.s)
+                          for signed_message in self.signed_messages]
+            addresses = [signer_cache.get_cached_signing_address(*signature) for signature in signatures]
+            not_cached = [i for i, address in enumerate(addresses) if address is None]
+            recovered = process_pool.map(ecrecover_to_address, [signatures[i] for i in not_cached])
+            for i, address in zip(not_cached, recovered):
+                signer_cache.add_signing_address(*signatures[i], address)
+                addresses[i] = address
+            return addresses
+
+        executor = get_recovery_executor()
+        if executor and len(self.signed_messages) > 1:
+            return list(executor.map(EthereumSignedMessage.get_signing_address, self.signed_messages))
+        return [signed_message.get_signing_address() for signed_message in self.signed_messages]
+
+
+@lru_cache(maxsize=None)
+def get_recovery_executor() -> Optional[ThreadPoolExecutor]:
+    """
+    Native ecrecover backends release the GIL, so threads can recover signers in parallel. On gevent workers threads
+    are monkey patched into greenlets, so this pool doesn't help there, `VERIFICATION_PROCESS_POOL` must be used
+    :return: Thread pool to recover signers if `ETH_RECOVERY_POOL` is enabled, `None` otherwise
+    """
+    if not settings.ETH_RECOVERY_POOL:
+        return None
+    return ThreadPoolExecutor(max_workers=settings.ETH_RECOVERY_POOL_SIZE or os.cpu_count(),
+                              thread_name_prefix='ecrecover')
+
+
 class EthereumSigner(EthereumSignedMessage):
     def __init__(self, message: str, key: bytes, hash_prefix: str = settings.ETH_HASH_PREFIX):
         """
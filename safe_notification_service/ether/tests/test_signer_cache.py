@@ -0,0 +1,87 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from ethereum import utils
+from faker import Faker
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..signer_cache import SignerCache, SignerCacheProvider
+from ..signing import EthereumSignedMessage
+from .factories import get_eth_address_with_key
+
+faker = Faker()
+
+
+class TestSignerCache(TestCase):
+    def get_signature(self):
+        eth_address, eth_key = get_eth_address_with_key()
+        message_hash = utils.sha3(faker.name())
+        v, r, s = utils.ecsign(message_hash, eth_key)
+        return eth_address, (message_hash, v, r, s)
+
+    def test_get_signing_address(self):
+        signer_cache = SignerCache(max_size=2)
+        recover = mock.MagicMock()
+        signatures = []
+        for _ in range(3):
+            eth_address, signature = self.get_signature()
+            recover.return_value = eth_address
+            self.assertEqual(signer_cache.get_signing_address(*signature, recover), eth_address)
+            self.assertEqual(signer_cache.get_signing_address(*signature, recover), eth_address)
+            signatures.append(signature)
+        self.assertEqual(recover.call_count, 3)
+        self.assertEqual(signer_cache.get_stats(), {'size': 2, 'hits': 3, 'redis_hits': 0, 'misses': 3,
+                                                    'hit_ratio': 0.5})
+
+        # Least recently used signature was removed
+        signer_cache.get_signing_address(*signatures[0], recover)
+        self.assertEqual(recover.call_count, 4)
+
+        signer_cache.clear()
+        self.assertEqual(signer_cache.get_stats()['size'], 0)
+
+        # Cache disabled
+        signer_cache = SignerCache(max_size=0)
+        signer_cache.get_signing_address(*signatures[1], recover)
+        signer_cache.get_signing_address(*signatures[1], recover)
+        self.assertEqual(recover.call_count, 6)
+
+    def test_get_signing_address_redis(self):
+        eth_address, signature = self.get_signature()
+        signer_cache = SignerCache(max_size=10, redis=get_redis(), redis_timeout=60)
+        get_redis().delete(signer_cache.KEY_PREFIX + signer_cache._get_key(*signature).hex())
+        recover = mock.MagicMock(return_value=eth_address)
+        self.assertEqual(signer_cache.get_signing_address(*signature, recover), eth_address)
+
+        another_signer_cache = SignerCache(max_size=10, redis=get_redis(), redis_timeout=60)
+        self.assertEqual(another_signer_cache.get_signing_address(*signature, recover), eth_address)
+        self.assertEqual(recover.call_count, 1)
+        self.assertEqual(another_signer_cache.get_stats()['redis_hits'], 1)
+
+    def test_get_signing_address_redis_error(self):
+        eth_address, signature = self.get_signature()
+        redis = mock.MagicMock()
+        redis.get.side_effect = RedisError
+        redis.set.side_effect = RedisError
+        signer_cache = SignerCache(max_size=10, redis=redis, redis_timeout=60)
+        recover = mock.MagicMock(return_value=eth_address)
+        # Address is recovered locally if Redis is not available
+        self.assertEqual(signer_cache.get_signing_address(*signature, recover), eth_address)
+        self.assertEqual(signer_cache.get_signing_address(*signature, recover), eth_address)
+        self.assertEqual(recover.call_count, 1)
+        self.assertEqual(signer_cache.get_stats()['misses'], 1)
+
+    def test_ethereum_signed_message(self):
+        eth_address, eth_key = get_eth_address_with_key()
+        message = faker.name()
+        v, r, s = utils.ecsign(EthereumSignedMessage(message, 27, 1, 1).message_hash, eth_key)
+        SignerCacheProvider().clear()
+        with mock.patch.object(EthereumSignedMessage, 'recover_signing_address',
+                               autospec=True, return_value=eth_address) as recover_signing_address:
+            for _ in range(2):
+                self.assertEqual(EthereumSignedMessage(message, v, r, s).get_signing_address(), eth_address)
+            recover_signing_address.assert_called_once()
+        self.assertEqual(EthereumSignedMessage(message, v, r, s).recover_signing_address(), eth_address)
@@ -1,10 +1,19 @@
+from unittest import mock
+
 from django.conf import settings
 from django.test import TestCase
 
 from ethereum import utils
 from faker import Faker
 
-from ..signing import EthereumSignedMessage, EthereumSigner
+from safe_notification_service.utils.process_pool import (
+    ProcessPool, VerificationProcessPoolProvider)
+
+from ..ecrecover import (EMPTY_PUBLIC_KEY, CoincurveEcrecoverBackend,
+                         LegacyEcrecoverBackend, coincurve)
+from ..signer_cache import SignerCacheProvider
+from ..signing import (EthereumMultipleSignedMessage, EthereumSignedMessage,
+                       EthereumSigner, get_recovery_executor)
 from .factories import get_eth_address_with_key
 
 faker = Faker()
@@ -45,3 +54,69 @@ class TestSigning(TestCase):
 
         self.assertEqual(ethereum_signed_message.get_signing_address(), eth_address)
         self.assertTrue(utils.check_checksum(ethereum_signed_message.get_signing_address()))
+
+    def test_ecrecover_backends(self):
+        backends = [LegacyEcrecoverBackend()]
+        if coincurve:
+            backends.append(CoincurveEcrecoverBackend())
+
+        eth_address, eth_key = get_eth_address_with_key()
+        message_hash = utils.sha3(faker.name())
+        v, r, s = utils.ecsign(message_hash, eth_key)
+        for backend in backends:
+            public_key = backend.recover_public_key(message_hash, v, r, s)
+            self.assertEqual(public_key, utils.ecrecover_to_pub(message_hash, v, r, s))
+            self.assertEqual(utils.checksum_encode(utils.sha3(public_key)[-20:]), eth_address)
+
+        if coincurve:
+            coincurve_backend = CoincurveEcrecoverBackend()
+            for v, r, s in ((31, r, s), (v, 0, s), (v, 2 ** 256, s), (v, r, -1)):
+                self.assertEqual(coincurve_backend.recover_public_key(message_hash, v, r, s), EMPTY_PUBLIC_KEY)
+
+    def test_ethereum_multiple_signed_message(self):
+        message = faker.name()
+        eth_addresses = []
+        signatures = []
+        for _ in range(10):
+            eth_address, eth_key = get_eth_address_with_key()
+            eth_addresses.append(eth_address)
+            signatures.append(utils.ecsign(utils.sha3(settings.ETH_HASH_PREFIX + message), eth_key))
+
+        for recovery_pool in (False, True):
+            with self.settings(ETH_RECOVERY_POOL=recovery_pool, ETH_RECOVERY_POOL_SIZE=4):
+                get_recovery_executor.cache_clear()
+                self.assertEqual(get_recovery_executor() is not None, recovery_pool)
+                ethereum_multiple_signed_message = EthereumMultipleSignedMessage(message, signatures)
+                self.assertEqual(ethereum_multiple_signed_message.message_hash,
+                                 EthereumSignedMessage(message, *signatures[0]).message_hash)
+                self.assertEqual(ethereum_multiple_signed_message.get_signing_addresses(), eth_addresses)
+                self.assertEqual(EthereumMultipleSignedMessage(message, []).get_signing_addresses(), [])
+        get_recovery_executor.cache_clear()
+
+    def test_ethereum_multiple_signed_message_process_pool(self):
+        message = faker.name()
+        eth_addresses = []
+        signatures = []
+        for _ in range(3):
+            eth_address, eth_key = get_eth_address_with_key()
+            eth_addresses.append(eth_address)
+            signatures.append(utils.ecsign(utils.sha3(settings.ETH_HASH_PREFIX + message), eth_key))
+
+        SignerCacheProvider().clear()
+        # First signer is cached, so only the others are sent to the process pool
+        EthereumSignedMessage(message, *signatures[0]).get_signing_address()
+        process_pool = ProcessPool(2)
+        try:
+            with mock.patch.object(VerificationProcessPoolProvider, 'instance', process_pool, create=True):
+                with mock.patch.object(process_pool, 'map', wraps=process_pool.map) as map_mock:
+                    self.assertEqual(EthereumMultipleSignedMessage(message, signatures).get_signing_addresses(),
+                                     eth_addresses)
+                    map_mock.assert_called_once()
+                    self.assertEqual(len(map_mock.call_args[0][1]), 2)
+
+                    # Every signer is cached now
+                    self.assertEqual(EthereumMultipleSignedMessage(message, signatures).get_signing_addresses(),
+                                     eth_addresses)
+                    self.assertEqual(len(map_mock.call_args[0][1]), 0)
+        finally:
+            process_pool.shutdown()
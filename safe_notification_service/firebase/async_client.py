@@ -0,0 +1,218 @@
+import asyncio
+import os
+import threading
+from logging import getLogger
+from typing import Any, Coroutine, Dict, List, Optional
+
+import httpx
+from firebase_admin import credentials, exceptions, initialize_app, messaging
+from firebase_admin.messaging import UnregisteredError
+from google.auth.transport.requests import Request
+
+from .client import MessagingClient
+
+logger = getLogger(__name__)
+
+
+class AsyncFirebaseClient(MessagingClient):
+    """
+    Firebase client using the FCM HTTP v1 API through a shared pool of HTTP/2 connections. Requests are sent from an
+    asyncio event loop running in a background thread, so blocking callers (like Celery tasks) can keep hundreds of
+    requests in flight. Intended for the Celery workers, `verify_token` uses the blocking Firebase SDK.
+    Concurrency is only achieved by `send_multicast_message`, as `send_message` waits for its only response. So
+    `FirebaseProvider` only uses this client if `NOTIFICATION_MULTICAST` is enabled
+    """
+    FCM_URL = 'https://fcm.googleapis.com/v1/projects/{}/messages:send'
+    # https://firebase.google.com/docs/reference/fcm/rest/v1/ErrorCode
+    FCM_ERROR_TYPES = {
+        'APNS_AUTH_ERROR': messaging.ThirdPartyAuthError,
+        'QUOTA_EXCEEDED': messaging.QuotaExceededError,
+        'SENDER_ID_MISMATCH': messaging.SenderIdMismatchError,
+        'THIRD_PARTY_AUTH_ERROR': messaging.ThirdPartyAuthError,
+        'UNREGISTERED': messaging.UnregisteredError,
+    }
+    HTTP_STATUS_ERROR_TYPES = {
+        400: exceptions.InvalidArgumentError,
+        401: exceptions.UnauthenticatedError,
+        403: exceptions.PermissionDeniedError,
+        404: exceptions.NotFoundError,
+        409: exceptions.ConflictError,
+        412: exceptions.FailedPreconditionError,
+        429: exceptions.ResourceExhaustedError,
+        500: exceptions.InternalError,
+        503: exceptions.UnavailableError,
+    }
+
+    def __init__(self, credentials, *args, max_concurrency: int = 100, fcm_url: Optional[str] = None,
+                 timeout: float = 10., **kwargs):
+        """
+        :param credentials: Firebase credentials
+        :param max_concurrency: Max number of requests in flight at the same time
+        :param fcm_url: FCM send endpoint. If not provided it will be built using the `project_id`
+        :param timeout: Timeout in seconds for every request
+        """
+        self._credentials = credentials
+        self._authenticate(*args, **kwargs)
+        self._fcm_url = fcm_url or self.FCM_URL.format(self._app.project_id)
+        self._google_credential = self._app.credential.get_credential()
+        self._credential_lock = threading.Lock()
+        self._max_concurrency = max_concurrency
+        self._timeout = timeout
+        self._loop_lock = threading.Lock()
+        self._loop_pid: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _authenticate(self, *args, **kwargs):
+        if isinstance(self._credentials, dict):
+            self._auth_instance = credentials.Certificate(self._credentials)
+            self._app = initialize_app(self._auth_instance, *args, **kwargs)
+        else:
+            self._app = initialize_app(self._credentials, *args, **kwargs)
+
+    @property
+    def auth_provider(self):
+        return self._auth_instance
+
+    @property
+    def app(self):
+        return self._app
+
+    def _start_loop(self):
+        """
+        Start the event loop in a background thread. The loop is started again if the process was forked
+        (e.g. Celery prefork pool), as threads don't survive a fork
+        """
+        with self._loop_lock:
+            if self._loop_pid == os.getpid():
+                return
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name='AsyncFirebaseClient', daemon=True).start()
+            self._loop_pid = os.getpid()
+            # Pool and semaphore must be created inside the event loop
+            self._http_client, self._semaphore = self._run(self._setup_loop())
+
+    async def _setup_loop(self):
+        http_client = httpx.AsyncClient(http2=True,
+                                        timeout=self._timeout,
+                                        limits=httpx.Limits(max_connections=self._max_concurrency))
+        return http_client, asyncio.Semaphore(self._max_concurrency)
+
+    def _run(self, coroutine: Coroutine) -> Any:
+        """
+        Run `coroutine` on the background event loop and block until it finishes
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def close(self):
+        if self._loop_pid == os.getpid():
+            self._run(self._http_client.aclose())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_pid = None
+
+    def _get_access_token(self) -> str:
+        with self._credential_lock:
+            if not self._google_credential.valid:
+                self._google_credential.refresh(Request())
+            return self._google_credential.token
+
+    def _build_fcm_error(self, response: httpx.Response) -> exceptions.FirebaseError:
+        try:
+            error_dict = response.json().get('error', {})
+        except ValueError:
+            error_dict = {}
+        message = error_dict.get('message') or 'Unexpected HTTP response with status: {}; body: {}'.format(
+            response.status_code, response.text)
+        exception_type = None
+        for detail in error_dict.get('details', []):
+            if detail.get('@type') == 'type.googleapis.com/google.firebase.fcm.v1.FcmError':
+                exception_type = self.FCM_ERROR_TYPES.get(detail.get('errorCode'))
+                break
+        if not exception_type:
+            exception_type = self.HTTP_STATUS_ERROR_TYPES.get(response.status_code, exceptions.UnknownError)
+        return exception_type(message, http_response=response)
+
+    async def _send(self, message: messaging.Message) -> str:
+        """
+        :return: Firebase `MessageId`
+        :raises: FirebaseError
+        """
+        async with self._semaphore:
+            if self._google_credential.valid:
+                access_token = self._google_credential.token
+            else:
+                # Refreshing is blocking, but only happens once per hour
+                access_token = await asyncio.get_running_loop().run_in_executor(None, self._get_access_token)
+            try:
+                response = await self._http_client.post(
+                    self._fcm_url,
+                    json={'message': messaging._MessagingService.encode_message(message)},
+                    headers={'Authorization': 'Bearer {}'.format(access_token),
+                             'X-GOOG-API-FORMAT-VERSION': '2'}
+                )
+            except httpx.TimeoutException as exc:
+                raise exceptions.DeadlineExceededError('Timed out sending message: {}'.format(exc), cause=exc)
+            except httpx.HTTPError as exc:
+                raise exceptions.UnavailableError('Failed to establish a connection: {}'.format(exc), cause=exc)
+
+        if response.is_success:
+            return response.json()['name']
+        else:
+            raise self._build_fcm_error(response)
+
+    async def _send_multicast(self, messages: List[messaging.Message]) -> messaging.BatchResponse:
+        results = await asyncio.gather(*[self._send(message) for message in messages], return_exceptions=True)
+        send_responses = []
+        for result in results:
+            if isinstance(result, exceptions.FirebaseError):
+                send_responses.append(messaging.SendResponse(None, result))
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                send_responses.append(messaging.SendResponse({'name': result}, None))
+        return messaging.BatchResponse(send_responses)
+
+    def verify_token(self, token: str) -> bool:
+        """
+        Check if a token is valid on firebase for the project. Only way to do it is simulating a message send
+        :param token: Firebase client token
+        :return: True if valid, False otherwise
+        """
+        try:
+            message = messaging.Message(
+                data={},
+                token=token
+            )
+            messaging.send(message, dry_run=True, app=self._app)
+            return True
+        except UnregisteredError:
+            return False
+
+    def send_message(self, data: Dict[str, any], token: str, ios: bool = True, android: bool = True,
+                     ttl: Optional[float] = None, collapse_key: Optional[str] = None) -> str:
+        """
+        Send one message and wait for the response. It blocks the caller like `FirebaseClient.send_message`, use
+        `send_multicast_message` to send concurrently
+        :return: Firebase `MessageId`
+        """
+        logger.debug("Sending data=%s with token=%s", data, token)
+        self._start_loop()
+        message = messaging.Message(
+            data=data,
+            token=token,
+            **self.get_message_configs(ios=ios, android=android, ttl=ttl, collapse_key=collapse_key)
+        )
+        return self._run(self._send(message))
+
+    def send_multicast_message(self, data: Dict[str, any], tokens: List[str],
+                               ios: bool = True, android: bool = True, ttl: Optional[float] = None,
+                               collapse_key: Optional[str] = None) -> messaging.BatchResponse:
+        """
+        Send the same message to multiple tokens concurrently. Like `FirebaseClient`, every token is sent in its
+        own request, but requests are multiplexed over the pooled connections instead of using a thread per request
+        :return: Firebase `BatchResponse`, with one `SendResponse` per token in the same order than `tokens`
+        """
+        logger.debug("Sending data=%s with %d tokens", data, len(tokens))
+        self._start_loop()
+        configs = self.get_message_configs(ios=ios, android=android, ttl=ttl, collapse_key=collapse_key)
+        messages = [messaging.Message(data=data, token=token, **configs) for token in tokens]
+        return self._run(self._send_multicast(messages))
@@ -1,9 +1,14 @@
+import hashlib
+import time
 from abc import ABC, abstractmethod
+from datetime import timedelta
+from functools import lru_cache
 from logging import getLogger
-from typing import Dict
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional
 
-from firebase_admin import credentials, initialize_app, messaging
-from firebase_admin.messaging import UnregisteredError
+from firebase_admin import credentials, exceptions, initialize_app, messaging
+from firebase_admin.messaging import SenderIdMismatchError, UnregisteredError
 
 from safe_notification_service.utils.singleton import singleton
 
@@ -16,7 +21,16 @@ class FirebaseProvider:
             from django.conf import settings
             cls.instance = None
             try:
-                cls.instance = FirebaseClient(credentials=settings.FIREBASE_AUTH_CREDENTIALS)
+                # Async client only sends concurrently for multicast messages, single messages would block the
+                # worker waiting for the response anyway
+                if settings.FIREBASE_ASYNC_CLIENT and settings.NOTIFICATION_MULTICAST:
+                    from .async_client import AsyncFirebaseClient
+                    cls.instance = AsyncFirebaseClient(settings.FIREBASE_AUTH_CREDENTIALS,
+                                                       max_concurrency=settings.FIREBASE_ASYNC_MAX_CONCURRENCY)
+                else:
+                    if settings.FIREBASE_ASYNC_CLIENT:
+                        logger.warning('FIREBASE_ASYNC_CLIENT requires NOTIFICATION_MULTICAST, using FirebaseClient')
+                    cls.instance = FirebaseClient(credentials=settings.FIREBASE_AUTH_CREDENTIALS)
             except AttributeError:
                 logger.warning('FIREBASE_AUTH_CREDENTIALS not found in settings')
             except Exception as e:
@@ -27,25 +41,13 @@ class FirebaseProvider:
                     cls.instance = MockedClient()
         return cls.instance
 
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            del cls.instance
 
-class MessagingClient(ABC):
-    @property
-    @abstractmethod
-    def auth_provider(self):
-        pass
 
-    @property
-    @abstractmethod
-    def app(self):
-        return self._app
-
-    @abstractmethod
-    def send_message(self, data: Dict[str, any], token: str, ios: bool = True) -> str:
-        raise NotImplementedError
-
-
-@singleton
-class FirebaseClient(MessagingClient):
+class MessagingClient(ABC):
     # Data for the Apple Push Notification Service
     # see https://firebase.google.com/docs/reference/admin/python/firebase_admin.messaging
     apns = messaging.APNSConfig(
@@ -69,6 +71,120 @@ class FirebaseClient(MessagingClient):
         ),
     )
 
+    @property
+    @abstractmethod
+    def auth_provider(self):
+        pass
+
+    @property
+    @abstractmethod
+    def app(self):
+        return self._app
+
+    # Max number of messages Firebase allows to be sent in one batch request
+    MAX_BATCH_SIZE = 500
+
+    # Errors verifying a token that will never succeed, so token is not valid
+    NOT_VALID_TOKEN_EXCEPTIONS = (UnregisteredError, SenderIdMismatchError, exceptions.InvalidArgumentError)
+
+    @abstractmethod
+    def verify_token(self, token: str) -> bool:
+        raise NotImplementedError
+
+    def verify_tokens(self, tokens: List[str]) -> List[Optional[bool]]:
+        """
+        Check multiple tokens simulating a message send, in batches of `MAX_BATCH_SIZE` tokens
+        :param tokens: Firebase client tokens
+        :return: For every token, in the same order than `tokens`, `True` if valid, `False` if not valid and
+        `None` if it could not be checked (e.g. Firebase was not available)
+        """
+        results = []
+        for i in range(0, len(tokens), self.MAX_BATCH_SIZE):
+            messages = [messaging.Message(data={}, token=token) for token in tokens[i:i + self.MAX_BATCH_SIZE]]
+            try:
+                batch_response = messaging.send_each(messages, dry_run=True, app=self.app)
+            except exceptions.FirebaseError as exc:
+                logger.warning('Cannot verify batch of %d tokens: %s', len(messages), exc)
+                results.extend([None] * len(messages))
+                continue
+            for send_response in batch_response.responses:
+                if send_response.success:
+                    results.append(True)
+                elif isinstance(send_response.exception, self.NOT_VALID_TOKEN_EXCEPTIONS):
+                    results.append(False)
+                else:
+                    logger.warning('Cannot verify token: %s', send_response.exception)
+                    results.append(None)
+        return results
+
+    # APNs rejects `apns-collapse-id` longer than 64 bytes
+    APNS_COLLAPSE_ID_MAX_LENGTH = 64
+
+    def get_apns_collapse_id(self, collapse_key: str) -> str:
+        """
+        :param collapse_key:
+        :return: `collapse_key`, hashed if it's too long for APNs
+        """
+        if len(collapse_key.encode()) > self.APNS_COLLAPSE_ID_MAX_LENGTH:
+            return hashlib.sha256(collapse_key.encode()).hexdigest()
+        return collapse_key
+
+    def get_message_configs(self, ios: bool = True, android: bool = True, ttl: Optional[float] = None,
+                            collapse_key: Optional[str] = None) -> Mapping[str, any]:
+        """
+        :param ios: If `True`, `apns` is configured for Apple devices
+        :param android: If `True`, `android` is configured when needed
+        :param ttl: Seconds the message is kept by FCM/APNs if device is not reachable. If not provided, platform
+        defaults are used
+        :param collapse_key: Messages with the same collapse key replace the previous ones not delivered yet
+        :return: `android` and `apns` arguments for a Firebase `Message` or `MulticastMessage`. They must not be
+        modified, as they can be shared
+        """
+        # Configs not depending on `ttl` are built once and reused
+        message_configs = self._get_cached_message_configs(ios, android, collapse_key)
+        if ttl is None:
+            return message_configs
+
+        # Only the expiration depends on the time, the rest of the configs are reused
+        ttl = max(ttl, 0)
+        android_config = (messaging.AndroidConfig(ttl=timedelta(seconds=ttl), collapse_key=collapse_key)
+                          if android else None)
+        apns_config = message_configs['apns']
+        if apns_config:
+            apns_config = messaging.APNSConfig(headers={**apns_config.headers,
+                                                        'apns-expiration': str(int(time.time() + ttl))},
+                                               payload=apns_config.payload)
+        return {'android': android_config, 'apns': apns_config}
+
+    @lru_cache(maxsize=1024)
+    def _get_cached_message_configs(self, ios: bool, android: bool, collapse_key: Optional[str]) -> Mapping[str, any]:
+        android_config = apns_config = None
+        if android and collapse_key:
+            android_config = messaging.AndroidConfig(collapse_key=collapse_key)
+        if ios:
+            apns_config = self.apns
+            if collapse_key:
+                apns_collapse_id = self.get_apns_collapse_id(collapse_key)
+                apns_config = messaging.APNSConfig(
+                    headers={**apns_config.headers, 'apns-collapse-id': apns_collapse_id},
+                    payload=apns_config.payload
+                )
+        return MappingProxyType({'android': android_config, 'apns': apns_config})
+
+    @abstractmethod
+    def send_message(self, data: Dict[str, any], token: str, ios: bool = True, android: bool = True,
+                     ttl: Optional[float] = None, collapse_key: Optional[str] = None) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def send_multicast_message(self, data: Dict[str, any], tokens: List[str],
+                               ios: bool = True, android: bool = True, ttl: Optional[float] = None,
+                               collapse_key: Optional[str] = None) -> messaging.BatchResponse:
+        raise NotImplementedError
+
+
+@singleton
+class FirebaseClient(MessagingClient):
     def __init__(self, credentials, *args, **kwargs):
         self._credentials = credentials
         self._authenticate(*args, **kwargs)
@@ -104,24 +220,51 @@ class FirebaseClient(MessagingClient):
         except UnregisteredError:
             return False
 
-    def send_message(self, data: Dict[str, any], token: str, ios: bool = True) -> str:
+    def send_message(self, data: Dict[str, any], token: str, ios: bool = True, android: bool = True,
+                     ttl: Optional[float] = None, collapse_key: Optional[str] = None) -> str:
         """
         Send message using firebase service
         :param data: Dictionary with the notification data
         :param token: Firebase token of recipient
         :param ios: If `True`, `apns` is configured for Apple devices. Otherwise, is not configured and Apple
         devices will not receive the notification
+        :param android: If `False`, `android` is not configured, as it's only useful for Android devices
+        :param ttl: Seconds the message is kept if device is not reachable
+        :param collapse_key: Messages with the same collapse key replace the previous ones not delivered yet
         :return: Firebase `MessageId`
         """
         logger.debug("Sending data=%s with token=%s", data, token)
         message = messaging.Message(
-            apns=self.apns if ios else None,
             data=data,
-            token=token
+            token=token,
+            **self.get_message_configs(ios=ios, android=android, ttl=ttl, collapse_key=collapse_key)
         )
         response = messaging.send(message)
         return response
 
+    def send_multicast_message(self, data: Dict[str, any], tokens: List[str],
+                               ios: bool = True, android: bool = True, ttl: Optional[float] = None,
+                               collapse_key: Optional[str] = None) -> messaging.BatchResponse:
+        """
+        Send the same message to multiple tokens. Firebase sends every token on its own HTTP v1 request (the legacy
+        batch endpoint is not available anymore), concurrently
+        :param data: Dictionary with the notification data
+        :param tokens: Firebase tokens of recipients. No more than 500 are allowed
+        :param ios: If `True`, `apns` is configured for Apple devices. Otherwise, is not configured and Apple
+        devices will not receive the notification
+        :param android: If `False`, `android` is not configured, as it's only useful for Android devices
+        :param ttl: Seconds the message is kept if devices are not reachable
+        :param collapse_key: Messages with the same collapse key replace the previous ones not delivered yet
+        :return: Firebase `BatchResponse`, with one `SendResponse` per token in the same order than `tokens`
+        """
+        logger.debug("Sending data=%s with %d tokens", data, len(tokens))
+        multicast_message = messaging.MulticastMessage(
+            data=data,
+            tokens=tokens,
+            **self.get_message_configs(ios=ios, android=android, ttl=ttl, collapse_key=collapse_key)
+        )
+        return messaging.send_each_for_multicast(multicast_message, app=self.app)
+
 
 @singleton
 class MockedClient(MessagingClient):
@@ -136,6 +279,17 @@ class MockedClient(MessagingClient):
     def verify_token(self, token: str) -> bool:
         return True
 
-    def send_message(self, data: Dict[str, any], token: str, ios: bool = True) -> str:
+    def verify_tokens(self, tokens: List[str]) -> List[Optional[bool]]:
+        return [True] * len(tokens)
+
+    def send_message(self, data: Dict[str, any], token: str, ios: bool = True, android: bool = True,
+                     ttl: Optional[float] = None, collapse_key: Optional[str] = None) -> str:
         logger.warning("MockedClient: Not sending message with data %s and token %s", data, token)
         return 'MockedResponse'
+
+    def send_multicast_message(self, data: Dict[str, any], tokens: List[str],
+                               ios: bool = True, android: bool = True, ttl: Optional[float] = None,
+                               collapse_key: Optional[str] = None) -> messaging.BatchResponse:
+        logger.warning("MockedClient: Not sending message with data %s and tokens %s", data, tokens)
+        return messaging.BatchResponse([messaging.SendResponse({'name': 'MockedResponse'}, None)
+                                        for _ in tokens])
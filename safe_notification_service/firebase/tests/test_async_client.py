@@ -0,0 +1,110 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.test import TestCase
+
+from firebase_admin import exceptions
+from firebase_admin.messaging import QuotaExceededError, UnregisteredError
+
+from safe_notification_service.firebase.async_client import AsyncFirebaseClient
+from safe_notification_service.firebase.client import FirebaseProvider
+
+from .utils import MockCredential
+
+
+class FcmStandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers like FCM HTTP v1 API depending on the token of the message
+    """
+    def _send_json(self, status: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.requests.append(self.headers)
+        message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['message']
+        token = message['token']
+        if token == 'unregistered-token':
+            self._send_json(404, {'error': {
+                'code': 404,
+                'message': 'Requested entity was not found.',
+                'status': 'NOT_FOUND',
+                'details': [{'@type': 'type.googleapis.com/google.firebase.fcm.v1.FcmError',
+                             'errorCode': 'UNREGISTERED'}]
+            }})
+        elif token == 'quota-token':
+            self._send_json(429, {'error': {
+                'code': 429,
+                'message': 'Quota exceeded.',
+                'status': 'RESOURCE_EXHAUSTED',
+                'details': [{'@type': 'type.googleapis.com/google.firebase.fcm.v1.FcmError',
+                             'errorCode': 'QUOTA_EXCEEDED'}]
+            }})
+        elif token == 'unavailable-token':
+            self._send_json(503, {})
+        else:
+            self._send_json(200, {'name': 'projects/mock-project-id/messages/{}'.format(token)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestAsyncFirebaseClient(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FcmStandInHandler)
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.firebase_client = AsyncFirebaseClient(MockCredential(), {'projectId': 'mock-project-id'},
+                                                  'async-firebase-client', max_concurrency=10,
+                                                  fcm_url='http://127.0.0.1:{}'.format(cls.server.server_port))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.firebase_client.close()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_send_message(self):
+        self.assertEqual(self.firebase_client.send_message({'value': 'mock-value'}, 'mock-token'),
+                         'projects/mock-project-id/messages/mock-token')
+        self.assertEqual(self.server.requests[-1]['Authorization'], 'Bearer mock-token')
+
+        with self.assertRaises(UnregisteredError):
+            self.firebase_client.send_message({'value': 'mock-value'}, 'unregistered-token')
+
+        with self.assertRaises(exceptions.UnavailableError):
+            self.firebase_client.send_message({'value': 'mock-value'}, 'unavailable-token')
+
+    def test_send_multicast_message(self):
+        tokens = ['token-{}'.format(i) for i in range(50)] + ['unregistered-token', 'quota-token']
+        batch_response = self.firebase_client.send_multicast_message({'value': 'mock-value'}, tokens)
+        self.assertEqual(len(batch_response.responses), len(tokens))
+        self.assertEqual(batch_response.success_count, 50)
+        for token, send_response in zip(tokens[:50], batch_response.responses):
+            self.assertEqual(send_response.message_id, 'projects/mock-project-id/messages/{}'.format(token))
+        self.assertIsInstance(batch_response.responses[-2].exception, UnregisteredError)
+        self.assertIsInstance(batch_response.responses[-1].exception, QuotaExceededError)
+
+    def test_firebase_provider(self):
+        # Async client is only used for multicast messages
+        for notification_multicast, expected_client in ((False, 'FirebaseClient'), (True, 'AsyncFirebaseClient')):
+            with self.settings(FIREBASE_ASYNC_CLIENT=True, NOTIFICATION_MULTICAST=notification_multicast,
+                               FIREBASE_AUTH_CREDENTIALS={}):
+                with mock.patch('safe_notification_service.firebase.client.FirebaseClient') as firebase_client_mock:
+                    with mock.patch('safe_notification_service.firebase.async_client.AsyncFirebaseClient') as \
+                            async_firebase_client_mock:
+                        FirebaseProvider.del_singleton()
+                        firebase_client = FirebaseProvider()
+                        FirebaseProvider.del_singleton()
+            self.assertEqual(firebase_client, {'FirebaseClient': firebase_client_mock,
+                                               'AsyncFirebaseClient': async_firebase_client_mock}[
+                expected_client].return_value)
@@ -1,5 +1,9 @@
+from unittest import mock
+
 from django.test import TestCase
 
+from firebase_admin import exceptions, messaging
+
 from safe_notification_service.firebase.client import FirebaseClient
 
 from .utils import MessagingService, MockCredential, send_message
@@ -21,3 +25,69 @@ class TestFirebase(TestCase):
                                                      data={'value': 'mock-value'},
                                                      token='mock-token')
         self.assertIsNotNone(response)
+
+    def test_send_multicast_message(self):
+        tokens = ['mock-token-1', 'mock-token-2']
+        recorder = self.firebase_messaging.recorder
+        batch_response = self.firebase_client.send_multicast_message({'value': 'mock-value'}, tokens)
+        self.assertEqual(batch_response.success_count, 2)
+        self.assertEqual([send_response.message_id for send_response in batch_response.responses],
+                         ['message-id', 'message-id'])
+        # Every token is sent using the HTTP v1 API, not the legacy batch endpoint
+        self.assertEqual(len(recorder), 2)
+        for request in recorder:
+            self.assertEqual(request.url, 'https://fcm.googleapis.com/v1/projects/mock-project-id/messages:send')
+
+    def test_verify_tokens(self):
+        tokens = ['mock-token-1', 'mock-token-2']
+        recorder = self.firebase_messaging.recorder
+        self.assertEqual(self.firebase_client.verify_tokens(tokens), [True, True])
+        self.assertEqual(len(recorder), 2)
+        for request in recorder:
+            self.assertEqual(request.url, 'https://fcm.googleapis.com/v1/projects/mock-project-id/messages:send')
+
+        # Tokens are not verified if the whole batch fails
+        with mock.patch.object(messaging, 'send_each', side_effect=exceptions.UnavailableError('Unavailable')):
+            self.assertEqual(self.firebase_client.verify_tokens(tokens), [None, None])
+
+        # Errors that will never succeed mean token is not valid, the others that token could not be verified
+        batch_response = messaging.BatchResponse([
+            messaging.SendResponse(None, messaging.UnregisteredError('Unregistered')),
+            messaging.SendResponse(None, messaging.SenderIdMismatchError('Sender id mismatch')),
+            messaging.SendResponse(None, exceptions.InvalidArgumentError('Invalid token')),
+            messaging.SendResponse(None, exceptions.UnavailableError('Unavailable')),
+        ])
+        with mock.patch.object(messaging, 'send_each', return_value=batch_response):
+            self.assertEqual(self.firebase_client.verify_tokens(['mock-token-%d' % i for i in range(4)]),
+                             [False, False, False, None])
+
+    def test_get_message_configs(self):
+        message_configs = self.firebase_client.get_message_configs()
+        self.assertIsNone(message_configs['android'])
+        self.assertEqual(message_configs['apns'], self.firebase_client.apns)
+        self.assertIsNone(self.firebase_client.get_message_configs(ios=False)['apns'])
+        # Configs not depending on the time are reused
+        self.assertIs(self.firebase_client.get_message_configs(collapse_key='safeCreation'),
+                      self.firebase_client.get_message_configs(collapse_key='safeCreation'))
+        self.assertIsNone(self.firebase_client.get_message_configs(android=False, ttl=60)['android'])
+
+        message_configs = self.firebase_client.get_message_configs(ttl=60)
+        self.assertEqual(message_configs['android'].ttl.total_seconds(), 60)
+        self.assertIn('apns-expiration', message_configs['apns'].headers)
+        self.assertEqual(message_configs['apns'].headers['apns-priority'], '10')
+        self.assertNotIn('apns-expiration', self.firebase_client.apns.headers)
+        # Configs not depending on the time are reused with `ttl` too
+        message_configs = self.firebase_client.get_message_configs(ttl=60, collapse_key='safeCreation')
+        self.assertEqual(message_configs['android'].collapse_key, 'safeCreation')
+        self.assertEqual(message_configs['apns'].headers['apns-collapse-id'], 'safeCreation')
+        self.assertIs(message_configs['apns'].payload, self.firebase_client.apns.payload)
+
+        message_configs = self.firebase_client.get_message_configs(collapse_key='safeCreation')
+        self.assertEqual(message_configs['android'].collapse_key, 'safeCreation')
+        self.assertIsNone(message_configs['android'].ttl)
+        self.assertEqual(message_configs['apns'].headers['apns-collapse-id'], 'safeCreation')
+        long_collapse_key = 'confirmationRequest:' + '0x4D953115678b15CE0B0396bCF95Db68003f86FB5' * 2
+        apns_collapse_id = self.firebase_client.get_message_configs(
+            collapse_key=long_collapse_key).get('apns').headers['apns-collapse-id']
+        self.assertEqual(len(apns_collapse_id), 64)
+        self.assertEqual(apns_collapse_id, self.firebase_client.get_apns_collapse_id(long_collapse_key))
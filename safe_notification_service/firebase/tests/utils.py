@@ -1,3 +1,4 @@
+import io
 import json
 
 from firebase_admin import _http_client, messaging
@@ -60,7 +61,7 @@ class MockAdapter(adapters.HTTPAdapter):
         resp = models.Response()
         resp.url = request.url
         resp.status_code = self._status
-        resp.raw = self._data.encode()
+        resp.raw = io.BytesIO(self._data.encode())
         return resp
 
 
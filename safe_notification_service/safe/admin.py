@@ -1,16 +1,27 @@
 from django.contrib import admin
 
-from .models import Device, DevicePair, NotificationType
+from .models import Device, DevicePair, NotificationOutbox, NotificationType
 
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
     date_hierarchy = 'created'
     list_display = ('created', 'push_token', 'owner', 'client', 'version_name')
-    list_filter = ('client', 'version_name')
+    list_filter = ('client', 'version_name', 'pending_verification')
     ordering = ['-created']
     readonly_fields = ('created', 'modified')
-    search_fields = ['owner', 'push_token']
+    search_fields = ['owner']
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Search by `push_token` using the indexed hash, so only exact matches are returned
+        """
+        original_queryset = queryset
+        queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            # Filter the incoming queryset, so changelist filters are kept
+            queryset |= original_queryset.filter_by_push_token(search_term.strip())
+        return queryset, may_have_duplicates
 
 
 @admin.register(DevicePair)
@@ -22,6 +33,15 @@ class DevicePairAdmin(admin.ModelAdmin):
 
 @admin.register(NotificationType)
 class NotificationTypeAdmin(admin.ModelAdmin):
-    list_display = ('name', 'description', 'ios', 'android', 'extension')
-    list_filter = ('name', 'ios', 'android', 'extension')
+    list_display = ('name', 'description', 'ios', 'android', 'extension', 'priority', 'ttl',
+                    'collapse_key')
+    list_filter = ('name', 'ios', 'android', 'extension', 'priority')
     search_fields = ['name', 'description']
+
+
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    date_hierarchy = 'created'
+    list_display = ('id', 'created', 'task_name')
+    list_filter = ('task_name',)
+    ordering = ['id']
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class SafeConfig(AppConfig):
     name = 'safe_notification_service.safe'
     verbose_name = 'Safe Notification Service'
+
+    def ready(self):
+        from . import signals  # noqa F401
+        from .throttling import check_throttle_rates
+        check_throttle_rates()
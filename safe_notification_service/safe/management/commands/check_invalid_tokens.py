@@ -1,27 +1,119 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
 from django.core.management.base import BaseCommand
 
-from safe_notification_service.firebase.client import FirebaseProvider
+from safe_notification_service.firebase.client import (FirebaseProvider,
+                                                       MessagingClient)
+from safe_notification_service.utils.redis import get_redis
 
 from ...models import Device
+from ...services import PushTokenReaperProvider
 
 
 class Command(BaseCommand):
-    help = 'Check status of Firebase push tokens and return not valid ones'
+    help = ('Check status of Firebase push tokens and return not valid ones. Devices are streamed ordered by owner '
+            'and progress is stored on Redis, so the command can be resumed if stopped')
+    CHECKPOINT_KEY = 'check-invalid-tokens:checkpoint'
 
     def add_arguments(self, parser):
         parser.add_argument('--delete', help='Remove tokens not valid', action='store_true')
+        parser.add_argument('--batch-size', help='Number of tokens verified per Firebase request', type=int,
+                            default=MessagingClient.MAX_BATCH_SIZE)
+        parser.add_argument('--concurrency', help='Number of Firebase requests run at the same time', type=int,
+                            default=4)
+        parser.add_argument('--restart', help='Ignore stored progress and check every token', action='store_true')
+
+    def get_batches(self, batch_size: int, checkpoint: Optional[str]) -> Iterator[List[Tuple[str, str]]]:
+        """
+        Stream devices with a server side cursor, so they are not loaded in memory
+        :return: Batches of `(owner, push_token)`
+        """
+        devices = Device.objects.exclude(push_token=None).order_by('owner')
+        if checkpoint:
+            devices = devices.filter(owner__gt=checkpoint)
+        batch = []
+        for owner, push_token in devices.values_list('owner', 'push_token').iterator(chunk_size=batch_size):
+            batch.append((owner, push_token))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def verify_batch(self, firebase_client: MessagingClient, batch: List[Tuple[str, str]]) -> List[Optional[bool]]:
+        """
+        :return: Verification of every push token of the `batch`. If the batch fails, its push tokens are
+            returned as not verified (`None`), so one failure doesn't stop the whole check
+        """
+        push_tokens = [push_token for _, push_token in batch]
+        try:
+            return firebase_client.verify_tokens(push_tokens)
+        except Exception as exc:
+            self.stdout.write(self.style.ERROR('Cannot verify batch of {} tokens: {}'.format(len(push_tokens), exc)))
+            return [None] * len(push_tokens)
 
     def handle(self, *args, **options):
         delete = options['delete']
+        batch_size = min(options['batch_size'], MessagingClient.MAX_BATCH_SIZE)
+        concurrency = options['concurrency']
         firebase_client = FirebaseProvider()
         if not firebase_client.app:
             self.stdout.write(self.style.ERROR('Firebase provider not configured!'))
+            return
+
+        redis = get_redis()
+        if options['restart']:
+            redis.delete(self.CHECKPOINT_KEY)
+        checkpoint = redis.get(self.CHECKPOINT_KEY)
+        checkpoint = checkpoint.decode() if checkpoint else None
+        if checkpoint:
+            self.stdout.write(self.style.SUCCESS('Resuming from owner={}'.format(checkpoint)))
+
+        checked = not_valid = not_verified = 0
+        unverified_found = False
+        start = time.monotonic()
+        batches = self.get_batches(batch_size, checkpoint)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                # Every group of batches is completed before storing the checkpoint, so no token is skipped on resume
+                group = [batch for _, batch in zip(range(concurrency), batches)]
+                if not group:
+                    break
+                push_tokens = [push_token for batch in group for _, push_token in batch]
+                group_results = list(executor.map(lambda batch: self.verify_batch(firebase_client, batch), group))
+                results = [result for batch_results in group_results for result in batch_results]
+
+                not_valid_push_tokens = list({push_token for push_token, is_valid in zip(push_tokens, results)
+                                              if is_valid is False})
+                for push_token in not_valid_push_tokens:
+                    self.stdout.write(self.style.SUCCESS('Push-token={} is not valid anymore'.format(push_token)))
+                if delete and not_valid_push_tokens:
+                    PushTokenReaperProvider().reap(not_valid_push_tokens)
+
+                # Every count is per device, as devices of different owners can share a push token
+                checked += len(push_tokens)
+                not_valid += results.count(False)
+                not_verified += results.count(None)
+                if not unverified_found:
+                    # Checkpoint is not moved past batches with tokens not verified, so they are checked on resume
+                    for batch, batch_results in zip(group, group_results):
+                        if None in batch_results:
+                            unverified_found = True
+                            break
+                        redis.set(self.CHECKPOINT_KEY, batch[-1][0])
+                elapsed = time.monotonic() - start
+                self.stdout.write('Checked {} devices ({:.1f} devices/s), {} with tokens not valid, {} could not be '
+                                  'verified'.format(checked, checked / elapsed if elapsed else 0, not_valid,
+                                                    not_verified))
+
+        if unverified_found:
+            self.stdout.write(self.style.WARNING('Some tokens could not be verified, run the command again to resume '
+                                                 'from the first of them'))
         else:
-            for device in Device.objects.all():
-                if not device.push_token:
-                    continue
-                if not firebase_client.verify_token(device.push_token):
-                    self.stdout.write(self.style.SUCCESS('Push-token={} is not valid anymore').format(device.push_token))
-                    if delete:
-                        device.push_token = None
-                        device.save()
+            redis.delete(self.CHECKPOINT_KEY)
+        self.stdout.write(self.style.SUCCESS(
+            'Finished in {:.1f} seconds. Checked {} devices, {} with tokens not valid, {} could not be '
+            'verified'.format(
+                time.monotonic() - start, checked, not_valid, not_verified)))
@@ -0,0 +1,50 @@
+import time
+from logging import getLogger
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...tasks import relay_notification_outbox
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Publish to the broker the notification tasks stored on the outbox. Multiple relays can run at once'
+    # Max seconds to wait between retries when relaying fails (e.g. broker not available)
+    MAX_RETRY_INTERVAL = 60
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', help='Max number of tasks published at once', type=int,
+                            default=settings.NOTIFICATION_OUTBOX_RELAY_BATCH_SIZE)
+        parser.add_argument('--interval', help='Seconds to wait when outbox is empty', type=float,
+                            default=settings.NOTIFICATION_OUTBOX_RELAY_INTERVAL_SECONDS)
+        parser.add_argument('--once', help='Exit when outbox is empty', action='store_true')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        interval = options['interval']
+        self.stdout.write(self.style.SUCCESS('Relaying notification outbox in batches of {}'.format(batch_size)))
+        errors = 0
+        while True:
+            try:
+                published = relay_notification_outbox(batch_size)
+            except Exception:
+                if options['once']:
+                    raise
+                # Tasks are kept on the outbox, so they are published when the broker or database are back
+                errors += 1
+                retry_interval = min(interval * 2 ** errors, self.MAX_RETRY_INTERVAL)
+                logger.exception('Cannot relay notification outbox, retrying in %.1f seconds', retry_interval)
+                close_old_connections()
+                time.sleep(retry_interval)
+                continue
+
+            errors = 0
+            if published:
+                self.stdout.write('Published {} tasks'.format(published))
+            if published < batch_size:
+                if options['once']:
+                    break
+                time.sleep(interval)
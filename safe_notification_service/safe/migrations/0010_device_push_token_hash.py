@@ -0,0 +1,44 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def get_push_token_hash(push_token):
+    # Copy of `safe.models.get_push_token_hash` when the migration was created, so it doesn't change with the models
+    if not push_token:
+        return None
+    return int.from_bytes(hashlib.sha256(push_token.encode()).digest()[:8], 'big', signed=True)
+
+
+def set_push_token_hash(apps, schema_editor):
+    Device = apps.get_model('safe', 'Device')
+    devices = []
+    for device in Device.objects.exclude(push_token=None).only('owner', 'push_token').iterator(chunk_size=2000):
+        device.push_token_hash = get_push_token_hash(device.push_token)
+        devices.append(device)
+        if len(devices) == 2000:
+            Device.objects.bulk_update(devices, ['push_token_hash'])
+            devices = []
+    Device.objects.bulk_update(devices, ['push_token_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0009_auto_20190626_1002'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='push_token_hash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_push_token_hash, reverse_code=migrations.RunPython.noop),
+        # Index is created after setting the hashes
+        migrations.AlterField(
+            model_name='device',
+            name='push_token_hash',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
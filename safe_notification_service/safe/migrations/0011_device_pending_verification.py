@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0010_device_push_token_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='pending_verification',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
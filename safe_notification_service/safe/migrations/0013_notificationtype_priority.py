@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0012_notificationoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationtype',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'HIGH'), (1, 'NORMAL'), (2, 'LOW')], default=1),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0013_notificationtype_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationtype',
+            name='ttl',
+            field=models.PositiveIntegerField(blank=True, default=None, null=True),
+        ),
+    ]
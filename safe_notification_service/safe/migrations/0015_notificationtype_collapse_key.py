@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0014_notificationtype_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationtype',
+            name='collapse_key',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
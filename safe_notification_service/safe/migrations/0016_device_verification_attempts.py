@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0015_notificationtype_collapse_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='verification_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
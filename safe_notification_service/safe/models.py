@@ -1,6 +1,11 @@
+import hashlib
+from collections import defaultdict
 from enum import Enum
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
 
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models
+from django.utils import timezone
 
 from model_utils.models import TimeStampedModel
 
@@ -13,23 +18,163 @@ class DeviceTypeEnum(Enum):
     EXTENSION = 2
 
 
-class DeviceManager(models.Manager):
+class NotificationPriorityEnum(Enum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+    @property
+    def queue(self) -> str:
+        """
+        :return: Celery queue for the notification tasks with this priority
+        """
+        return 'notifications-' + self.name.lower()
+
+
+def get_push_token_hash(push_token: Optional[str]) -> Optional[int]:
+    """
+    :param push_token:
+    :return: 64 bits digest of the `push_token` (first 8 bytes of sha256), `None` if there's no `push_token`
+    """
+    if not push_token:
+        return None
+    return int.from_bytes(hashlib.sha256(push_token.encode()).digest()[:8], 'big', signed=True)
+
+
+class DeviceQuerySet(models.QuerySet):
+    """
+    `push_token` is a long not indexed text, so lookups must use the indexed `push_token_hash`. As the hash could
+    collide `push_token` is also checked
+    """
+    def filter_by_push_token(self, push_token: str):
+        return self.filter(push_token_hash=get_push_token_hash(push_token), push_token=push_token)
+
+    def filter_by_push_tokens(self, push_tokens: Sequence[str]):
+        return self.filter(push_token_hash__in=[get_push_token_hash(push_token) for push_token in push_tokens],
+                           push_token__in=push_tokens)
+
+    def filter_pending_verification(self):
+        return self.filter(pending_verification=True).exclude(push_token=None)
+
+    def remove_push_tokens(self) -> int:
+        """
+        :return: Number of devices updated
+        """
+        return self.update(push_token=None, push_token_hash=None, pending_verification=False,
+                           verification_attempts=0)
+
+
+class DeviceManager(models.Manager.from_queryset(DeviceQuerySet)):
     def get_or_create_without_push_token(self, owner):
         try:
             return self.get(owner=owner)
         except self.model.DoesNotExist:
             return self.create(owner=owner, push_token=None)
 
+    def register_push_token(self, push_token: str, build_number: int, version_name: str, client: int, bundle: str,
+                            owners: Sequence[str],
+                            pending_verification: bool = False) -> Tuple[List['Device'], List[str]]:
+        """
+        Insert or update the devices for `owners` linked to `push_token`, and delete the devices (and their
+        pairings) of other owners linked to the same `push_token`. Everything is done in one query
+        :param pending_verification: `True` if `push_token` was not verified on Firebase yet
+        :return: One device per owner, in the same order than `owners`, and the addresses whose paired devices
+        changed: the ones authorized by the updated or deleted devices, the ones authorizing the deleted devices and
+        the deleted devices themselves
+        """
+        unique_owners = list(dict.fromkeys(owners))
+        # Every column must be returned, so `Device` instances are not built with deferred fields
+        columns = [field.column for field in self.model._meta.concrete_fields]
+        values = {
+            'created': '%(now)s',
+            'modified': '%(now)s',
+            'owner': 'owner',
+            'push_token': '%(push_token)s',
+            'push_token_hash': '%(push_token_hash)s',
+            'build_number': '%(build_number)s',
+            'version_name': '%(version_name)s',
+            'client': '%(client)s',
+            'bundle': '%(bundle)s',
+            'pending_verification': '%(pending_verification)s',
+            'verification_attempts': '0',
+        }
+        query = """
+        WITH stale_devices AS (
+            SELECT owner FROM {device_table}
+            WHERE push_token_hash = %(push_token_hash)s AND push_token = %(push_token)s
+            AND NOT (owner = ANY(%(owners)s))
+        ), affected_addresses AS (
+            SELECT authorized_device_id AS address FROM {device_pair_table}
+            WHERE authorizing_device_id IN (SELECT owner FROM stale_devices)
+            OR authorizing_device_id = ANY(%(owners)s)
+            UNION
+            SELECT authorizing_device_id FROM {device_pair_table}
+            WHERE authorized_device_id IN (SELECT owner FROM stale_devices)
+            UNION
+            SELECT owner FROM stale_devices
+        ), deleted_device_pairs AS (
+            DELETE FROM {device_pair_table}
+            WHERE authorizing_device_id IN (SELECT owner FROM stale_devices)
+            OR authorized_device_id IN (SELECT owner FROM stale_devices)
+        ), deleted_devices AS (
+            DELETE FROM {device_table} WHERE owner IN (SELECT owner FROM stale_devices)
+        ), upserted_devices AS (
+            INSERT INTO {device_table} ({columns})
+            SELECT {values}
+            FROM unnest(%(owners)s::varchar[]) AS owner
+            ON CONFLICT (owner) DO UPDATE SET
+                modified = EXCLUDED.modified,
+                push_token = EXCLUDED.push_token,
+                push_token_hash = EXCLUDED.push_token_hash,
+                build_number = EXCLUDED.build_number,
+                version_name = EXCLUDED.version_name,
+                client = EXCLUDED.client,
+                bundle = EXCLUDED.bundle,
+                pending_verification = EXCLUDED.pending_verification,
+                verification_attempts = EXCLUDED.verification_attempts
+            RETURNING {columns}
+        )
+        SELECT {columns}, ARRAY(SELECT address FROM affected_addresses)
+        FROM upserted_devices
+        """.format(device_table=self.model._meta.db_table,
+                   device_pair_table=DevicePair._meta.db_table,
+                   columns=', '.join(columns),
+                   values=', '.join(values[column] for column in columns))
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, {
+                'now': timezone.now(),
+                'owners': unique_owners,
+                'push_token': push_token,
+                'push_token_hash': get_push_token_hash(push_token),
+                'build_number': build_number,
+                'version_name': version_name,
+                'client': client,
+                'bundle': bundle,
+                'pending_verification': pending_verification,
+            })
+            rows = cursor.fetchall()
+        # Last column is the same for every row, the addresses whose paired devices changed
+        devices = [self.model.from_db(self.db, columns, row[:-1]) for row in rows]
+        devices_by_owner = {device.owner: device for device in devices}
+        return [devices_by_owner[owner] for owner in owners], rows[0][-1]
+
 
 class Device(TimeStampedModel):
     objects = DeviceManager()
     owner = EthereumAddressField(primary_key=True)
     push_token = models.TextField(null=True, blank=True)
+    # Kept updated on `save`. Use it for lookups by `push_token`
+    push_token_hash = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True)
     build_number = models.PositiveIntegerField(default=0)  # e.g. 1644
     version_name = models.CharField(max_length=100, default='')  # e.g 1.0.0
     client = models.PositiveSmallIntegerField(null=True, default=None,
                                               choices=[(tag.value, tag.name) for tag in DeviceTypeEnum])
     bundle = models.CharField(max_length=100, default='')
+    # `push_token` was registered without verifying it on Firebase, it will be verified by a task
+    pending_verification = models.BooleanField(default=False, db_index=True)
+    # Times `push_token` could not be verified on Firebase, it's removed after too many attempts
+    verification_attempts = models.PositiveSmallIntegerField(default=0)
 
     class Meta:
         verbose_name = 'Device'
@@ -39,6 +184,13 @@ class Device(TimeStampedModel):
         token = self.push_token[:10] if self.push_token else 'No Token'
         return '{} - {}...'.format(self.owner, token)
 
+    def save(self, *args, **kwargs):
+        self.push_token_hash = get_push_token_hash(self.push_token)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'push_token' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'push_token_hash'}
+        super().save(*args, **kwargs)
+
     def get_device_type(self):
         if self.client is None:
             return None
@@ -46,7 +198,64 @@ class Device(TimeStampedModel):
             return DeviceTypeEnum(self.client)
 
 
+class DevicePairManager(models.Manager):
+    def create_pairing(self, authorizing_owner: str, authorized_owner: str) -> 'DevicePair':
+        """
+        Create the devices if they don't exist (without `push_token`) and pair them in both directions. Everything
+        is done in one query
+        :return: `DevicePair` where `authorizing_owner` authorizes `authorized_owner`
+        """
+        now = timezone.now()
+        device_fields = Device._meta.concrete_fields
+        device_defaults = {field.column: field.get_default() for field in device_fields}
+        device_defaults.update(created=now, modified=now, push_token=None, push_token_hash=None)
+        columns = [field.column for field in self.model._meta.concrete_fields]
+        query = """
+        WITH inserted_devices AS (
+            INSERT INTO {device_table} ({device_columns})
+            SELECT {device_values}
+            FROM unnest(%(owners)s::varchar[]) AS owner
+            ON CONFLICT (owner) DO NOTHING
+        )
+        INSERT INTO {device_pair_table} (created, modified, authorizing_device_id, authorized_device_id)
+        VALUES (%(now)s, %(now)s, %(authorizing_owner)s, %(authorized_owner)s),
+               (%(now)s, %(now)s, %(authorized_owner)s, %(authorizing_owner)s)
+        ON CONFLICT (authorizing_device_id, authorized_device_id) DO UPDATE SET modified = EXCLUDED.modified
+        RETURNING {columns}
+        """.format(device_table=Device._meta.db_table,
+                   device_pair_table=self.model._meta.db_table,
+                   device_columns=', '.join(field.column for field in device_fields),
+                   device_values=', '.join('owner' if field.column == 'owner' else '%({})s'.format(field.column)
+                                           for field in device_fields),
+                   columns=', '.join(columns))
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, {
+                **device_defaults,
+                'now': now,
+                'owners': [authorizing_owner, authorized_owner],
+                'authorizing_owner': authorizing_owner,
+                'authorized_owner': authorized_owner,
+            })
+            rows = cursor.fetchall()
+        device_pairs = [self.model.from_db(self.db, columns, row) for row in rows]
+        return next(device_pair for device_pair in device_pairs
+                    if device_pair.authorizing_device_id == authorizing_owner)
+
+    def delete_pairing(self, owner: str, another_owner: str) -> int:
+        """
+        Delete the pairing between 2 devices in both directions using one query
+        :return: Number of `DevicePair` deleted
+        """
+        deleted, _ = self.filter(
+            models.Q(authorizing_device_id=owner, authorized_device_id=another_owner)
+            | models.Q(authorizing_device_id=another_owner, authorized_device_id=owner)
+        ).delete()
+        return deleted
+
+
 class DevicePair(TimeStampedModel):
+    objects = DevicePairManager()
     authorizing_device = models.ForeignKey(
         Device,
         related_name='authorizing_devices',
@@ -67,6 +276,34 @@ class DevicePair(TimeStampedModel):
         return '{} authorizes {}'.format(self.authorizing_device.owner, self.authorized_device.owner)
 
 
+class NotificationTypeRule(NamedTuple):
+    """
+    Immutable snapshot of a `NotificationType`, safe to be cached
+    """
+    name: str
+    min_build_numbers: Dict[int, Optional[int]]  # `Device.client` -> min `build_number` (`None` if disabled)
+    priority: int = NotificationPriorityEnum.NORMAL.value
+    ttl: Optional[int] = None
+    collapse_key: str = ''
+
+    def get_collapse_key(self, message: Dict[str, any]) -> Optional[str]:
+        """
+        :param message:
+        :return: `collapse_key` formatted with the fields of the `message` (missing ones are empty), `None` if not
+            configured
+        """
+        if not self.collapse_key:
+            return None
+        try:
+            return self.collapse_key.format_map(defaultdict(str, message))
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):  # Not a valid template
+            return self.collapse_key
+
+    def matches_device(self, device: Device) -> bool:
+        min_build_number = self.min_build_numbers.get(device.client)
+        return (min_build_number is not None) and (device.build_number >= min_build_number)
+
+
 class NotificationType(models.Model):
     name = models.CharField(max_length=50)
     description = models.TextField(blank=True)
@@ -74,15 +311,66 @@ class NotificationType(models.Model):
     ios = models.PositiveIntegerField(default=None, null=True, blank=True)
     android = models.PositiveIntegerField(default=None, null=True, blank=True)
     extension = models.PositiveIntegerField(default=None, null=True, blank=True)
+    # Notification tasks are routed to a Celery queue per priority if `NOTIFICATION_PRIORITY_QUEUES` is enabled
+    priority = models.PositiveSmallIntegerField(default=NotificationPriorityEnum.NORMAL.value,
+                                                choices=[(tag.value, tag.name) for tag in NotificationPriorityEnum])
+    # Seconds after being enqueued when the notification is not worth delivering. `None` never expires
+    ttl = models.PositiveIntegerField(default=None, null=True, blank=True)
+    # Notifications with the same collapse key replace the previous ones not delivered yet. Fields of the message
+    # can be used, e.g. `{type}:{safe}`. Empty disables collapsing
+    collapse_key = models.CharField(max_length=100, blank=True)
+
+    def get_rule(self) -> NotificationTypeRule:
+        return NotificationTypeRule(
+            name=self.name,
+            min_build_numbers={
+                DeviceTypeEnum.ANDROID.value: self.android,
+                DeviceTypeEnum.EXTENSION.value: self.extension,
+                DeviceTypeEnum.IOS.value: self.ios,
+            },
+            priority=self.priority,
+            ttl=self.ttl,
+            collapse_key=self.collapse_key,
+        )
 
     def matches_device(self, device: Device) -> bool:
-        device_type = device.get_device_type()
-        if device_type == DeviceTypeEnum.ANDROID:
-            build_number = self.android
-        elif device_type == DeviceTypeEnum.EXTENSION:
-            build_number = self.extension
-        elif device_type == DeviceTypeEnum.IOS:
-            build_number = self.ios
-        else:
-            return False
-        return (build_number is not None) and (device.build_number >= build_number)
+        return self.get_rule().matches_device(device)
+
+
+class NotificationOutboxManager(models.Manager):
+    def add_tasks(self, tasks: Sequence[Tuple[str, Sequence[any], Dict[str, any], Dict[str, any]]]):
+        """
+        Store tasks to be published by the relay, using one query
+        :param tasks: List of `(task_name, args, kwargs, options)`
+        """
+        self.bulk_create([self.model(task_name=task_name, args=list(args), kwargs=kwargs, options=options)
+                          for task_name, args, kwargs, options in tasks])
+
+    def lock_batch(self, batch_size: int) -> List['NotificationOutbox']:
+        """
+        Lock the oldest tasks, skipping the ones locked by other relays. Must be called inside a transaction
+        :param batch_size:
+        :return: Locked tasks, oldest first
+        """
+        return list(self.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+
+
+class NotificationOutbox(models.Model):
+    """
+    Tasks waiting to be published to the broker. They are stored on the same transaction as the request, so they are
+    only published if the transaction is committed and the request doesn't wait for the broker
+    """
+    objects = NotificationOutboxManager()
+    id = models.BigAutoField(primary_key=True)
+    created = models.DateTimeField(auto_now_add=True)
+    task_name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    kwargs = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    options = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+
+    class Meta:
+        verbose_name = 'Notification Outbox'
+        verbose_name_plural = 'Notification Outbox'
+
+    def __str__(self):
+        return '{} - {}'.format(self.id, self.task_name)
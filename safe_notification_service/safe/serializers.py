@@ -13,15 +13,18 @@ from rest_framework.exceptions import ValidationError
 from gnosis.eth.django.serializers import (EthereumAddressField,
                                            SignatureSerializer)
 
-from safe_notification_service.ether.signing import EthereumSignedMessage
-from safe_notification_service.firebase.client import FirebaseProvider
+from safe_notification_service.ether.signing import (
+    EthereumMultipleSignedMessage, EthereumSignedMessage)
 from safe_notification_service.safe.models import (Device, DevicePair,
                                                    DeviceTypeEnum)
+from safe_notification_service.utils.process_pool import \
+    VerificationProcessPoolProvider
 
 from .helpers import validate_google_billing_purchase
+from .services.auth_service import AuthServiceProvider
+from .services.pairing_cache import PairingCacheProvider
 
 logger = logging.getLogger(__name__)
-firebase_client = FirebaseProvider()
 
 
 def isoformat_without_ms(date_time):
@@ -69,14 +72,12 @@ class MultipleSignedMessageSerializer(serializers.Serializer):
         super().validate(data)
         message = ''.join(self.get_hashed_fields(data))
         data['message'] = message
-        data['signing_addresses'] = []
-        for signature in data['signatures']:
-            v = signature['v']
-            r = signature['r']
-            s = signature['s']
-            ethereum_signed_message = EthereumSignedMessage(message, v, r, s)
-            data['message_hash'] = ethereum_signed_message.message_hash
-            data['signing_addresses'].append(ethereum_signed_message.get_signing_address())
+        ethereum_multiple_signed_message = EthereumMultipleSignedMessage(
+            message, [(signature['v'], signature['r'], signature['s']) for signature in data['signatures']]
+        )
+        if data['signatures']:
+            data['message_hash'] = ethereum_multiple_signed_message.message_hash
+        data['signing_addresses'] = ethereum_multiple_signed_message.get_signing_addresses()
 
         return data
 
@@ -103,7 +104,7 @@ class AuthSerializer(SignedMessageSerializer):
         #     Device.objects.get(push_token=value)
         #     raise ValidationError('Push token %s already in use' % value)
         # except Device.DoesNotExist:
-        if firebase_client.verify_token(value):
+        if AuthServiceProvider().verify_push_token(value):
             return value
         else:
             raise ValidationError('Push token %s not valid for this project' % value)
@@ -114,7 +115,9 @@ class AuthSerializer(SignedMessageSerializer):
         try:
             device = Device.objects.get(owner=owner)
             device.push_token = push_token
+            device.pending_verification = False
             device.save()
+            PairingCacheProvider().invalidate_devices([owner])
         except Device.DoesNotExist:
             device = Device.objects.create(
                 owner=owner,
@@ -190,20 +193,10 @@ class PairingSerializer(SignedMessageSerializer):
         another_device_address = validated_data['temporary_authorization']['signing_address']
         owner = validated_data['signing_address']
 
-        another_device = Device.objects.get_or_create_without_push_token(another_device_address)
-        owner_device = Device.objects.get_or_create_without_push_token(owner)
-
-        # Do pairing
-        device_pair, _ = DevicePair.objects.update_or_create(
-            authorizing_device=owner_device,
-            authorized_device=another_device,
-        )
-
-        _, _ = DevicePair.objects.update_or_create(
-            authorizing_device=another_device,
-            authorized_device=owner_device,
-        )
+        # Create devices if they don't exist and pair them in both directions
+        device_pair = DevicePair.objects.create_pairing(owner, another_device_address)
 
+        PairingCacheProvider().invalidate([owner, another_device_address])
         return device_pair
 
 
@@ -279,7 +272,8 @@ class GoogleInAppPurchaseSerializer(serializers.Serializer):
         if not google_billing_public_key_base64:
             raise ValidationError('GOOGLE_BILLING_PUBLIC_KEY_BASE64 environment variable not found')
 
-        if not validate_google_billing_purchase(google_billing_public_key_base64, signed_data_str, signature):
+        if not VerificationProcessPoolProvider().run(validate_google_billing_purchase,
+                                                     google_billing_public_key_base64, signed_data_str, signature):
             raise ValidationError('Cannot validate google signed data')
 
         data['order_id'] = signed_data['orderId']
@@ -1,4 +1,11 @@
 # flake8: noqa F401
 from .auth_service import AuthService, AuthServiceProvider
+from .notification_coalescer import (NotificationCoalescer,
+                                     NotificationCoalescerProvider)
 from .notification_service import (NotificationService,
                                    NotificationServiceProvider)
+from .notification_type_cache import (NotificationTypeCache,
+                                      NotificationTypeCacheProvider)
+from .pairing_cache import PairingCache, PairingCacheProvider
+from .push_token_reaper import PushTokenReaper, PushTokenReaperProvider
+from .rate_limiter import RateLimiter, RateLimiterProvider
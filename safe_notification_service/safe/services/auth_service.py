@@ -1,10 +1,20 @@
+import hashlib
 from logging import getLogger
-from typing import List
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Min
+
+from redis import Redis
+from redis.exceptions import RedisError
 
 from safe_notification_service.firebase.client import (FirebaseProvider,
                                                        MessagingClient)
+from safe_notification_service.utils.redis import get_redis
 
 from ..models import Device, DeviceTypeEnum
+from .pairing_cache import PairingCacheProvider
 
 logger = getLogger(__name__)
 
@@ -20,7 +30,9 @@ class InvalidPushToken(AuthServiceException):
 class AuthServiceProvider:
     def __new__(cls):
         if not hasattr(cls, 'instance'):
-            cls.instance = AuthService(FirebaseProvider())
+            cls.instance = AuthService(FirebaseProvider(), get_redis(),
+                                       settings.PUSH_TOKEN_VERIFICATION_CACHE_TIMEOUT_SECONDS,
+                                       settings.PUSH_TOKEN_VERIFICATION_NEGATIVE_CACHE_TIMEOUT_SECONDS)
         return cls.instance
 
     @classmethod
@@ -30,40 +42,179 @@ class AuthServiceProvider:
 
 
 class AuthService:
-    def __init__(self, messaging_client: MessagingClient):
+    PUSH_TOKEN_VERIFICATION_KEY_PREFIX = 'push-token-verification:'
+    PUSH_TOKEN_VERIFICATION_SCHEDULED_KEY = 'push-token-verification:scheduled'
+
+    def __init__(self, messaging_client: MessagingClient, redis: Redis, verification_cache_timeout: int = 0,
+                 verification_negative_cache_timeout: int = 0):
+        """
+        :param messaging_client:
+        :param redis:
+        :param verification_cache_timeout: Seconds to cache push tokens verified as valid. `0` disables the cache
+        :param verification_negative_cache_timeout: Seconds to cache push tokens verified as not valid, it should be
+        short as tokens can be registered on Firebase later. `0` disables the cache
+        """
         self.messaging_client = messaging_client
+        self.redis = redis
+        self.verification_cache_timeout = verification_cache_timeout
+        self.verification_negative_cache_timeout = verification_negative_cache_timeout
+
+    def _get_push_token_verification_key(self, push_token: str) -> str:
+        return self.PUSH_TOKEN_VERIFICATION_KEY_PREFIX + hashlib.sha256(push_token.encode()).hexdigest()
 
-    def verify_push_token(self, push_token: str):
+    def get_cached_push_token_verification(self, push_token: str) -> Optional[bool]:
         """
-        Checks if push token is valid
+        :param push_token: Firebase push token
+        :return: `True` if push token was verified as valid, `False` if not valid, `None` if not verified recently
+            or Redis is not available
+        """
+        try:
+            cached = self.redis.get(self._get_push_token_verification_key(push_token))
+        except RedisError:
+            logger.warning('Cannot get cached verification for push-token=%s', push_token, exc_info=True)
+            return None
+        return None if cached is None else cached == b'1'
+
+    def _cache_push_token_verifications(self, verifications: Dict[str, bool]):
+        try:
+            with self.redis.pipeline() as pipe:
+                for push_token, is_valid in verifications.items():
+                    timeout = (self.verification_cache_timeout if is_valid
+                               else self.verification_negative_cache_timeout)
+                    if timeout:
+                        pipe.set(self._get_push_token_verification_key(push_token), int(is_valid), ex=timeout)
+                pipe.execute()
+        except RedisError:
+            # Cache is only an optimization, verifications are already done
+            logger.warning('Cannot cache verification of %d push tokens', len(verifications), exc_info=True)
+
+    def verify_push_token(self, push_token: str) -> bool:
+        """
+        Checks if push token is valid. Results are cached on Redis, so they are shared by every worker
         :param push_token: Firebase push token
         :return: `True` if valid, `False` otherwise
         """
-        return self.messaging_client.verify_token(push_token)
+        is_valid = self.get_cached_push_token_verification(push_token)
+        if is_valid is None:
+            is_valid = self.messaging_client.verify_token(push_token)
+            self._cache_push_token_verifications({push_token: is_valid})
+        return is_valid
+
+    def clear_push_token_verifications(self, push_tokens: Sequence[str]):
+        """
+        Remove cached verifications, for example when Firebase reports the push tokens are not valid anymore. If
+        Redis is not available they are kept, but they expire after the verification cache timeout
+        :param push_tokens: Firebase push tokens
+        """
+        if push_tokens:
+            try:
+                self.redis.delete(*[self._get_push_token_verification_key(push_token) for push_token in push_tokens])
+            except RedisError:
+                logger.warning('Cannot clear cached verification of %d push tokens', len(push_tokens), exc_info=True)
+
+    def schedule_push_token_verification(self):
+        """
+        Schedule a task to verify push tokens pending verification. Only one task is scheduled every
+        `PUSH_TOKEN_VERIFICATION_DELAY_SECONDS`, so push tokens registered meanwhile are verified in the same batch.
+        If Redis is not available, task is always scheduled
+        """
+        from ..tasks import verify_pending_push_tokens_task
+
+        delay = settings.PUSH_TOKEN_VERIFICATION_DELAY_SECONDS
+        try:
+            schedule = self.redis.set(self.PUSH_TOKEN_VERIFICATION_SCHEDULED_KEY, 1, nx=True, ex=max(delay, 1))
+        except RedisError:
+            logger.warning('Cannot check if push token verification is scheduled, scheduling it', exc_info=True)
+            schedule = True
+        if schedule:
+            # Wait for the devices to be committed
+            transaction.on_commit(lambda: verify_pending_push_tokens_task.apply_async(countdown=delay))
+
+    def verify_pending_push_tokens(self, batch_size: int) -> int:
+        """
+        Verify on Firebase a batch of the push tokens pending verification, the ones with less verification attempts
+        and pending for longer first. Devices with valid push tokens are marked as verified, and push tokens not
+        valid are removed. Push tokens that could not be verified are kept pending and verification is scheduled
+        again, unless they could not be verified after `PUSH_TOKEN_VERIFICATION_MAX_ATTEMPTS`, then they are removed
+        :param batch_size: Max number of push tokens to verify
+        :return: Number of push tokens verified
+        """
+        push_tokens = [push_token for push_token, _, _ in Device.objects.filter_pending_verification().values(
+            'push_token'
+        ).annotate(
+            attempts=Min('verification_attempts'), pending_since=Min('modified')
+        ).order_by('attempts', 'pending_since').values_list('push_token', 'attempts', 'pending_since')[:batch_size]]
+        if not push_tokens:
+            return 0
+
+        verifications = {push_token: is_valid
+                         for push_token, is_valid in zip(push_tokens, self.messaging_client.verify_tokens(push_tokens))
+                         if is_valid is not None}
+        self._cache_push_token_verifications(verifications)
+        valid_push_tokens = [push_token for push_token, is_valid in verifications.items() if is_valid]
+        not_valid_push_tokens = [push_token for push_token, is_valid in verifications.items() if not is_valid]
+        not_verified_push_tokens = [push_token for push_token in push_tokens if push_token not in verifications]
+
+        with transaction.atomic():
+            owners = list(Device.objects.filter_by_push_tokens(list(verifications)).values_list('owner', flat=True))
+            Device.objects.filter_by_push_tokens(valid_push_tokens).update(pending_verification=False,
+                                                                           verification_attempts=0)
+            Device.objects.filter_by_push_tokens(not_valid_push_tokens).remove_push_tokens()
+        # Invalidated after the changes are written, so other processes cannot fill the cache with old data
+        PairingCacheProvider().invalidate_devices(owners)
+        logger.info('Verified %d pending push tokens, %d were not valid', len(verifications),
+                    len(not_valid_push_tokens))
+        if not_verified_push_tokens:
+            logger.warning('%d pending push tokens could not be verified', len(not_verified_push_tokens))
+            self._add_failed_verification_attempt(not_verified_push_tokens)
+            self.schedule_push_token_verification()
+        return len(verifications)
+
+    def _add_failed_verification_attempt(self, push_tokens: Sequence[str]):
+        """
+        Count a failed verification attempt for `push_tokens`, and remove the push tokens that could not be
+        verified after `PUSH_TOKEN_VERIFICATION_MAX_ATTEMPTS`, so they are not retried and notified forever
+        :param push_tokens: Firebase push tokens pending verification
+        """
+        devices = Device.objects.filter_pending_verification().filter_by_push_tokens(push_tokens)
+        with transaction.atomic():
+            devices.update(verification_attempts=F('verification_attempts') + 1)
+            exhausted_devices = devices.filter(
+                verification_attempts__gte=settings.PUSH_TOKEN_VERIFICATION_MAX_ATTEMPTS
+            )
+            owners = list(exhausted_devices.values_list('owner', flat=True))
+            removed = exhausted_devices.remove_push_tokens()
+        PairingCacheProvider().invalidate_devices(owners)
+        if removed:
+            logger.warning('Removed push tokens of %d devices not verified after %d attempts', removed,
+                           settings.PUSH_TOKEN_VERIFICATION_MAX_ATTEMPTS)
 
     def create_auth(self, push_token: str, build_number: int, version_name: str, client: str, bundle: str,
                     owners: List[str]) -> List[Device]:
-
+        """
+        Register `push_token` for `owners`. If `PUSH_TOKEN_ASYNC_VERIFICATION` is enabled and `push_token` was not
+        verified recently, devices are registered as pending verification and `push_token` is verified later by a
+        task, so registration doesn't wait for Firebase
+        """
         assert owners, 'At least one owner must be provided'
 
-        if not self.verify_push_token(push_token):
+        if settings.PUSH_TOKEN_ASYNC_VERIFICATION:
+            is_valid = self.get_cached_push_token_verification(push_token)
+        else:
+            is_valid = self.verify_push_token(push_token)
+        if is_valid is False:
             raise InvalidPushToken(push_token)
+        pending_verification = is_valid is None
 
-        devices = []
         client = client.upper()
+        devices, paired_addresses = Device.objects.register_push_token(push_token, build_number, version_name,
+                                                                       DeviceTypeEnum[client].value, bundle, owners,
+                                                                       pending_verification=pending_verification)
+        PairingCacheProvider().invalidate(paired_addresses)
+        if pending_verification:
+            self.schedule_push_token_verification()
         for owner in owners:
-            device, _ = Device.objects.update_or_create(owner=owner, defaults={
-                'push_token': push_token,
-                'build_number': build_number,
-                'version_name': version_name,
-                'client': DeviceTypeEnum[client].value,
-                'bundle': bundle,
-            })
-            devices.append(device)
             logger.info('Owner=%s registered device with client=%s, bundle=%s, version_name=%s,'
-                        'build_number=%d and push_token=%s',
-                        owner, client, bundle, version_name, build_number, push_token)
-
-        # Delete existing owners linked to this push token
-        Device.objects.exclude(owner__in=owners).filter(push_token=push_token).delete()
+                        'build_number=%d, push_token=%s and pending_verification=%s',
+                        owner, client, bundle, version_name, build_number, push_token, pending_verification)
         return devices
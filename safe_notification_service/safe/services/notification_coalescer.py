@@ -0,0 +1,89 @@
+import uuid
+from logging import getLogger
+from typing import List, Optional, Sequence
+
+from django.conf import settings
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+logger = getLogger(__name__)
+
+
+class NotificationCoalescerProvider:
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = NotificationCoalescer(get_redis(), settings.NOTIFICATION_COALESCE_WINDOW_SECONDS)
+        return cls.instance
+
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            del cls.instance
+
+
+class NotificationCoalescer:
+    """
+    Coalesce notifications with the same collapse key sent to the same push token during a short window. Every
+    notification is delayed `window` seconds and marked on Redis as the newest one for every push token, so when a
+    newer one is enqueued during the window the older one is discarded instead of sent
+    """
+    KEY_PREFIX = 'notification-coalesce:'
+    # Keys must outlive the queued notifications, if a key expires the notification is sent anyway
+    KEY_TIMEOUT = 60 * 60
+
+    def __init__(self, redis: Redis, window: float):
+        """
+        :param redis:
+        :param window: Seconds notifications are delayed waiting for newer ones. `0` disables coalescing
+        """
+        self.redis = redis
+        self.window = window
+
+    def _get_key(self, collapse_key: str, push_token: str) -> str:
+        return f'{self.KEY_PREFIX}{collapse_key}:{push_token}'
+
+    def coalesce(self, collapse_key: str, push_tokens: Sequence[str]) -> Optional[str]:
+        """
+        Mark a new notification as the newest one for `push_tokens`, replacing the ones still queued
+        :param collapse_key:
+        :param push_tokens:
+        :return: Coalesce id of the notification, required to check if it's still the newest one when sent. `None`
+            if Redis is not available, so notification must be sent without coalescing
+        """
+        coalesce_id = uuid.uuid4().hex
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for push_token in push_tokens:
+                pipe.set(self._get_key(collapse_key, push_token), coalesce_id, ex=self.KEY_TIMEOUT)
+            pipe.execute()
+        except RedisError:
+            logger.warning('Cannot coalesce notification with collapse-key=%s, sending it without coalescing',
+                           collapse_key, exc_info=True)
+            return None
+        return coalesce_id
+
+    def get_newest_push_tokens(self, collapse_key: str, push_tokens: List[str], coalesce_id: str) -> List[str]:
+        """
+        :param collapse_key:
+        :param push_tokens:
+        :param coalesce_id: Returned by `coalesce` when the notification was enqueued
+        :return: Push tokens for which the notification was not replaced by a newer one. If Redis is not available
+            every push token is returned, so notification is sent anyway
+        """
+        if not push_tokens:
+            return []
+        try:
+            current_ids = self.redis.mget([self._get_key(collapse_key, push_token) for push_token in push_tokens])
+        except RedisError:
+            logger.warning('Cannot check newer notifications with collapse-key=%s, sending it', collapse_key,
+                           exc_info=True)
+            return push_tokens
+        newest_push_tokens = [push_token for push_token, current_id in zip(push_tokens, current_ids)
+                              if current_id is None or current_id.decode() == coalesce_id]
+        if len(newest_push_tokens) != len(push_tokens):
+            logger.info('Discarding notification with collapse-key=%s for %d push tokens, replaced by a newer one',
+                        collapse_key, len(push_tokens) - len(newest_push_tokens))
+        return newest_push_tokens
@@ -1,14 +1,19 @@
+from email.utils import parsedate_to_datetime
 from logging import getLogger
-from typing import Dict, List, Optional
+from typing import Dict, List, NamedTuple, Optional
 
-from django.db.models import Q
+from django.conf import settings
+from django.utils import timezone
 
+from firebase_admin import exceptions
 from firebase_admin.messaging import UnregisteredError
 
 from safe_notification_service.firebase.client import (FirebaseProvider,
                                                        MessagingClient)
 
-from ..models import Device, DevicePair, DeviceTypeEnum, NotificationType
+from ..models import Device, DeviceTypeEnum, NotificationTypeRule
+from .notification_type_cache import NotificationTypeCacheProvider
+from .pairing_cache import PairingCacheProvider
 
 logger = getLogger(__name__)
 
@@ -25,6 +30,32 @@ class UnknownMessagingException(NotificationServiceException):
     pass
 
 
+class RetriableMessagingException(UnknownMessagingException):
+    """
+    Temporary error (quota exceeded, service unavailable...), sending can be retried later
+    """
+    def __init__(self, *args, retry_after: Optional[float] = None):
+        """
+        :param retry_after: Seconds to wait before retrying if provided by Firebase (`Retry-After` header)
+        """
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+class PermanentMessagingException(UnknownMessagingException):
+    """
+    Error that will happen again if retried (invalid message, authentication error...)
+    """
+    pass
+
+
+class MulticastResult(NamedTuple):
+    message_ids: Dict[str, str]  # Push token -> Firebase `MessageId`
+    invalid_push_tokens: List[str]
+    failed_push_tokens: List[str]  # Only push tokens that can be retried
+    retry_after: Optional[float]  # Max `Retry-After` returned for `failed_push_tokens`
+
+
 class NotificationServiceProvider:
     def __new__(cls):
         if not hasattr(cls, 'instance'):
@@ -41,58 +72,130 @@ class NotificationService:
     def __init__(self, messaging_client: MessagingClient):
         self.messaging_client = messaging_client
 
-    def _filter_devices_by_message_type(self, message: Dict[str, any],
-                                        devices: List[Device]) -> List[Device]:
+    def _filter_devices_by_rule(self, notification_type_rule: Optional[NotificationTypeRule],
+                                devices: List[Device]) -> List[Device]:
         """
         Filter notifications based on `NotificationType` and `Device` client. If notification is not configured
         (no `NotificationType` found) notification will be enabled for every client. Otherwise, configuration per
         client is followed
-        :param message:
+        :param notification_type_rule:
         :param devices:
         :return: Filtered list of devices, empty list if no device passed the filtering
         """
         if not devices:
             return []
+        if not notification_type_rule:
+            return devices
+        return [device for device in devices
+                if notification_type_rule.matches_device(device)]
 
+    def get_notification_type_rule(self, message: Dict[str, any]) -> Optional[NotificationTypeRule]:
+        """
+        :param message:
+        :return: `NotificationTypeRule` for the `type` of the message, `None` if not configured. It should be
+            resolved once per notification and reused
+        """
         message_type = message.get('type')
-        if not message_type:
-            return devices
-        else:
-            try:
-                notification_type = NotificationType.objects.get(name=message_type)
-                return [device for device in devices
-                        if notification_type.matches_device(device)]
-            except NotificationType.DoesNotExist:
-                return devices
+        return NotificationTypeCacheProvider().get_rule(message_type) if message_type else None
 
     def get_enabled_devices(self,
                             message: Dict[str, any],
                             devices: List[str],
                             signer_address: Optional[str] = None) -> List[Device]:
         """
-        Get `devices` enabled for this kind of notification. It lets out `devices` without `push_token`
+        Get `devices` enabled for this kind of notification
         :param message:
         :param devices:
         :param signer_address: If not set, `DevicePairs` are not checked for sending notifications
         :return: Devices filtered
         """
+        return self.get_enabled_devices_by_rule(self.get_notification_type_rule(message), devices, signer_address)
+
+    def get_enabled_devices_by_rule(self,
+                                    notification_type_rule: Optional[NotificationTypeRule],
+                                    devices: List[str],
+                                    signer_address: Optional[str] = None) -> List[Device]:
+        """
+        Get `devices` enabled for the `notification_type_rule`. It lets out `devices` without `push_token`, and
+        devices pending push token verification if `PUSH_TOKEN_PENDING_VERIFICATION_NOTIFY` is disabled
+        :param notification_type_rule: Rule for the type of the notification, `None` if not configured
+        :param devices:
+        :param signer_address: If not set, `DevicePairs` are not checked for sending notifications
+        :return: Devices filtered
+        """
         if signer_address:
-            pairings = DevicePair.objects.filter(
-                (Q(authorizing_device__owner__in=devices) & Q(authorized_device__owner=signer_address))
-            ).select_related('authorizing_device')
-            db_devices = [pairing.authorizing_device for pairing in pairings if pairing.authorizing_device.push_token]
+            owners = set(devices)
+            db_devices = [device for device in PairingCacheProvider().get_paired_devices(signer_address)
+                          if device.owner in owners]
         else:
             db_devices = Device.objects.filter(owner__in=devices).exclude(push_token=None)
+        if not settings.PUSH_TOKEN_PENDING_VERIFICATION_NOTIFY:
+            db_devices = [device for device in db_devices if not device.pending_verification]
         logger.info('Found %d paired devices, sender: %s, devices: %s' % (len(db_devices), signer_address, devices))
-        filtered_devices = self._filter_devices_by_message_type(message, db_devices)
+        filtered_devices = self._filter_devices_by_rule(notification_type_rule, db_devices)
         logger.info('Remaining %d paired devices after filtering, sender: %s, devices: %s' % (len(filtered_devices),
                                                                                               signer_address,
                                                                                               filtered_devices))
         return filtered_devices
 
-    def send_notification(self, message: Dict[str, any], push_token: str) -> str:
+    def _get_retry_after(self, exc: Exception) -> Optional[float]:
+        """
+        :return: Seconds to wait from the `Retry-After` header of the Firebase response, if present
+        """
+        http_response = getattr(exc, 'http_response', None)
+        retry_after = http_response.headers.get('Retry-After') if http_response is not None else None
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0.)
+        except ValueError:
+            try:  # It can also be a HTTP date
+                return max((parsedate_to_datetime(retry_after) - timezone.now()).total_seconds(), 0.)
+            except (TypeError, ValueError):
+                return None
+
+    def _get_messaging_exception(self, exc: Exception) -> UnknownMessagingException:
+        """
+        Classify an error sending a message, so the caller knows if it's worth retrying
+        :param exc: Exception raised by the messaging client
+        :return: `RetriableMessagingException` or `PermanentMessagingException`
+        """
+        str_exc = str(exc)
+        if isinstance(exc, (exceptions.ResourceExhaustedError, exceptions.UnavailableError,
+                            exceptions.InternalError, exceptions.DeadlineExceededError,
+                            exceptions.AbortedError, exceptions.UnknownError, ConnectionError)):
+            return RetriableMessagingException(str_exc, retry_after=self._get_retry_after(exc))
+        else:
+            return PermanentMessagingException(str_exc)
+
+    def _get_platform_configs(self, client: Optional[int]) -> Dict[str, bool]:
+        """
+        :param client: `Device.client`
+        :return: `ios` and `android` arguments for the messaging client, so only the config for the platform of the
+            device is sent. If client is not known, both are sent
+        """
+        if client is None:
+            return {'ios': True, 'android': True}
+        if client == DeviceTypeEnum.EXTENSION.value:
+            # Browser extension receives Firebase messages on Chrome like an Android device does (no APNs), and
+            # Android config (priority, ttl and collapse key) is honored there. So it gets only the Android config
+            return {'ios': False, 'android': True}
+        is_ios = client == DeviceTypeEnum.IOS.value
+        return {'ios': is_ios, 'android': not is_ios}
+
+    def send_notification(self, message: Dict[str, any], push_token: str, ttl: Optional[float] = None,
+                          collapse_key: Optional[str] = None, client: Optional[int] = None) -> str:
+        """
+        :param message:
+        :param push_token:
+        :param ttl: Seconds the notification is kept by FCM/APNs if device is not reachable
+        :param collapse_key: Notifications with the same collapse key replace the previous ones not delivered yet
+        :param client: `Device.client` of the push token, `None` if not known
+        :raises: InvalidPushToken, RetriableMessagingException, PermanentMessagingException
+        """
         try:
-            return self.messaging_client.send_message(message, push_token)
+            return self.messaging_client.send_message(message, push_token, ttl=ttl, collapse_key=collapse_key,
+                                                      **self._get_platform_configs(client))
         except UnregisteredError as exc:
             # Push token not valid
             str_exc = str(exc)
@@ -100,6 +203,53 @@ class NotificationService:
                            message, push_token, str_exc, exc_info=True)
             raise InvalidPushToken(str_exc) from exc
         except Exception as exc:
-            str_exc = str(exc)
-            logger.error('Message=%s push-token=%s exception=%s', message, push_token, str_exc, exc_info=True)
-            raise UnknownMessagingException(str_exc) from exc
+            messaging_exception = self._get_messaging_exception(exc)
+            logger.error('Message=%s push-token=%s exception=%s', message, push_token, exc,
+                         exc_info=isinstance(messaging_exception, PermanentMessagingException))
+            raise messaging_exception from exc
+
+    def send_multicast_notification(self, message: Dict[str, any], push_tokens: List[str],
+                                    ttl: Optional[float] = None, collapse_key: Optional[str] = None,
+                                    client: Optional[int] = None) -> MulticastResult:
+        """
+        Send the same notification to multiple push tokens. Firebase HTTP v1 API has no batch endpoint, so one
+        request is sent per push token, concurrently
+        :param message:
+        :param push_tokens:
+        :param ttl: Seconds the notification is kept by FCM/APNs if devices are not reachable
+        :param collapse_key: Notifications with the same collapse key replace the previous ones not delivered yet
+        :param client: `Device.client` of every push token, `None` if not known
+        :return: `MulticastResult` with the results mapped to every push token. Push tokens failing with a
+        permanent error are not included in `failed_push_tokens`, as retrying them is useless
+        :raises: RetriableMessagingException, PermanentMessagingException
+        """
+        try:
+            batch_response = self.messaging_client.send_multicast_message(message, push_tokens, ttl=ttl,
+                                                                          collapse_key=collapse_key,
+                                                                          **self._get_platform_configs(client))
+        except Exception as exc:
+            messaging_exception = self._get_messaging_exception(exc)
+            logger.error('Message=%s push-tokens=%s exception=%s', message, push_tokens, exc,
+                         exc_info=isinstance(messaging_exception, PermanentMessagingException))
+            raise messaging_exception from exc
+
+        message_ids = {}
+        invalid_push_tokens = []
+        failed_push_tokens = []
+        retry_after = None
+        for push_token, send_response in zip(push_tokens, batch_response.responses):
+            if send_response.success:
+                message_ids[push_token] = send_response.message_id
+            elif isinstance(send_response.exception, UnregisteredError):
+                logger.warning('Push token not valid. Message=%s push-token=%s exception=%s',
+                               message, push_token, send_response.exception)
+                invalid_push_tokens.append(push_token)
+            else:
+                logger.error('Message=%s push-token=%s exception=%s',
+                             message, push_token, send_response.exception)
+                messaging_exception = self._get_messaging_exception(send_response.exception)
+                if isinstance(messaging_exception, RetriableMessagingException):
+                    failed_push_tokens.append(push_token)
+                    if messaging_exception.retry_after is not None:
+                        retry_after = max(retry_after or 0., messaging_exception.retry_after)
+        return MulticastResult(message_ids, invalid_push_tokens, failed_push_tokens, retry_after)
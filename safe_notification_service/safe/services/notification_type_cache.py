@@ -0,0 +1,100 @@
+import threading
+import time
+from logging import getLogger
+from typing import Dict, Optional
+
+from django.conf import settings
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..models import NotificationType, NotificationTypeRule
+
+logger = getLogger(__name__)
+
+
+class NotificationTypeCacheProvider:
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = NotificationTypeCache(get_redis(),
+                                                 settings.NOTIFICATION_TYPES_CACHE_LOCAL_TIMEOUT_SECONDS)
+        return cls.instance
+
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            del cls.instance
+
+
+class NotificationTypeCache:
+    """
+    Per process cache of the `NotificationType` rules. Every `NotificationType` change increments a version stored on
+    Redis, so every process knows when its cache must be reloaded with just one cheap Redis `GET`. Cache is reloaded
+    after `timeout` anyway, so a lost invalidation only keeps old rules for a short time
+    """
+    VERSION_KEY = 'notification-types:version'
+
+    def __init__(self, redis: Redis, timeout: int = 10):
+        """
+        :param redis:
+        :param timeout: Max seconds to keep the rules on the process, even if version on Redis doesn't change
+        """
+        self.redis = redis
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._expiration = 0.
+        self._rules: Dict[str, NotificationTypeRule] = {}
+
+    def get_version(self) -> int:
+        return int(self.redis.get(self.VERSION_KEY) or 0)
+
+    def invalidate(self):
+        """
+        Invalidate the cache for every process. Invalidation is best effort: if Redis is not available, only the
+        cache of this process is invalidated, as the other processes will load the rules from the database while
+        Redis cannot be read
+        """
+        with self._lock:
+            self._version = None
+            self._rules = {}
+        try:
+            self.redis.incr(self.VERSION_KEY)
+        except RedisError:
+            logger.warning('Cannot invalidate notification types cache for every process', exc_info=True)
+
+    def _get_rules_from_database(self) -> Dict[str, NotificationTypeRule]:
+        return {notification_type.name: notification_type.get_rule()
+                for notification_type in NotificationType.objects.all()}
+
+    def get_rules(self) -> Dict[str, NotificationTypeRule]:
+        """
+        :return: Dictionary of `NotificationType` name -> `NotificationTypeRule`. If Redis is not available, so
+            it's not possible to know if the cache is valid, rules are loaded from the database
+        """
+        if not settings.NOTIFICATION_TYPES_CACHE:
+            return self._get_rules_from_database()
+
+        try:
+            version = self.get_version()
+        except RedisError:
+            logger.warning('Cannot get notification types version, loading them from database', exc_info=True)
+            return self._get_rules_from_database()
+
+        if version != self._version or self._expiration <= time.monotonic():
+            with self._lock:
+                if version != self._version or self._expiration <= time.monotonic():
+                    logger.debug('Loading notification types with version=%d', version)
+                    self._rules = self._get_rules_from_database()
+                    self._version = version
+                    self._expiration = time.monotonic() + self.timeout
+        return self._rules
+
+    def get_rule(self, name: str) -> Optional[NotificationTypeRule]:
+        """
+        :param name: `NotificationType` name
+        :return: `NotificationTypeRule` if `NotificationType` exists, `None` otherwise
+        """
+        return self.get_rules().get(name)
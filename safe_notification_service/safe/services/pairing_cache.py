@@ -0,0 +1,157 @@
+import json
+import threading
+import time
+from logging import getLogger
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..models import Device, DevicePair
+
+logger = getLogger(__name__)
+
+
+class PairingCacheProvider:
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = PairingCache(get_redis(),
+                                        settings.PAIRING_CACHE_TIMEOUT_SECONDS,
+                                        settings.PAIRING_CACHE_LOCAL_TIMEOUT_SECONDS)
+        return cls.instance
+
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            del cls.instance
+
+
+class PairingCache:
+    """
+    Read-through cache of the devices paired with a signer (devices authorizing the signer), so notifications can be
+    routed without hitting the database. Cache has two tiers: a short lived one per process and a shared one on Redis.
+    Only the fields required for routing are cached: `owner`, `push_token`, `client`, `build_number` and
+    `pending_verification`
+    """
+    KEY_PREFIX = 'paired-devices:'
+    MAX_LOCAL_ENTRIES = 10000
+
+    def __init__(self, redis: Redis, timeout: int, local_timeout: int):
+        """
+        :param redis:
+        :param timeout: Seconds to keep the paired devices on Redis
+        :param local_timeout: Seconds to keep the paired devices on the process. As other processes cannot
+        invalidate it, it should be short. `0` disables the per process cache
+        """
+        self.redis = redis
+        self.timeout = timeout
+        self.local_timeout = local_timeout
+        self._lock = threading.Lock()
+        self._local_cache: Dict[str, Tuple[float, List[Device]]] = {}
+
+    def _get_key(self, signer_address: str) -> str:
+        return self.KEY_PREFIX + signer_address
+
+    def _get_paired_devices_from_database(self, signer_address: str) -> List[Device]:
+        device_pairs = DevicePair.objects.filter(
+            authorized_device__owner=signer_address
+        ).exclude(
+            authorizing_device__push_token=None
+        ).values_list(
+            'authorizing_device__owner', 'authorizing_device__push_token', 'authorizing_device__client',
+            'authorizing_device__build_number', 'authorizing_device__pending_verification'
+        )
+        return [Device(owner=owner, push_token=push_token, client=client, build_number=build_number,
+                       pending_verification=pending_verification)
+                for owner, push_token, client, build_number, pending_verification in device_pairs]
+
+    def _get_paired_devices_from_redis(self, signer_address: str) -> List[Device]:
+        """
+        :param signer_address:
+        :return: Paired devices from Redis, filling it from the database if not cached. If Redis is not available
+            database is used
+        """
+        key = self._get_key(signer_address)
+        try:
+            cached = self.redis.get(key)
+        except RedisError:
+            logger.warning('Cannot get paired devices for signer=%s from redis', signer_address, exc_info=True)
+            return self._get_paired_devices_from_database(signer_address)
+
+        if cached is not None:
+            return [Device(owner=owner, push_token=push_token, client=client, build_number=build_number,
+                           pending_verification=pending_verification)
+                    for owner, push_token, client, build_number, pending_verification in json.loads(cached)]
+
+        paired_devices = self._get_paired_devices_from_database(signer_address)
+        try:
+            self.redis.set(key,
+                           json.dumps([(device.owner, device.push_token, device.client, device.build_number,
+                                        device.pending_verification)
+                                       for device in paired_devices]),
+                           ex=self.timeout)
+        except RedisError:
+            logger.warning('Cannot cache paired devices for signer=%s on redis', signer_address, exc_info=True)
+        return paired_devices
+
+    def get_paired_devices(self, signer_address: str) -> List[Device]:
+        """
+        :param signer_address:
+        :return: Devices authorizing `signer_address` with a `push_token`
+        """
+        if not settings.PAIRING_CACHE:
+            return self._get_paired_devices_from_database(signer_address)
+
+        if self.local_timeout:
+            expiration, paired_devices = self._local_cache.get(signer_address, (0, None))
+            if expiration > time.monotonic():
+                return paired_devices
+
+        paired_devices = self._get_paired_devices_from_redis(signer_address)
+        if self.local_timeout:
+            with self._lock:
+                if len(self._local_cache) >= self.MAX_LOCAL_ENTRIES:
+                    self._local_cache.pop(next(iter(self._local_cache)))  # Remove the oldest entry
+                self._local_cache[signer_address] = (time.monotonic() + self.local_timeout, paired_devices)
+        return paired_devices
+
+    def _invalidate(self, signer_addresses: List[str]):
+        with self._lock:
+            for signer_address in signer_addresses:
+                self._local_cache.pop(signer_address, None)
+        try:
+            self.redis.delete(*[self._get_key(signer_address) for signer_address in signer_addresses])
+        except RedisError:
+            # Invalidation is best effort, so a Redis outage doesn't break pairing or auth. Redis entries expire
+            # after `timeout` anyway
+            logger.warning('Cannot invalidate paired devices for signers=%s on redis', signer_addresses,
+                           exc_info=True)
+
+    def invalidate(self, signer_addresses: Iterable[str]):
+        """
+        Invalidate the paired devices of `signer_addresses`. It must be called after writing the changes, as the
+        cache could be filled again by other processes right after invalidating it. If called in a transaction,
+        invalidation is done again when it's committed, as other processes would fill the cache with old data
+        until then. Outside a transaction the changes are already committed, so invalidation is done only once
+        :param signer_addresses:
+        """
+        signer_addresses = list(set(signer_addresses))
+        if signer_addresses:
+            self._invalidate(signer_addresses)
+            if transaction.get_connection().in_atomic_block:
+                transaction.on_commit(lambda: self._invalidate(signer_addresses))
+
+    def invalidate_devices(self, owners: Iterable[str]):
+        """
+        Devices of `owners` were updated, invalidate the paired devices of the signers paired with them. Like
+        `invalidate`, it must be called after updating the devices
+        :param owners:
+        """
+        self.invalidate(DevicePair.objects.filter(
+            authorizing_device__owner__in=owners
+        ).values_list('authorized_device_id', flat=True))
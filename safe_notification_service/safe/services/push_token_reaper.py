@@ -0,0 +1,149 @@
+from logging import getLogger
+from typing import Sequence
+
+from django.conf import settings
+from django.db import transaction
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..models import Device
+from .auth_service import AuthServiceProvider
+from .pairing_cache import PairingCacheProvider
+
+logger = getLogger(__name__)
+
+
+class PushTokenReaperProvider:
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = PushTokenReaper(get_redis(),
+                                           settings.INVALID_PUSH_TOKENS_FLUSH_INTERVAL_SECONDS,
+                                           settings.INVALID_PUSH_TOKENS_FLUSH_BATCH_SIZE)
+        return cls.instance
+
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            del cls.instance
+
+
+class PushTokenReaper:
+    """
+    Collects push tokens reported as not valid by Firebase when sending notifications and removes them from the
+    `Device` table in batches, so one `UPDATE` is done per flush interval instead of one per failure.
+    Pending push tokens are stored on Redis, so they are shared by every worker
+    """
+    PENDING_PUSH_TOKENS_KEY = 'invalid-push-tokens:pending'
+    FLUSH_LOCK_KEY = 'invalid-push-tokens:flush-lock'
+
+    def __init__(self, redis: Redis, flush_interval: int, batch_size: int):
+        """
+        :param redis:
+        :param flush_interval: Seconds between flushes
+        :param batch_size: Max number of push tokens removed per `UPDATE`. If more push tokens are pending, flush
+        will happen without waiting for `flush_interval`
+        """
+        self.redis = redis
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+    def add_invalid_push_tokens(self, push_tokens: Sequence[str]) -> int:
+        """
+        Queue `push_tokens` for removal. If flush interval elapsed they will be removed from database. It never
+        raises, as it's called after notifications were sent: if Redis is not available push tokens are removed
+        right now, and if removing them fails they are dropped
+        :param push_tokens:
+        :return: Number of push tokens reaped, `0` if flush was not triggered
+        """
+        if not push_tokens:
+            return 0
+
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.sadd(self.PENDING_PUSH_TOKENS_KEY, *push_tokens)
+                pipe.scard(self.PENDING_PUSH_TOKENS_KEY)
+                _, pending = pipe.execute()
+        except RedisError:
+            logger.warning('Cannot queue %d invalid push tokens, reaping them now', len(push_tokens), exc_info=True)
+            try:
+                self.reap(push_tokens)
+            except Exception:
+                logger.error('Cannot reap %d invalid push tokens, dropping them', len(push_tokens), exc_info=True)
+                return 0
+            return len(push_tokens)
+
+        if pending >= self.batch_size:
+            return self._flush_pending()
+        # Lock expires after `flush_interval`, so only one worker will flush per interval
+        try:
+            flush_lock = self.redis.set(self.FLUSH_LOCK_KEY, 1, nx=True, ex=self.flush_interval)
+        except RedisError:
+            # Push tokens are pending, they will be flushed with the next ones
+            logger.warning('Cannot get invalid push tokens flush lock', exc_info=True)
+            return 0
+        if flush_lock:
+            reaped = self._flush_pending()
+            self.schedule_flush()
+            return reaped
+        return 0
+
+    def _flush_pending(self) -> int:
+        """
+        Flush without raising, push tokens not reaped are kept pending for the next flush
+        :return: Number of push tokens reaped
+        """
+        try:
+            return self.flush()
+        except Exception:
+            logger.warning('Cannot flush invalid push tokens, keeping them pending', exc_info=True)
+            return 0
+
+    def schedule_flush(self):
+        """
+        Schedule a flush for when the flush lock expires, so push tokens added while it's held are reaped even if no
+        more push tokens are added after that
+        """
+        from ..tasks import flush_invalid_push_tokens_task
+
+        flush_invalid_push_tokens_task.apply_async(countdown=self.flush_interval)
+
+    def flush(self) -> int:
+        """
+        Remove pending push tokens from database, using one `UPDATE` per `batch_size` push tokens. If removing a
+        batch fails, its push tokens are kept pending
+        :return: Number of push tokens reaped
+        """
+        reaped = 0
+        while push_tokens := self.redis.spop(self.PENDING_PUSH_TOKENS_KEY, self.batch_size):
+            push_tokens = [push_token.decode() for push_token in push_tokens]
+            try:
+                updated = self.reap(push_tokens)
+            except Exception:
+                # Return push tokens to the pending ones, so they are not lost and next flush retries them
+                try:
+                    self.redis.sadd(self.PENDING_PUSH_TOKENS_KEY, *push_tokens)
+                except RedisError:
+                    logger.error('Cannot keep %d invalid push tokens pending, dropping them', len(push_tokens),
+                                 exc_info=True)
+                raise
+            reaped += len(push_tokens)
+            logger.info('Reaped %d invalid push tokens, %d devices updated', len(push_tokens), updated)
+        return reaped
+
+    def reap(self, push_tokens: Sequence[str]) -> int:
+        """
+        Remove `push_tokens` from database right now, using one `UPDATE`
+        :param push_tokens:
+        :return: Number of devices updated
+        """
+        AuthServiceProvider().clear_push_token_verifications(push_tokens)
+        with transaction.atomic():
+            devices = Device.objects.filter_by_push_tokens(push_tokens)
+            owners = list(devices.values_list('owner', flat=True))
+            updated = devices.remove_push_tokens()
+        # Invalidated after the changes are written, so other processes cannot fill the cache with old data
+        PairingCacheProvider().invalidate_devices(owners)
+        return updated
@@ -0,0 +1,86 @@
+from logging import getLogger
+from typing import Optional, Sequence
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+logger = getLogger(__name__)
+
+
+class RateLimiterProvider:
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = RateLimiter(get_redis())
+        return cls.instance
+
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            del cls.instance
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter stored on Redis, so limits are shared by every process. Buckets are checked and updated
+    by a Lua script, atomically and with only one round trip
+    """
+    KEY_PREFIX = 'rate-limit:'
+    # KEYS: buckets. ARGV: capacity, refill rate (tokens per second), tokens requested.
+    # Tokens are only taken if every bucket has enough of them. Redis clock is used, so it's the same for every
+    # process. Returns seconds to wait until the request is allowed, `0` if allowed
+    TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local ttl = math.ceil(capacity / rate * 1000)
+local buckets = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'tokens', 'timestamp')
+    local tokens = tonumber(bucket[1]) or capacity
+    local timestamp = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+    if tokens < requested then
+        wait = math.max(wait, (requested - tokens) / rate)
+    end
+    buckets[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local tokens = buckets[i]
+    if wait == 0 then
+        tokens = tokens - requested
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'timestamp', now)
+    redis.call('PEXPIRE', key, ttl)
+end
+return tostring(wait)
+"""
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._token_bucket_script = redis.register_script(self.TOKEN_BUCKET_SCRIPT)
+
+    def consume(self, keys: Sequence[str], capacity: int, refill_rate: float, tokens: int = 1) -> Optional[float]:
+        """
+        Take `tokens` from every bucket. If any of them has not enough tokens, none are taken
+        :param keys: Identifiers of the buckets (e.g. an ip address)
+        :param capacity: Max tokens of every bucket, so it's the burst allowed
+        :param refill_rate: Tokens added to every bucket per second
+        :param tokens: Tokens requested
+        :return: `None` if tokens were taken, seconds to wait until they are available otherwise. If Redis is not
+            available requests are allowed, so rate limiting doesn't take the service down
+        """
+        if not keys:
+            return None
+        try:
+            wait = float(self._token_bucket_script(keys=[self.KEY_PREFIX + key for key in keys],
+                                                   args=[capacity, refill_rate, tokens]))
+        except RedisError:
+            logger.warning('Cannot check rate limit for keys=%s', keys, exc_info=True)
+            return None
+        return wait or None
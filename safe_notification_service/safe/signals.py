@@ -0,0 +1,20 @@
+from logging import getLogger
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import NotificationType
+from .services.notification_type_cache import NotificationTypeCacheProvider
+
+logger = getLogger(__name__)
+
+
+@receiver(post_save, sender=NotificationType, dispatch_uid='notification_type.invalidate_cache.save')
+@receiver(post_delete, sender=NotificationType, dispatch_uid='notification_type.invalidate_cache.delete')
+def invalidate_notification_type_cache(sender, instance: NotificationType, **kwargs):
+    logger.info('NotificationType %s changed, invalidating cache', instance.name)
+    notification_type_cache = NotificationTypeCacheProvider()
+    notification_type_cache.invalidate()
+    # Other processes could reload the cache before the transaction is committed
+    transaction.on_commit(notification_type_cache.invalidate)
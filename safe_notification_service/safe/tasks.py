@@ -1,36 +1,332 @@
-from typing import Dict, List, Optional
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence
 
 from django.conf import settings
+from django.db import transaction
 
-from celery import app
+from celery import Signature, app, group, signature
 from celery.utils.log import get_task_logger
 
-from .models import Device
+from .models import (Device, NotificationOutbox, NotificationPriorityEnum,
+                     NotificationTypeRule)
+from .services.auth_service import AuthServiceProvider
+from .services.notification_coalescer import NotificationCoalescerProvider
 from .services.notification_service import (InvalidPushToken,
                                             NotificationServiceProvider,
-                                            UnknownMessagingException)
+                                            PermanentMessagingException,
+                                            RetriableMessagingException)
+from .services.push_token_reaper import PushTokenReaperProvider
 
 logger = get_task_logger(__name__)
 
 
+def get_retry_countdown(retries: int, retry_after: Optional[float] = None) -> float:
+    """
+    Exponential backoff with jitter, so retries from multiple workers don't hit Firebase at the same time
+    :param retries: Number of retries already done
+    :param retry_after: Seconds requested by Firebase to wait before retrying. It takes precedence if bigger
+    :return: Seconds to wait before the next retry
+    """
+    delay = min(settings.NOTIFICATION_RETRY_DELAY_SECONDS * 2 ** retries,
+                settings.NOTIFICATION_RETRY_MAX_DELAY_SECONDS)
+    countdown = delay / 2 + random.uniform(0, delay / 2)
+    return max(countdown, retry_after or 0)
+
+
+def get_notification_queue(notification_type_rule: Optional[NotificationTypeRule]) -> Optional[str]:
+    """
+    :param notification_type_rule: Rule for the type of the notification, `None` if not configured
+    :return: Celery queue for the priority of the notification if `NOTIFICATION_PRIORITY_QUEUES` is enabled, `None`
+        to use the default queue otherwise. Not configured notifications have `NORMAL` priority
+    """
+    if not settings.NOTIFICATION_PRIORITY_QUEUES:
+        return None
+    priority = notification_type_rule.priority if notification_type_rule else NotificationPriorityEnum.NORMAL
+    return NotificationPriorityEnum(priority).queue
+
+
+def route_notification_tasks(notification_type_rule: Optional[NotificationTypeRule],
+                             signatures: List[Signature]) -> List[Signature]:
+    """
+    Route the tasks of a notification to the queue for its priority, so low priority bursts don't delay the others
+    :param notification_type_rule: Rule for the type of the notification, `None` if not configured
+    :param signatures:
+    :return: Same `signatures`, routed
+    """
+    queue = get_notification_queue(notification_type_rule)
+    if queue:
+        for task_signature in signatures:
+            task_signature.set(queue=queue)
+    return signatures
+
+
+def get_expires_at(notification_type_rule: Optional[NotificationTypeRule]) -> Optional[float]:
+    """
+    Expiration is fixed when the notification is enqueued, so time spent queued or retrying counts
+    :param notification_type_rule: Rule for the type of the notification, `None` if not configured
+    :return: Timestamp after which the notification must be discarded, `None` if it doesn't expire
+    """
+    ttl = notification_type_rule.ttl if notification_type_rule else None
+    return None if ttl is None else time.time() + ttl
+
+
 def send_notification_to_devices(message: Dict[str, any], devices: List[str],
-                                 signer_address: Optional[str] = None) -> List[Device]:
-    devices = NotificationServiceProvider().get_enabled_devices(message, devices, signer_address)
+                                 signer_address: Optional[str] = None,
+                                 expires_at: Optional[float] = None) -> List[Device]:
+    """
+    Enqueue the notification for the enabled `devices`. Only one notification is sent per push token, as the same
+    push token can be linked to multiple owners (one app instance with multiple owners)
+    :param expires_at: Expiration of the notification if it was already enqueued, calculated from the
+        `NotificationType` ttl otherwise
+    :return: Devices enabled for the notification
+    """
+    notification_service = NotificationServiceProvider()
+    # Rule is resolved only once for the filtering, expiration, collapse key and routing of the notification
+    notification_type_rule = notification_service.get_notification_type_rule(message)
+    devices = notification_service.get_enabled_devices_by_rule(notification_type_rule, devices, signer_address)
+    # Remove duplicated push tokens keeping the order. Devices sharing a push token are the same app instance, so
+    # they share the client too
+    clients = {}
     for device in devices:
-        send_notification_task.delay(message, device.push_token)
+        clients.setdefault(device.push_token, device.client)
+    push_tokens = list(clients)
+    if not push_tokens:
+        return devices
+
+    kwargs = {}
+    if expires_at is None:
+        expires_at = get_expires_at(notification_type_rule)
+    if expires_at is not None:
+        kwargs['expires_at'] = expires_at
+    collapse_key = notification_type_rule.get_collapse_key(message) if notification_type_rule else ''
+    if collapse_key:
+        kwargs['collapse_key'] = collapse_key
+        if settings.NOTIFICATION_COALESCE_WINDOW_SECONDS:
+            coalesce_id = NotificationCoalescerProvider().coalesce(collapse_key, push_tokens)
+            if coalesce_id:
+                kwargs['coalesce_id'] = coalesce_id
+
+    if settings.NOTIFICATION_MULTICAST:
+        # Every multicast request has the payload for only one platform
+        push_tokens_by_client = defaultdict(list)
+        for push_token, client in clients.items():
+            push_tokens_by_client[client].append(push_token)
+        batch_size = settings.NOTIFICATION_MULTICAST_MAX_TOKENS
+        signatures = [send_multicast_notification_task.s(message, client_push_tokens[i:i + batch_size],
+                                                         client=client, **kwargs)
+                      for client, client_push_tokens in push_tokens_by_client.items()
+                      for i in range(0, len(client_push_tokens), batch_size)]
+    else:
+        signatures = [send_notification_task.s(message, push_token, client=client, **kwargs)
+                      for push_token, client in clients.items()]
+    if 'coalesce_id' in kwargs:
+        # Wait for newer notifications replacing this one
+        for task_signature in signatures:
+            task_signature.set(countdown=settings.NOTIFICATION_COALESCE_WINDOW_SECONDS)
+    publish_tasks(route_notification_tasks(notification_type_rule, signatures))
     return devices
 
 
+def dispatch_notification(message: Dict[str, any], devices: List[str], signer_address: Optional[str] = None):
+    """
+    Enqueue the resolution of the enabled `devices` for the notification, so the HTTP request doesn't need to wait.
+    Task is routed to the queue for the priority of the notification, and expiration is calculated now so time
+    waiting for the task counts
+    :param message:
+    :param devices:
+    :param signer_address:
+    """
+    notification_type_rule = NotificationServiceProvider().get_notification_type_rule(message)
+    expires_at = get_expires_at(notification_type_rule)
+    kwargs = {} if expires_at is None else {'expires_at': expires_at}
+    publish_tasks(route_notification_tasks(notification_type_rule,
+                                           [dispatch_notification_task.s(message, devices, signer_address,
+                                                                         **kwargs)]))
+
+
+def publish_tasks(signatures: Sequence[Signature]):
+    """
+    Publish every task as a group, so Celery uses the same producer and broker connection for all of them instead
+    of acquiring one per task. If `NOTIFICATION_OUTBOX` is enabled, tasks are stored on the `NotificationOutbox`
+    instead, on the current transaction, and published later by the relay
+    :param signatures: Tasks to publish
+    """
+    if not signatures:
+        return
+    if settings.NOTIFICATION_OUTBOX:
+        NotificationOutbox.objects.add_tasks([(signature.task, signature.args, signature.kwargs, signature.options)
+                                              for signature in signatures])
+    else:
+        group(signatures).apply_async()
+
+
+def relay_notification_outbox(batch_size: int) -> int:
+    """
+    Publish a batch of the tasks stored on the `NotificationOutbox` and remove them. Tasks are locked while they are
+    published, so multiple relays can run at the same time. If publishing fails, tasks are kept for the next try
+    :param batch_size: Max number of tasks to publish
+    :return: Number of tasks published
+    """
+    with transaction.atomic():
+        outbox_tasks = NotificationOutbox.objects.lock_batch(batch_size)
+        if outbox_tasks:
+            group([signature(outbox_task.task_name, args=outbox_task.args, kwargs=outbox_task.kwargs,
+                             options=outbox_task.options)
+                   for outbox_task in outbox_tasks]).apply_async()
+            NotificationOutbox.objects.filter(id__in=[outbox_task.id for outbox_task in outbox_tasks]).delete()
+    return len(outbox_tasks)
+
+
+def get_remaining_ttl(expires_at: Optional[float]) -> Optional[float]:
+    """
+    :param expires_at: Timestamp when the notification expires
+    :return: Seconds until the notification expires, `None` if it never expires
+    """
+    return expires_at - time.time() if expires_at is not None else None
+
+
+def is_expired(expires_at: Optional[float], countdown: float = 0) -> bool:
+    """
+    :param expires_at: Timestamp when the notification expires
+    :param countdown: Seconds until the notification would be sent
+    :return: `True` if the notification would be expired when sent, `False` otherwise
+    """
+    return expires_at is not None and time.time() + countdown >= expires_at
+
+
+@app.shared_task()
+def dispatch_notification_task(message: Dict[str, any], devices: List[str],
+                               signer_address: Optional[str] = None, expires_at: Optional[float] = None) -> int:
+    """
+    Resolve the enabled devices and enqueue the notification for them, so the HTTP request doesn't need to wait
+    :param expires_at: Timestamp after which the notification is discarded, calculated when it was enqueued
+    :return: Number of devices enabled for the notification
+    """
+    if is_expired(expires_at):
+        logger.info('Discarding expired notification, message: %s, sender: %s', message, signer_address)
+        return 0
+    enabled_devices = send_notification_to_devices(message, devices, signer_address, expires_at=expires_at)
+    if not enabled_devices:
+        logger.info('No enabled devices found for notification, sender: %s, devices: %s', signer_address, devices)
+    return len(enabled_devices)
+
+
 @app.shared_task(bind=True,
                  default_retry_delay=settings.NOTIFICATION_RETRY_DELAY_SECONDS,
                  max_retries=settings.NOTIFICATION_MAX_RETRIES)
-def send_notification_task(self, message: Dict[str, any], push_token: str) -> str:
+def send_notification_task(self, message: Dict[str, any], push_token: str, expires_at: Optional[float] = None,
+                           collapse_key: Optional[str] = None, coalesce_id: Optional[str] = None,
+                           client: Optional[int] = None) -> Optional[str]:
     """
     The task sends a Firebase Push Notification
+    :param client: `Device.client` of the push token, so only the payload for its platform is sent
+    :param expires_at: Timestamp after which the notification is discarded instead of sent
+    :param collapse_key: Notifications with the same collapse key replace the previous ones not delivered yet
+    :param coalesce_id: If set, notification is discarded if a newer one with the same `collapse_key` was enqueued
+    :return: Firebase `MessageId`, `None` if not sent
     """
+    if is_expired(expires_at):
+        logger.info('Discarding expired notification, message: %s, push-token: %s', message, push_token)
+        return None
+    if coalesce_id and not NotificationCoalescerProvider().get_newest_push_tokens(collapse_key, [push_token],
+                                                                                  coalesce_id):
+        return None
+
     try:
-        return NotificationServiceProvider().send_notification(message, push_token)
+        return NotificationServiceProvider().send_notification(message, push_token,
+                                                               ttl=get_remaining_ttl(expires_at),
+                                                               collapse_key=collapse_key, client=client)
     except InvalidPushToken:
+        PushTokenReaperProvider().add_invalid_push_tokens([push_token])
+    except PermanentMessagingException:
         pass
-    except UnknownMessagingException as exc:
-        self.retry(exc=exc)
+    except RetriableMessagingException as exc:
+        countdown = get_retry_countdown(self.request.retries, exc.retry_after)
+        if is_expired(expires_at, countdown):
+            logger.info('Not retrying notification as it would be expired, message: %s, push-token: %s',
+                        message, push_token)
+        else:
+            self.retry(exc=exc, countdown=countdown)
+
+
+@app.shared_task(bind=True,
+                 default_retry_delay=settings.NOTIFICATION_RETRY_DELAY_SECONDS,
+                 max_retries=settings.NOTIFICATION_MAX_RETRIES)
+def send_multicast_notification_task(self, message: Dict[str, any], push_tokens: List[str],
+                                     expires_at: Optional[float] = None, collapse_key: Optional[str] = None,
+                                     coalesce_id: Optional[str] = None,
+                                     client: Optional[int] = None) -> Dict[str, str]:
+    """
+    The task sends the same Firebase Push Notification to multiple push tokens, with one Firebase HTTP v1 request per
+    push token sent concurrently. If some of the push tokens fail, only those will be retried
+    :param client: `Device.client` of every push token, so only the payload for their platform is sent
+    :param expires_at: Timestamp after which the notification is discarded instead of sent
+    :param collapse_key: Notifications with the same collapse key replace the previous ones not delivered yet
+    :param coalesce_id: If set, notification is not sent to the push tokens for which a newer one with the same
+        `collapse_key` was enqueued
+    :return: Dictionary of push token -> Firebase `MessageId` for the push tokens that succeeded
+    """
+    if is_expired(expires_at):
+        logger.info('Discarding expired notification, message: %s, push-tokens: %d', message, len(push_tokens))
+        return {}
+    if coalesce_id:
+        push_tokens = NotificationCoalescerProvider().get_newest_push_tokens(collapse_key, push_tokens, coalesce_id)
+        if not push_tokens:
+            return {}
+
+    try:
+        multicast_result = NotificationServiceProvider().send_multicast_notification(
+            message, push_tokens, ttl=get_remaining_ttl(expires_at), collapse_key=collapse_key, client=client)
+    except PermanentMessagingException:
+        return {}
+    except RetriableMessagingException as exc:
+        countdown = get_retry_countdown(self.request.retries, exc.retry_after)
+        if is_expired(expires_at, countdown):
+            logger.info('Not retrying notification as it would be expired, message: %s', message)
+            return {}
+        # Push tokens discarded by coalescing are not retried
+        self.retry(args=(message, push_tokens), exc=exc, countdown=countdown)
+
+    PushTokenReaperProvider().add_invalid_push_tokens(multicast_result.invalid_push_tokens)
+    if multicast_result.failed_push_tokens:
+        countdown = get_retry_countdown(self.request.retries, multicast_result.retry_after)
+        if is_expired(expires_at, countdown):
+            logger.info('Not retrying %d push tokens as notification would be expired, message: %s',
+                        len(multicast_result.failed_push_tokens), message)
+        else:
+            self.retry(args=(message, multicast_result.failed_push_tokens), countdown=countdown)
+    return multicast_result.message_ids
+
+
+# Retried until it succeeds, as nothing else would verify the push tokens pending verification. Retries are spaced
+# by `get_retry_countdown`, so they are done at most every `NOTIFICATION_RETRY_MAX_DELAY_SECONDS`
+@app.shared_task(bind=True, max_retries=None)
+def verify_pending_push_tokens_task(self) -> int:
+    """
+    Verify push tokens registered without verification on Firebase, in batches. If verification fails, task is
+    retried later
+    :return: Number of push tokens verified
+    """
+    batch_size = settings.PUSH_TOKEN_VERIFICATION_BATCH_SIZE
+    auth_service = AuthServiceProvider()
+    verified = 0
+    while True:
+        try:
+            batch_verified = auth_service.verify_pending_push_tokens(batch_size)
+        except Exception as exc:
+            logger.warning('Cannot verify pending push tokens, retrying', exc_info=True)
+            self.retry(exc=exc, countdown=get_retry_countdown(self.request.retries))
+        verified += batch_verified
+        if batch_verified < batch_size:
+            return verified
+
+
+@app.shared_task()
+def flush_invalid_push_tokens_task() -> int:
+    """
+    Remove from database the invalid push tokens pending to be reaped
+    :return: Number of push tokens reaped
+    """
+    return PushTokenReaperProvider().flush()
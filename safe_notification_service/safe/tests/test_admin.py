@@ -0,0 +1,22 @@
+from django.contrib.admin.sites import AdminSite
+from django.test import TestCase
+
+from ..admin import DeviceAdmin
+from ..models import Device, DeviceTypeEnum
+from .factories import DeviceFactory
+
+
+class TestDeviceAdmin(TestCase):
+    def test_get_search_results(self):
+        device_admin = DeviceAdmin(Device, AdminSite())
+        android_device = DeviceFactory(client=DeviceTypeEnum.ANDROID.value)
+        ios_device = DeviceFactory(client=DeviceTypeEnum.IOS.value)
+
+        for device in (android_device, ios_device):
+            queryset, _ = device_admin.get_search_results(None, Device.objects.all(), device.push_token)
+            self.assertEqual(list(queryset), [device])
+
+        # Changelist filters are kept when searching by `push_token`
+        queryset, _ = device_admin.get_search_results(None, Device.objects.filter(client=DeviceTypeEnum.IOS.value),
+                                                      android_device.push_token)
+        self.assertEqual(list(queryset), [])
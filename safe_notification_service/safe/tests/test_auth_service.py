@@ -1,9 +1,18 @@
-from django.test import TestCase
+from unittest import mock
+
+from django.test import TestCase, TransactionTestCase
 
 from eth_account import Account
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
 
-from ..models import Device, DeviceTypeEnum
-from ..services import AuthServiceProvider
+from ..models import Device, DevicePair, DeviceTypeEnum, get_push_token_hash
+from ..services import (AuthService, AuthServiceProvider,
+                        NotificationServiceProvider, PairingCacheProvider)
+from ..services.auth_service import InvalidPushToken
+from .factories import DevicePairFactory
+from .test_pairing_cache import refill_pairing_cache_on_invalidate
 
 
 class TestAuthService(TestCase):
@@ -51,3 +60,215 @@ class TestAuthService(TestCase):
         self.assertEqual(Device.objects.all().count(), len(owners) + 1)
         self.assertEqual(Device.objects.filter(push_token=push_token).count(), len(owners))
         self.assertEqual(Device.objects.filter(push_token=push_token_2).count(), 1)
+
+        # Lookups by push token use the hash
+        self.assertEqual(Device.objects.filter_by_push_token(push_token).count(), len(owners))
+        self.assertEqual(Device.objects.filter_by_push_tokens([push_token, push_token_2]).count(), len(owners) + 1)
+        self.assertEqual(Device.objects.filter_by_push_token(push_token_2).get().push_token_hash,
+                         get_push_token_hash(push_token_2))
+        device = Device.objects.filter_by_push_token(push_token_2).get()
+        device.push_token = push_token
+        device.save(update_fields=['push_token'])
+        self.assertEqual(Device.objects.filter_by_push_token(push_token).count(), len(owners) + 1)
+        self.assertEqual(Device.objects.filter_by_push_token(push_token).remove_push_tokens(), len(owners) + 1)
+        self.assertEqual(Device.objects.filter(push_token_hash=None).count(), len(owners) + 1)
+
+    def test_create_auth_queries(self):
+        auth_service = AuthServiceProvider()
+        push_token = 'eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G'
+        owners = [Account.create().address for _ in range(10)]
+        with self.assertNumQueries(1):
+            devices = auth_service.create_auth(push_token, 2, '1.0.2', DeviceTypeEnum.IOS.name, 'pm.gnosis.heimdall',
+                                               owners)
+        self.assertEqual([device.owner for device in devices], owners)
+        for device in devices:
+            self.assertEqual(device, Device.objects.get(owner=device.owner))
+            self.assertEqual(device.push_token, push_token)
+            self.assertEqual(device.client, DeviceTypeEnum.IOS.value)
+            self.assertEqual(device.build_number, 2)
+            self.assertIsNotNone(device.created)
+
+        # Pairings of removed owners are removed too
+        DevicePairFactory(authorizing_device=devices[0], authorized_device=devices[1])
+        DevicePairFactory(authorizing_device=devices[1], authorized_device=devices[0])
+        DevicePairFactory(authorizing_device=devices[2], authorized_device=devices[0])
+        new_owners = [devices[2].owner, devices[2].owner, Account.create().address]
+        with self.assertNumQueries(1):
+            new_devices = auth_service.create_auth(push_token, 3, '1.0.3', DeviceTypeEnum.IOS.name,
+                                                   'pm.gnosis.heimdall', new_owners)
+        self.assertEqual([device.owner for device in new_devices], new_owners)
+        self.assertEqual(new_devices[0].created, devices[2].created)
+        self.assertEqual(new_devices[0].build_number, 3)
+        self.assertCountEqual(Device.objects.values_list('owner', flat=True), set(new_owners))
+        self.assertEqual(DevicePair.objects.count(), 0)
+
+    def test_register_push_token_paired_addresses(self):
+        push_token = 'eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G-paired-addresses'
+        owner = Account.create().address
+        (stale_device,), _ = Device.objects.register_push_token(push_token, 2, '1.0.2', DeviceTypeEnum.IOS.value,
+                                                                'pm.gnosis.heimdall', [owner])
+        # Device replaced is only the authorized side of the pairing
+        authorizing_address = DevicePairFactory(authorized_device=stale_device).authorizing_device.owner
+        authorized_address = DevicePairFactory(authorizing_device=stale_device).authorized_device.owner
+        DevicePairFactory()
+
+        new_owner = Account.create().address
+        _, paired_addresses = Device.objects.register_push_token(push_token, 3, '1.0.3', DeviceTypeEnum.IOS.value,
+                                                                 'pm.gnosis.heimdall', [new_owner])
+        self.assertCountEqual(paired_addresses, [owner, authorizing_address, authorized_address])
+        self.assertEqual(DevicePair.objects.count(), 1)
+
+    def test_verify_push_token(self):
+        messaging_client = mock.MagicMock()
+        auth_service = AuthService(messaging_client, get_redis(), verification_cache_timeout=60,
+                                   verification_negative_cache_timeout=60)
+        push_token = Account.create().address
+        not_valid_push_token = Account.create().address
+        messaging_client.verify_token.side_effect = lambda token: token == push_token
+        for _ in range(2):
+            self.assertTrue(auth_service.verify_push_token(push_token))
+            self.assertFalse(auth_service.verify_push_token(not_valid_push_token))
+        self.assertEqual(messaging_client.verify_token.call_count, 2)
+
+        # Verification is shared between processes
+        another_auth_service = AuthService(messaging_client, get_redis())
+        self.assertTrue(another_auth_service.verify_push_token(push_token))
+        self.assertEqual(messaging_client.verify_token.call_count, 2)
+
+        # Push token is not valid anymore
+        messaging_client.verify_token.side_effect = lambda token: False
+        auth_service.clear_push_token_verifications([push_token, not_valid_push_token])
+        self.assertFalse(another_auth_service.verify_push_token(push_token))
+        self.assertEqual(messaging_client.verify_token.call_count, 3)
+
+        # Cache disabled
+        self.assertFalse(another_auth_service.verify_push_token(push_token))
+        self.assertEqual(messaging_client.verify_token.call_count, 4)
+
+    def test_verify_push_token_redis_error(self):
+        messaging_client = mock.MagicMock()
+        messaging_client.verify_token.return_value = True
+        redis = mock.MagicMock()
+        redis.get.side_effect = RedisError
+        redis.pipeline.return_value.__enter__.return_value.execute.side_effect = RedisError
+        redis.delete.side_effect = RedisError
+        auth_service = AuthService(messaging_client, redis, verification_cache_timeout=60)
+        push_token = Account.create().address
+        # Cache is skipped if Redis is not available
+        self.assertIsNone(auth_service.get_cached_push_token_verification(push_token))
+        self.assertTrue(auth_service.verify_push_token(push_token))
+        messaging_client.verify_token.assert_called_once_with(push_token)
+        auth_service.clear_push_token_verifications([push_token])
+
+    def test_create_auth_async_verification(self):
+        messaging_client = mock.MagicMock()
+        auth_service = AuthService(messaging_client, get_redis(), verification_cache_timeout=60,
+                                   verification_negative_cache_timeout=60)
+        push_token = 'eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G-async'
+        not_valid_push_token = 'eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G-async-not-valid'
+        unknown_push_token = 'eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G-async-unknown'
+        auth_service.clear_push_token_verifications([push_token, not_valid_push_token, unknown_push_token])
+        get_redis().delete(AuthService.PUSH_TOKEN_VERIFICATION_SCHEDULED_KEY)
+        owners = [Account.create().address for _ in range(3)]
+
+        with self.settings(PUSH_TOKEN_ASYNC_VERIFICATION=True):
+            devices = auth_service.create_auth(push_token, 2, '1.0.2', DeviceTypeEnum.ANDROID.name,
+                                               'pm.gnosis.heimdall', owners[:1])
+            devices += auth_service.create_auth(not_valid_push_token, 2, '1.0.2', DeviceTypeEnum.ANDROID.name,
+                                                'pm.gnosis.heimdall', owners[1:2])
+            devices += auth_service.create_auth(unknown_push_token, 2, '1.0.2', DeviceTypeEnum.ANDROID.name,
+                                                'pm.gnosis.heimdall', owners[2:])
+            messaging_client.verify_token.assert_not_called()
+            self.assertTrue(all(device.pending_verification for device in devices))
+            self.assertTrue(get_redis().exists(AuthService.PUSH_TOKEN_VERIFICATION_SCHEDULED_KEY))
+
+            verifications = {push_token: True, not_valid_push_token: False, unknown_push_token: None}
+            messaging_client.verify_tokens.side_effect = lambda tokens: [verifications[token] for token in tokens]
+            self.assertEqual(auth_service.verify_pending_push_tokens(10), 2)
+            self.assertFalse(Device.objects.get(owner=owners[0]).pending_verification)
+            self.assertIsNone(Device.objects.get(owner=owners[1]).push_token)
+            self.assertTrue(Device.objects.get(owner=owners[2]).pending_verification)
+            self.assertEqual(Device.objects.filter_pending_verification().count(), 1)
+
+            # Verifications are cached
+            devices = auth_service.create_auth(push_token, 3, '1.0.3', DeviceTypeEnum.ANDROID.name,
+                                               'pm.gnosis.heimdall', owners[:1])
+            self.assertFalse(devices[0].pending_verification)
+            with self.assertRaises(InvalidPushToken):
+                auth_service.create_auth(not_valid_push_token, 3, '1.0.3', DeviceTypeEnum.ANDROID.name,
+                                         'pm.gnosis.heimdall', owners[1:2])
+            messaging_client.verify_token.assert_not_called()
+
+    def test_create_auth_async_verification_redis_error(self):
+        messaging_client = mock.MagicMock()
+        redis = mock.MagicMock()
+        redis.get.side_effect = RedisError
+        redis.set.side_effect = RedisError
+        auth_service = AuthService(messaging_client, redis)
+        push_token = 'eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G-async-redis-error'
+        owner = Account.create().address
+        with self.settings(PUSH_TOKEN_ASYNC_VERIFICATION=True):
+            with mock.patch('safe_notification_service.safe.tasks.verify_pending_push_tokens_task') as task:
+                with self.captureOnCommitCallbacks(execute=True):
+                    devices = auth_service.create_auth(push_token, 2, '1.0.2', DeviceTypeEnum.ANDROID.name,
+                                                       'pm.gnosis.heimdall', [owner])
+                # Verification is scheduled even if Redis is not available
+                task.apply_async.assert_called_once()
+        self.assertTrue(devices[0].pending_verification)
+
+    def test_verify_pending_push_tokens_max_attempts(self):
+        messaging_client = mock.MagicMock()
+        auth_service = AuthService(messaging_client, get_redis())
+        push_tokens = ['eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G-attempts-%d' % i for i in range(3)]
+        owners = [Account.create().address for _ in push_tokens]
+        for push_token, owner in zip(push_tokens, owners):
+            Device.objects.register_push_token(push_token, 2, '1.0.2', DeviceTypeEnum.ANDROID.value,
+                                               'pm.gnosis.heimdall', [owner], pending_verification=True)
+
+        messaging_client.verify_tokens.side_effect = lambda tokens: [None] * len(tokens)
+        with self.settings(PUSH_TOKEN_VERIFICATION_MAX_ATTEMPTS=2):
+            self.assertEqual(auth_service.verify_pending_push_tokens(1), 0)
+            self.assertEqual(messaging_client.verify_tokens.call_args[0][0], push_tokens[:1])
+            self.assertEqual(Device.objects.get(owner=owners[0]).verification_attempts, 1)
+
+            # Push tokens that could not be verified don't block the others
+            self.assertEqual(auth_service.verify_pending_push_tokens(2), 0)
+            self.assertEqual(messaging_client.verify_tokens.call_args[0][0], push_tokens[1:])
+
+            # Push tokens are removed after too many attempts
+            self.assertEqual(auth_service.verify_pending_push_tokens(1), 0)
+            self.assertEqual(messaging_client.verify_tokens.call_args[0][0], push_tokens[:1])
+            self.assertIsNone(Device.objects.get(owner=owners[0]).push_token)
+            self.assertTrue(Device.objects.get(owner=owners[1]).pending_verification)
+
+            # Registering push token again resets the attempts
+            devices, _ = Device.objects.register_push_token(push_tokens[1], 3, '1.0.3', DeviceTypeEnum.ANDROID.value,
+                                                            'pm.gnosis.heimdall', [owners[1]],
+                                                            pending_verification=True)
+            self.assertEqual(devices[0].verification_attempts, 0)
+
+
+class TestAuthServiceWithoutTransaction(TransactionTestCase):
+    def test_verify_pending_push_tokens_pairing_cache(self):
+        messaging_client = mock.MagicMock()
+        auth_service = AuthService(messaging_client, get_redis())
+        push_token = 'eZpZnaXNo0Y:APA91bE8QebofNECOmZUIsyYl0M85EDG9XdIqcew2G-pairing-cache'
+        owner = Account.create().address
+        Device.objects.register_push_token(push_token, 2, '1.0.2', DeviceTypeEnum.ANDROID.value,
+                                           'pm.gnosis.heimdall', [owner], pending_verification=True)
+        signer_address = DevicePairFactory(authorizing_device=Device.objects.get(owner=owner)).authorized_device.owner
+        with self.settings(PAIRING_CACHE=True, PAIRING_CACHE_LOCAL_TIMEOUT_SECONDS=0,
+                           PUSH_TOKEN_PENDING_VERIFICATION_NOTIFY=False):
+            PairingCacheProvider.del_singleton()
+            PairingCacheProvider().invalidate([signer_address])
+            notification_service = NotificationServiceProvider()
+            self.assertEqual(notification_service.get_enabled_devices({}, [owner], signer_address), [])
+
+            # Verified device is notified right away, even if other processes fill the cache meanwhile
+            messaging_client.verify_tokens.return_value = [True]
+            with refill_pairing_cache_on_invalidate():
+                self.assertEqual(auth_service.verify_pending_push_tokens(10), 1)
+            self.assertEqual([device.owner for device in notification_service.get_enabled_devices({}, [owner],
+                                                                                                  signer_address)],
+                             [owner])
+            PairingCacheProvider.del_singleton()
@@ -0,0 +1,87 @@
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..management.commands.check_invalid_tokens import Command
+from ..models import Device
+from .factories import DeviceFactory
+
+
+class TestCommands(TestCase):
+    @mock.patch('safe_notification_service.safe.management.commands.check_invalid_tokens.FirebaseProvider')
+    def test_check_invalid_tokens(self, firebase_provider_mock: mock.MagicMock):
+        get_redis().delete(Command.CHECKPOINT_KEY)
+        devices = [DeviceFactory() for _ in range(7)]
+        # Devices of different owners can share a push token
+        devices.append(DeviceFactory(push_token=devices[1].push_token))
+        not_valid_push_tokens = {devices[1].push_token, devices[5].push_token}
+        firebase_client = firebase_provider_mock.return_value
+        firebase_client.verify_tokens.side_effect = lambda tokens: [token not in not_valid_push_tokens
+                                                                    for token in tokens]
+
+        buf = StringIO()
+        call_command('check_invalid_tokens', '--batch-size=2', '--concurrency=2', stdout=buf)
+        self.assertIn('Checked 8 devices', buf.getvalue())
+        self.assertIn('3 with tokens not valid', buf.getvalue())
+        self.assertEqual(firebase_client.verify_tokens.call_count, 4)
+        self.assertEqual(Device.objects.exclude(push_token=None).count(), 8)
+        self.assertFalse(get_redis().exists(Command.CHECKPOINT_KEY))
+
+        # Resume from checkpoint
+        owners = list(Device.objects.order_by('owner').values_list('owner', flat=True))
+        get_redis().set(Command.CHECKPOINT_KEY, owners[3])
+        firebase_client.verify_tokens.reset_mock()
+        call_command('check_invalid_tokens', '--delete', stdout=buf)
+        firebase_client.verify_tokens.assert_called_once()
+        self.assertEqual(len(firebase_client.verify_tokens.call_args[0][0]), 4)
+        self.assertEqual(Device.objects.filter(owner__in=owners[4:], push_token=None).count(),
+                         len([device for device in devices
+                              if device.owner in owners[4:] and device.push_token in not_valid_push_tokens]))
+
+        call_command('check_invalid_tokens', '--delete', '--restart', stdout=buf)
+        self.assertEqual(Device.objects.exclude(push_token=None).count(), 5)
+
+    @mock.patch('safe_notification_service.safe.management.commands.check_invalid_tokens.FirebaseProvider')
+    def test_check_invalid_tokens_batch_error(self, firebase_provider_mock: mock.MagicMock):
+        get_redis().delete(Command.CHECKPOINT_KEY)
+        for _ in range(6):
+            DeviceFactory()
+        owners = list(Device.objects.order_by('owner').values_list('owner', flat=True))
+        firebase_client = firebase_provider_mock.return_value
+        # Second batch fails, the other ones are verified
+        firebase_client.verify_tokens.side_effect = [[True, True], ConnectionError('Firebase not available'),
+                                                     [False, False]]
+
+        buf = StringIO()
+        call_command('check_invalid_tokens', '--batch-size=2', '--concurrency=1', stdout=buf)
+        self.assertIn('Checked 6 devices', buf.getvalue())
+        self.assertIn('2 with tokens not valid, 2 could not be verified', buf.getvalue())
+        self.assertEqual(firebase_client.verify_tokens.call_count, 3)
+        # Checkpoint is kept before the tokens not verified, so they are checked again on resume
+        self.assertEqual(get_redis().get(Command.CHECKPOINT_KEY).decode(), owners[1])
+
+        firebase_client.verify_tokens.reset_mock(side_effect=True)
+        firebase_client.verify_tokens.side_effect = lambda tokens: [True] * len(tokens)
+        call_command('check_invalid_tokens', '--batch-size=2', '--concurrency=1', stdout=buf)
+        self.assertEqual(firebase_client.verify_tokens.call_count, 2)
+        self.assertFalse(get_redis().exists(Command.CHECKPOINT_KEY))
+
+    def test_relay_notification_outbox_error(self):
+        command_module = 'safe_notification_service.safe.management.commands.relay_notification_outbox'
+        with mock.patch(command_module + '.relay_notification_outbox',
+                        side_effect=[ConnectionError('Broker not available'), 1]) as relay_mock:
+            # Relay keeps running after an error, `KeyboardInterrupt` is used to stop it
+            with mock.patch(command_module + '.time.sleep', side_effect=[None, KeyboardInterrupt]) as sleep_mock:
+                with self.assertRaises(KeyboardInterrupt):
+                    call_command('relay_notification_outbox', '--batch-size=2', '--interval=1', stdout=StringIO())
+            self.assertEqual(relay_mock.call_count, 2)
+            self.assertEqual(sleep_mock.call_args_list, [mock.call(2), mock.call(1)])
+
+            # With `--once` errors are raised
+            relay_mock.side_effect = ConnectionError('Broker not available')
+            with self.assertRaises(ConnectionError):
+                call_command('relay_notification_outbox', '--once', stdout=StringIO())
@@ -0,0 +1,89 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..services import NotificationCoalescer, NotificationCoalescerProvider
+from ..services.notification_service import NotificationService
+from ..tasks import send_notification_task, send_notification_to_devices
+from .factories import DeviceFactory, NotificationTypeFactory
+
+
+class TestNotificationCoalescer(TestCase):
+    def test_coalesce(self):
+        notification_coalescer = NotificationCoalescer(get_redis(), 1.)
+        collapse_key = 'safeCreation:0x4D953115678b15CE0B0396bCF95Db68003f86FB5'
+        push_tokens = ['push-token-1', 'push-token-2']
+        get_redis().delete(*[notification_coalescer._get_key(collapse_key, push_token) for push_token in push_tokens])
+
+        # Notifications never coalesced are sent
+        self.assertEqual(notification_coalescer.get_newest_push_tokens(collapse_key, push_tokens, 'not-existing'),
+                         push_tokens)
+
+        coalesce_id = notification_coalescer.coalesce(collapse_key, push_tokens)
+        self.assertEqual(notification_coalescer.get_newest_push_tokens(collapse_key, push_tokens, coalesce_id),
+                         push_tokens)
+        newer_coalesce_id = notification_coalescer.coalesce(collapse_key, push_tokens[:1])
+        self.assertEqual(notification_coalescer.get_newest_push_tokens(collapse_key, push_tokens, coalesce_id),
+                         push_tokens[1:])
+        self.assertEqual(notification_coalescer.get_newest_push_tokens(collapse_key, push_tokens[:1],
+                                                                       newer_coalesce_id),
+                         push_tokens[:1])
+        # Other collapse keys are not affected
+        self.assertEqual(notification_coalescer.get_newest_push_tokens('other', push_tokens, coalesce_id),
+                         push_tokens)
+
+    def test_coalesce_redis_error(self):
+        redis = mock.MagicMock()
+        redis.pipeline.return_value.execute.side_effect = RedisError
+        redis.mget.side_effect = RedisError
+        notification_coalescer = NotificationCoalescer(redis, 1.)
+        collapse_key = 'safeCreation:0x4D953115678b15CE0B0396bCF95Db68003f86FB5'
+        push_tokens = ['push-token-1', 'push-token-2']
+        # Notifications are sent without coalescing if Redis is not available
+        self.assertIsNone(notification_coalescer.coalesce(collapse_key, push_tokens))
+        self.assertEqual(notification_coalescer.get_newest_push_tokens(collapse_key, push_tokens, 'coalesce-id'),
+                         push_tokens)
+
+    def test_send_notification_to_devices_coalesced(self):
+        message = {
+            "type": 'confirmationRequest',
+            "safe": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        NotificationTypeFactory(name=message['type'], android=0, ios=0, extension=0, collapse_key='{type}:{safe}')
+        device = DeviceFactory()
+        collapse_key = 'confirmationRequest:0x4D953115678b15CE0B0396bCF95Db68003f86FB5'
+
+        with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+            send_notification_to_devices(message, [device.owner])
+            signature = publish_tasks_mock.call_args[0][0][0]
+            self.assertEqual(signature.kwargs, {'collapse_key': collapse_key, 'client': device.client})
+            self.assertNotIn('countdown', signature.options)
+
+            with self.settings(NOTIFICATION_COALESCE_WINDOW_SECONDS=2.):
+                NotificationCoalescerProvider.del_singleton()
+                send_notification_to_devices(message, [device.owner])
+                older_signature = publish_tasks_mock.call_args[0][0][0]
+                self.assertEqual(older_signature.options['countdown'], 2.)
+                send_notification_to_devices(message, [device.owner])
+                newer_signature = publish_tasks_mock.call_args[0][0][0]
+
+                # Notification is sent without delay if it cannot be coalesced
+                with mock.patch.object(NotificationCoalescer, 'coalesce', return_value=None):
+                    send_notification_to_devices(message, [device.owner])
+                    signature = publish_tasks_mock.call_args[0][0][0]
+                    self.assertEqual(signature.kwargs, {'collapse_key': collapse_key, 'client': device.client})
+                    self.assertNotIn('countdown', signature.options)
+            NotificationCoalescerProvider.del_singleton()
+
+        with mock.patch.object(NotificationService, 'send_notification',
+                               return_value='MockedResponse') as send_notification_mock:
+            self.assertIsNone(send_notification_task.apply(older_signature.args, older_signature.kwargs).get())
+            send_notification_mock.assert_not_called()
+            self.assertEqual(send_notification_task.apply(newer_signature.args, newer_signature.kwargs).get(),
+                             'MockedResponse')
+            send_notification_mock.assert_called_once_with(message, device.push_token, ttl=None,
+                                                           collapse_key=collapse_key, client=device.client)
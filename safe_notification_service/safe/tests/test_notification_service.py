@@ -1,7 +1,17 @@
+from unittest import mock
+
 from django.test import TestCase
 
+from firebase_admin.exceptions import InvalidArgumentError, UnavailableError
+from firebase_admin.messaging import (BatchResponse, QuotaExceededError,
+                                      SendResponse, UnregisteredError)
+from requests import Response
+
 from ..models import DeviceTypeEnum
 from ..services import NotificationServiceProvider
+from ..services.notification_service import (InvalidPushToken,
+                                             PermanentMessagingException,
+                                             RetriableMessagingException)
 from .factories import (DeviceFactory, DevicePairFactory,
                         NotificationTypeFactory)
 
@@ -97,3 +107,99 @@ class TestNotificationService(TestCase):
             self.assertCountEqual(notification_service.get_enabled_devices(message, device_owners,
                                                                            signer_address=signer_address),
                                   [])
+
+    def test_get_enabled_devices_pending_verification(self):
+        notification_service = NotificationServiceProvider()
+        message = {'type': 'safeCreation'}
+        device = DeviceFactory()
+        pending_device = DeviceFactory(pending_verification=True)
+        signer_device = DeviceFactory()
+        for authorizing_device in (device, pending_device):
+            DevicePairFactory(authorizing_device=authorizing_device, authorized_device=signer_device)
+        device_owners = [device.owner, pending_device.owner]
+
+        for signer_address in (None, signer_device.owner):
+            with self.settings(PUSH_TOKEN_PENDING_VERIFICATION_NOTIFY=True):
+                self.assertCountEqual(notification_service.get_enabled_devices(message, device_owners,
+                                                                               signer_address=signer_address),
+                                      [device, pending_device])
+            with self.settings(PUSH_TOKEN_PENDING_VERIFICATION_NOTIFY=False):
+                self.assertCountEqual(notification_service.get_enabled_devices(message, device_owners,
+                                                                               signer_address=signer_address),
+                                      [device])
+
+    def test_send_multicast_notification(self):
+        notification_service = NotificationServiceProvider()
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        push_tokens = ['valid-token', 'unregistered-token', 'unavailable-token', 'invalid-argument-token']
+        batch_response = BatchResponse([
+            SendResponse({'name': 'message-id'}, None),
+            SendResponse(None, UnregisteredError('Requested entity was not found')),
+            SendResponse(None, UnavailableError('Service unavailable')),
+            SendResponse(None, InvalidArgumentError('Invalid argument')),
+        ])
+        with mock.patch.object(notification_service.messaging_client, 'send_multicast_message',
+                               return_value=batch_response):
+            multicast_result = notification_service.send_multicast_notification(message, push_tokens)
+        self.assertEqual(multicast_result.message_ids, {'valid-token': 'message-id'})
+        self.assertEqual(multicast_result.invalid_push_tokens, ['unregistered-token'])
+        self.assertEqual(multicast_result.failed_push_tokens, ['unavailable-token'])
+        self.assertIsNone(multicast_result.retry_after)
+
+        with mock.patch.object(notification_service.messaging_client, 'send_multicast_message',
+                               side_effect=UnavailableError('Service unavailable')):
+            with self.assertRaises(RetriableMessagingException):
+                notification_service.send_multicast_notification(message, push_tokens)
+
+    def test_send_notification_errors(self):
+        notification_service = NotificationServiceProvider()
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        push_token = 'test-123'
+        http_response = Response()
+        http_response.status_code = 429
+        http_response.headers['Retry-After'] = '120'
+        for side_effect, expected_exception in (
+            (UnregisteredError('Requested entity was not found'), InvalidPushToken),
+            (QuotaExceededError('Quota exceeded', http_response=http_response), RetriableMessagingException),
+            (UnavailableError('Service unavailable'), RetriableMessagingException),
+            (InvalidArgumentError('Invalid argument'), PermanentMessagingException),
+            (ValueError('Invalid data'), PermanentMessagingException),
+        ):
+            with mock.patch.object(notification_service.messaging_client, 'send_message',
+                                   side_effect=side_effect):
+                with self.assertRaises(expected_exception) as context:
+                    notification_service.send_notification(message, push_token)
+                if isinstance(side_effect, QuotaExceededError):
+                    self.assertEqual(context.exception.retry_after, 120)
+
+    def test_send_notification_platform(self):
+        notification_service = NotificationServiceProvider()
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        push_token = 'test-123'
+        for client, ios, android in (
+            (None, True, True),
+            (DeviceTypeEnum.IOS.value, True, False),
+            (DeviceTypeEnum.ANDROID.value, False, True),
+            (DeviceTypeEnum.EXTENSION.value, False, True),
+        ):
+            with mock.patch.object(notification_service.messaging_client, 'send_message',
+                                   return_value='message-id') as send_message_mock:
+                self.assertEqual(notification_service.send_notification(message, push_token, client=client),
+                                 'message-id')
+                send_message_mock.assert_called_once_with(message, push_token, ttl=None, collapse_key=None,
+                                                          ios=ios, android=android)
+            # Multicast messages get the same platform config
+            with mock.patch.object(notification_service.messaging_client, 'send_multicast_message',
+                                   return_value=BatchResponse([])) as send_multicast_message_mock:
+                notification_service.send_multicast_notification(message, [push_token], client=client)
+                send_multicast_message_mock.assert_called_once_with(message, [push_token], ttl=None,
+                                                                    collapse_key=None, ios=ios, android=android)
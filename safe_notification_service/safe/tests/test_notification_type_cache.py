@@ -0,0 +1,99 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..models import DeviceTypeEnum, NotificationType
+from ..services import NotificationTypeCache, NotificationTypeCacheProvider
+from .factories import DeviceFactory, NotificationTypeFactory
+
+
+class TestNotificationTypeCache(TestCase):
+    def test_get_rule(self):
+        notification_type_cache = NotificationTypeCache(get_redis())
+        with self.settings(NOTIFICATION_TYPES_CACHE=True):
+            notification_type_cache.invalidate()
+            self.assertIsNone(notification_type_cache.get_rule('safeCreation'))
+            with self.assertNumQueries(0):
+                self.assertIsNone(notification_type_cache.get_rule('safeCreation'))
+
+            # Cache is invalidated when saved
+            notification_type = NotificationTypeFactory(name='safeCreation', android=5)
+            with self.assertNumQueries(1):
+                notification_type_rule = notification_type_cache.get_rule('safeCreation')
+            self.assertEqual(notification_type_rule, notification_type.get_rule())
+            with self.assertNumQueries(0):
+                self.assertEqual(notification_type_cache.get_rule('safeCreation'), notification_type_rule)
+
+            # Changes without signals are not detected
+            NotificationType.objects.update(android=7)
+            self.assertEqual(notification_type_cache.get_rule('safeCreation').min_build_numbers[
+                                 DeviceTypeEnum.ANDROID.value], 5)
+
+            # Invalidation from another process
+            get_redis().incr(NotificationTypeCache.VERSION_KEY)
+            self.assertEqual(notification_type_cache.get_rule('safeCreation').min_build_numbers[
+                                 DeviceTypeEnum.ANDROID.value], 7)
+
+            # Provider cache is invalidated too
+            NotificationTypeCacheProvider().get_rules()
+            notification_type.delete()
+            self.assertIsNone(notification_type_cache.get_rule('safeCreation'))
+            self.assertIsNone(NotificationTypeCacheProvider().get_rule('safeCreation'))
+
+    def test_get_rule_redis_error(self):
+        notification_type_cache = NotificationTypeCache(get_redis())
+        notification_type = NotificationTypeFactory(name='safeCreation', android=5)
+        with self.settings(NOTIFICATION_TYPES_CACHE=True):
+            with mock.patch.object(NotificationTypeCache, 'get_version', side_effect=RedisError):
+                # Database is used if Redis is not available
+                with self.assertNumQueries(1):
+                    self.assertEqual(notification_type_cache.get_rule('safeCreation'), notification_type.get_rule())
+
+        # Changes are saved if cache cannot be invalidated
+        redis = mock.MagicMock()
+        redis.incr.side_effect = RedisError
+        with mock.patch.object(NotificationTypeCacheProvider, 'instance', NotificationTypeCache(redis), create=True):
+            notification_type.android = 7
+            notification_type.save()
+            notification_type.delete()
+
+    def test_get_rule_invalidation_lost(self):
+        notification_type = NotificationTypeFactory(name='safeCreation', android=5)
+        notification_type_cache = NotificationTypeCache(get_redis(), timeout=10)
+        another_notification_type_cache = NotificationTypeCache(get_redis(), timeout=10)
+        with self.settings(NOTIFICATION_TYPES_CACHE=True):
+            with mock.patch('safe_notification_service.safe.services.notification_type_cache.time.monotonic',
+                            return_value=100.) as monotonic_mock:
+                self.assertEqual(another_notification_type_cache.get_rule('safeCreation'), notification_type.get_rule())
+
+                # Version cannot be incremented, so other processes keep the old rules
+                notification_type_cache.redis = mock.MagicMock()
+                notification_type_cache.redis.incr.side_effect = RedisError
+                with mock.patch.object(NotificationTypeCacheProvider, 'instance', notification_type_cache,
+                                       create=True):
+                    notification_type.android = 7
+                    notification_type.save()
+                self.assertEqual(another_notification_type_cache.get_rule('safeCreation').min_build_numbers[
+                                     DeviceTypeEnum.ANDROID.value], 5)
+
+                # Until the timeout
+                monotonic_mock.return_value = 110.
+                self.assertEqual(another_notification_type_cache.get_rule('safeCreation').min_build_numbers[
+                                     DeviceTypeEnum.ANDROID.value], 7)
+                with self.assertNumQueries(0):
+                    another_notification_type_cache.get_rule('safeCreation')
+
+    def test_notification_type_rule(self):
+        notification_type = NotificationTypeFactory(android=5, ios=None, extension=0)
+        notification_type_rule = notification_type.get_rule()
+        for device, expected in ((DeviceFactory(client=DeviceTypeEnum.ANDROID.value, build_number=4), False),
+                                 (DeviceFactory(client=DeviceTypeEnum.ANDROID.value, build_number=5), True),
+                                 (DeviceFactory(client=DeviceTypeEnum.IOS.value, build_number=5), False),
+                                 (DeviceFactory(client=DeviceTypeEnum.EXTENSION.value, build_number=0), True),
+                                 (DeviceFactory(client=None, build_number=10), False)):
+            self.assertEqual(notification_type_rule.matches_device(device), expected)
+            self.assertEqual(notification_type.matches_device(device), expected)
@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+from unittest import mock
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from eth_account import Account
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..models import Device
+from ..services import PairingCache, PushTokenReaper
+from .factories import DeviceFactory, DevicePairFactory
+
+
+@contextmanager
+def refill_pairing_cache_on_invalidate():
+    """
+    Simulate other processes filling the pairing cache again right after every invalidation, so the cache keeps old
+    data if it's invalidated before the changes are written
+    """
+    invalidate = PairingCache.invalidate
+
+    def invalidate_and_refill(pairing_cache: PairingCache, signer_addresses):
+        signer_addresses = list(signer_addresses)
+        invalidate(pairing_cache, signer_addresses)
+        for signer_address in signer_addresses:
+            pairing_cache.get_paired_devices(signer_address)
+
+    with mock.patch.object(PairingCache, 'invalidate', autospec=True, side_effect=invalidate_and_refill):
+        yield
+
+
+class TestPairingCache(TestCase):
+    def test_get_paired_devices(self):
+        pairing_cache = PairingCache(get_redis(), timeout=60, local_timeout=60)
+        signer_device = DeviceFactory()
+        signer_address = signer_device.owner
+        pairing_cache.invalidate([signer_address])
+        with self.settings(PAIRING_CACHE=True):
+            self.assertEqual(pairing_cache.get_paired_devices(signer_address), [])
+
+            device_pair = DevicePairFactory(authorized_device=signer_device)
+            DevicePairFactory(authorized_device=signer_device, authorizing_device__push_token=None)
+            # Cache was not invalidated
+            self.assertEqual(pairing_cache.get_paired_devices(signer_address), [])
+
+            pairing_cache.invalidate([signer_address])
+            with self.assertNumQueries(1):
+                paired_devices = pairing_cache.get_paired_devices(signer_address)
+            self.assertEqual(len(paired_devices), 1)
+            authorizing_device = device_pair.authorizing_device
+            self.assertEqual((paired_devices[0].owner, paired_devices[0].push_token, paired_devices[0].client,
+                              paired_devices[0].build_number),
+                             (authorizing_device.owner, authorizing_device.push_token, authorizing_device.client,
+                              authorizing_device.build_number))
+
+            # Process cache
+            with self.assertNumQueries(0):
+                self.assertEqual(pairing_cache.get_paired_devices(signer_address), paired_devices)
+
+            # Redis cache
+            another_pairing_cache = PairingCache(get_redis(), timeout=60, local_timeout=0)
+            with self.assertNumQueries(0):
+                paired_devices = another_pairing_cache.get_paired_devices(signer_address)
+            self.assertEqual([device.push_token for device in paired_devices], [authorizing_device.push_token])
+
+            # Paired devices are invalidated when push token is removed
+            get_redis().delete(PushTokenReaper.FLUSH_LOCK_KEY)
+            PushTokenReaper(get_redis(), flush_interval=60, batch_size=10).add_invalid_push_tokens(
+                [authorizing_device.push_token]
+            )
+            self.assertEqual(another_pairing_cache.get_paired_devices(signer_address), [])
+
+    def test_get_paired_devices_disabled(self):
+        pairing_cache = PairingCache(get_redis(), timeout=60, local_timeout=60)
+        device_pair = DevicePairFactory()
+        signer_address = device_pair.authorized_device.owner
+        with self.settings(PAIRING_CACHE=False):
+            for _ in range(2):
+                with self.assertNumQueries(1):
+                    self.assertEqual(len(pairing_cache.get_paired_devices(signer_address)), 1)
+
+    def test_get_paired_devices_redis_error(self):
+        redis = mock.MagicMock()
+        redis.get.side_effect = RedisError
+        redis.delete.side_effect = RedisError
+        pairing_cache = PairingCache(redis, timeout=60, local_timeout=0)
+        device_pair = DevicePairFactory()
+        signer_address = device_pair.authorized_device.owner
+        with self.settings(PAIRING_CACHE=True):
+            # Invalidation doesn't raise and database is used
+            pairing_cache.invalidate([signer_address])
+            with self.assertNumQueries(1):
+                paired_devices = pairing_cache.get_paired_devices(signer_address)
+            self.assertEqual([device.push_token for device in paired_devices],
+                             [device_pair.authorizing_device.push_token])
+
+            redis.get.side_effect = None
+            redis.get.return_value = None
+            redis.set.side_effect = RedisError
+            self.assertEqual(len(pairing_cache.get_paired_devices(signer_address)), 1)
+
+    def test_invalidate_devices(self):
+        pairing_cache = PairingCache(get_redis(), timeout=60, local_timeout=60)
+        authorizing_device = DeviceFactory()
+        signer_addresses = [DevicePairFactory(authorizing_device=authorizing_device).authorized_device.owner
+                            for _ in range(2)]
+        not_paired_address = Account.create().address
+        with self.settings(PAIRING_CACHE=True):
+            pairing_cache.invalidate(signer_addresses + [not_paired_address])
+            for signer_address in signer_addresses:
+                self.assertEqual(len(pairing_cache.get_paired_devices(signer_address)), 1)
+
+            Device.objects.filter(owner=authorizing_device.owner).update(push_token=None)
+            pairing_cache.invalidate_devices([authorizing_device.owner])
+            for signer_address in signer_addresses:
+                self.assertEqual(pairing_cache.get_paired_devices(signer_address), [])
+
+
+class TestPairingCacheWithoutTransaction(TransactionTestCase):
+    def test_invalidate_without_transaction(self):
+        pairing_cache = PairingCache(get_redis(), timeout=60, local_timeout=0)
+        device_pair = DevicePairFactory()
+        authorizing_device = device_pair.authorizing_device
+        signer_address = device_pair.authorized_device.owner
+        pairing_cache.invalidate([signer_address])
+        with self.settings(PAIRING_CACHE=True):
+            self.assertEqual(len(pairing_cache.get_paired_devices(signer_address)), 1)
+
+            # Writes are committed right away, so cache is invalidated once after them
+            with refill_pairing_cache_on_invalidate():
+                Device.objects.filter(owner=authorizing_device.owner).update(push_token=None)
+                with mock.patch.object(transaction, 'on_commit') as on_commit_mock:
+                    pairing_cache.invalidate_devices([authorizing_device.owner])
+                    on_commit_mock.assert_not_called()
+            self.assertEqual(pairing_cache.get_paired_devices(signer_address), [])
+
+            # In a transaction, cache is invalidated again when committed
+            with transaction.atomic():
+                Device.objects.filter(owner=authorizing_device.owner).update(push_token='new-push-token')
+                pairing_cache.invalidate_devices([authorizing_device.owner])
+                # Other processes don't see the change yet
+                get_redis().set(pairing_cache._get_key(signer_address), '[]')
+            self.assertEqual([device.push_token for device in pairing_cache.get_paired_devices(signer_address)],
+                             ['new-push-token'])
@@ -0,0 +1,105 @@
+from unittest import mock
+
+from django.test import TestCase, TransactionTestCase
+
+from redis.exceptions import RedisError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..models import Device
+from ..services import PairingCache, PushTokenReaper
+from ..tasks import flush_invalid_push_tokens_task
+from .factories import DeviceFactory, DevicePairFactory
+from .test_pairing_cache import refill_pairing_cache_on_invalidate
+
+
+class TestPushTokenReaper(TestCase):
+    def setUp(self):
+        self.redis = get_redis()
+        self.redis.delete(PushTokenReaper.PENDING_PUSH_TOKENS_KEY, PushTokenReaper.FLUSH_LOCK_KEY)
+
+    def test_add_invalid_push_tokens(self):
+        push_token_reaper = PushTokenReaper(self.redis, flush_interval=60, batch_size=3)
+        devices = [DeviceFactory() for _ in range(6)]
+        self.assertEqual(push_token_reaper.add_invalid_push_tokens([]), 0)
+
+        # First invalid push token triggers a flush, and another one is scheduled for when the interval elapses
+        with mock.patch.object(flush_invalid_push_tokens_task, 'apply_async') as apply_async_mock:
+            self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[0].push_token]), 1)
+            apply_async_mock.assert_called_once_with(countdown=60)
+        self.assertIsNone(Device.objects.get(owner=devices[0].owner).push_token)
+
+        # Next ones will wait for the flush interval
+        self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[1].push_token]), 0)
+        self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[1].push_token]), 0)
+        self.assertIsNotNone(Device.objects.get(owner=devices[1].owner).push_token)
+
+        # Unless `batch_size` is reached
+        self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[2].push_token,
+                                                                    devices[3].push_token]), 3)
+        self.assertEqual(Device.objects.filter(push_token=None).count(), 4)
+
+        # Flush interval elapsed
+        self.redis.delete(PushTokenReaper.FLUSH_LOCK_KEY)
+        self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[4].push_token]), 1)
+        self.assertEqual(Device.objects.filter(push_token=None).count(), 5)
+
+        # Scheduled flush reaps the ones added while flush lock is held, even if no more are added
+        self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[5].push_token]), 0)
+        with mock.patch('safe_notification_service.safe.tasks.PushTokenReaperProvider',
+                        return_value=push_token_reaper):
+            self.assertEqual(flush_invalid_push_tokens_task.delay().get(), 1)
+        self.assertEqual(Device.objects.filter(push_token=None).count(), 6)
+
+    def test_flush_error(self):
+        push_token_reaper = PushTokenReaper(self.redis, flush_interval=60, batch_size=3)
+        device = DeviceFactory()
+        self.redis.sadd(PushTokenReaper.PENDING_PUSH_TOKENS_KEY, device.push_token)
+        with mock.patch.object(PushTokenReaper, 'reap', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                push_token_reaper.flush()
+        # Push token is kept pending and reaped on next flush
+        self.assertTrue(self.redis.sismember(PushTokenReaper.PENDING_PUSH_TOKENS_KEY, device.push_token))
+        self.assertEqual(push_token_reaper.flush(), 1)
+        self.assertIsNone(Device.objects.get(owner=device.owner).push_token)
+
+    def test_add_invalid_push_tokens_redis_error(self):
+        redis = mock.MagicMock()
+        redis.pipeline.return_value.__enter__.return_value.execute.side_effect = RedisError
+        push_token_reaper = PushTokenReaper(redis, flush_interval=60, batch_size=3)
+        devices = [DeviceFactory() for _ in range(2)]
+        # Push tokens are reaped right now if they cannot be queued
+        self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[0].push_token]), 1)
+        self.assertIsNone(Device.objects.get(owner=devices[0].owner).push_token)
+
+        # Errors are not raised, as notifications were already sent
+        with mock.patch.object(PushTokenReaper, 'reap', side_effect=ConnectionError):
+            self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[1].push_token]), 0)
+
+        # Push tokens queued are kept pending if flush fails
+        push_token_reaper = PushTokenReaper(self.redis, flush_interval=60, batch_size=3)
+        with mock.patch.object(PushTokenReaper, 'reap', side_effect=ConnectionError):
+            with mock.patch.object(flush_invalid_push_tokens_task, 'apply_async') as apply_async_mock:
+                self.assertEqual(push_token_reaper.add_invalid_push_tokens([devices[1].push_token]), 0)
+                apply_async_mock.assert_called_once_with(countdown=60)
+        self.assertTrue(self.redis.sismember(PushTokenReaper.PENDING_PUSH_TOKENS_KEY, devices[1].push_token))
+
+
+class TestPushTokenReaperWithoutTransaction(TransactionTestCase):
+    def test_reap_pairing_cache(self):
+        device_pair = DevicePairFactory()
+        push_token = device_pair.authorizing_device.push_token
+        signer_address = device_pair.authorized_device.owner
+        pairing_cache = PairingCache(get_redis(), timeout=60, local_timeout=0)
+        with self.settings(PAIRING_CACHE=True):
+            with mock.patch('safe_notification_service.safe.services.push_token_reaper.PairingCacheProvider',
+                            return_value=pairing_cache):
+                pairing_cache.invalidate([signer_address])
+                self.assertEqual(len(pairing_cache.get_paired_devices(signer_address)), 1)
+
+                # Reaped push token is not notified anymore, even if other processes fill the cache meanwhile
+                with refill_pairing_cache_on_invalidate():
+                    self.assertEqual(PushTokenReaper(get_redis(), flush_interval=60, batch_size=10).reap(
+                        [push_token]
+                    ), 1)
+                self.assertEqual(pairing_cache.get_paired_devices(signer_address), [])
@@ -0,0 +1,54 @@
+import time
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from redis.exceptions import ConnectionError
+
+from safe_notification_service.utils.redis import get_redis
+
+from ..services import RateLimiter
+from ..throttling import check_throttle_rates, parse_rate
+
+
+class TestRateLimiter(TestCase):
+    def test_consume(self):
+        rate_limiter = RateLimiter(get_redis())
+        keys = ['test:1', 'test:2']
+        get_redis().delete(*[rate_limiter.KEY_PREFIX + key for key in keys])
+
+        self.assertIsNone(rate_limiter.consume([], 1, 1.))
+        for _ in range(3):
+            self.assertIsNone(rate_limiter.consume(keys[:1], 3, 0.1))
+        wait = rate_limiter.consume(keys[:1], 3, 0.1)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 10)
+
+        # Tokens are not taken from any bucket if one of them is empty
+        self.assertIsNotNone(rate_limiter.consume(keys, 3, 0.1))
+        for _ in range(3):
+            self.assertIsNone(rate_limiter.consume(keys[1:], 3, 0.1))
+
+        # Buckets are refilled
+        time.sleep(0.01)
+        self.assertIsNone(rate_limiter.consume(['test:1'], 3, 1000.))
+
+    def test_consume_redis_not_available(self):
+        rate_limiter = RateLimiter(get_redis())
+        with mock.patch.object(rate_limiter, '_token_bucket_script', side_effect=ConnectionError()):
+            self.assertIsNone(rate_limiter.consume(['test:1'], 1, 1.))
+
+    def test_check_throttle_rates(self):
+        self.assertEqual(parse_rate('60/minute'), (60, 60))
+        self.assertEqual(parse_rate('1/s'), (1, 1))
+        self.assertEqual(parse_rate('2/day'), (2, 60 * 60 * 24))
+        for rate in ('60', '60/week', '60/', 'a/minute', '0/minute', '1/2/minute'):
+            with self.assertRaises(ImproperlyConfigured):
+                parse_rate(rate)
+
+        with self.settings(THROTTLE_IP_RATE='60/minute', THROTTLE_SIGNER_RATE=None):
+            check_throttle_rates()
+        with self.settings(THROTTLE_IP_RATE='60/minute', THROTTLE_SIGNER_RATE='60/week'):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'THROTTLE_SIGNER_RATE'):
+                check_throttle_rates()
@@ -1,8 +1,23 @@
+import time
+from unittest import mock
+
+from celery.exceptions import Retry
 from rest_framework.test import APITestCase
 
-from safe_notification_service.safe.models import DeviceTypeEnum
+from safe_notification_service.safe.models import (DeviceTypeEnum,
+                                                   NotificationOutbox,
+                                                   NotificationPriorityEnum)
 
-from ..tasks import send_notification_task, send_notification_to_devices
+from ..services.auth_service import AuthService
+from ..services.notification_coalescer import NotificationCoalescer
+from ..services.notification_service import (NotificationService,
+                                             RetriableMessagingException)
+from ..services.notification_type_cache import NotificationTypeCache
+from ..tasks import (dispatch_notification, dispatch_notification_task,
+                     get_retry_countdown, relay_notification_outbox,
+                     send_multicast_notification_task, send_notification_task,
+                     send_notification_to_devices,
+                     verify_pending_push_tokens_task)
 from .factories import (DeviceFactory, DevicePairFactory,
                         NotificationTypeFactory)
 
@@ -78,3 +93,229 @@ class TestTasks(APITestCase):
 
         self.assertEqual(send_notification_task.delay(message, push_token).get(),
                          'MockedResponse')
+
+    def test_send_notification_task_expired(self):
+        message = {
+            "type": 'sendTransaction',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        push_token = 'test-123'
+
+        self.assertEqual(send_notification_task.delay(message, push_token, expires_at=time.time() + 60).get(),
+                         'MockedResponse')
+        with mock.patch.object(NotificationService, 'send_notification') as send_notification_mock:
+            self.assertIsNone(send_notification_task.delay(message, push_token, expires_at=time.time() - 1).get())
+            self.assertEqual(send_multicast_notification_task.delay(message, [push_token],
+                                                                    expires_at=time.time() - 1).get(), {})
+            send_notification_mock.assert_not_called()
+
+        # `expires_at` is set from the `NotificationType` ttl
+        device = DeviceFactory()
+        with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+            send_notification_to_devices(message, [device.owner])
+            self.assertNotIn('expires_at', publish_tasks_mock.call_args[0][0][0].kwargs)
+
+            NotificationTypeFactory(name=message['type'], android=0, ios=0, extension=0, ttl=600)
+            send_notification_to_devices(message, [device.owner])
+            expires_at = publish_tasks_mock.call_args[0][0][0].kwargs['expires_at']
+            self.assertAlmostEqual(expires_at, time.time() + 600, delta=5)
+
+    def test_dispatch_notification_expiration(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        NotificationTypeFactory(name=message['type'], android=0, ios=0, extension=0, ttl=600)
+        device = DeviceFactory()
+        with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+            # Expiration is calculated when dispatch is enqueued, not when it's run
+            dispatch_notification(message, [device.owner])
+            expires_at = publish_tasks_mock.call_args[0][0][0].kwargs['expires_at']
+            self.assertAlmostEqual(expires_at, time.time() + 600, delta=5)
+
+            self.assertEqual(dispatch_notification_task(message, [device.owner], expires_at=expires_at), 1)
+            self.assertEqual(publish_tasks_mock.call_args[0][0][0].kwargs['expires_at'], expires_at)
+
+            publish_tasks_mock.reset_mock()
+            self.assertEqual(dispatch_notification_task(message, [device.owner], expires_at=time.time() - 1), 0)
+            publish_tasks_mock.assert_not_called()
+
+    def test_send_notification_to_devices_rule_resolved_once(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        NotificationTypeFactory(name=message['type'], android=0, ios=0, extension=0, ttl=600,
+                                priority=NotificationPriorityEnum.HIGH.value, collapse_key='{address}')
+        device = DeviceFactory()
+        with self.settings(NOTIFICATION_PRIORITY_QUEUES=True):
+            with mock.patch.object(NotificationTypeCache, 'get_rules', autospec=True,
+                                   side_effect=NotificationTypeCache.get_rules) as get_rules_mock:
+                with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+                    send_notification_to_devices(message, [device.owner])
+                    get_rules_mock.assert_called_once()
+                    signature = publish_tasks_mock.call_args[0][0][0]
+                    self.assertIn('expires_at', signature.kwargs)
+                    self.assertEqual(signature.kwargs['collapse_key'], message['address'])
+                    self.assertEqual(signature.options['queue'], NotificationPriorityEnum.HIGH.queue)
+
+    def test_send_notification_to_devices_multicast(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        devices = [DeviceFactory() for _ in range(5)]
+        device_owners = [device.owner for device in devices]
+
+        with self.settings(NOTIFICATION_MULTICAST=True, NOTIFICATION_MULTICAST_MAX_TOKENS=2):
+            with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+                self.assertCountEqual(send_notification_to_devices(message, device_owners), devices)
+                publish_tasks_mock.assert_called_once()
+                signatures = publish_tasks_mock.call_args[0][0]
+                self.assertEqual(len(signatures), 3)
+                self.assertTrue(all(signature.task == send_multicast_notification_task.name
+                                    for signature in signatures))
+                sent_push_tokens = [push_token for signature in signatures for push_token in signature.args[1]]
+                self.assertCountEqual(sent_push_tokens, [device.push_token for device in devices])
+
+    def test_send_notification_to_devices_multicast_by_client(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        devices = [DeviceFactory(client=client.value) for client in DeviceTypeEnum for _ in range(2)]
+        devices.append(DeviceFactory(client=None))
+        device_owners = [device.owner for device in devices]
+
+        with self.settings(NOTIFICATION_MULTICAST=True):
+            with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+                self.assertCountEqual(send_notification_to_devices(message, device_owners), devices)
+                signatures = publish_tasks_mock.call_args[0][0]
+                self.assertEqual(len(signatures), len(DeviceTypeEnum) + 1)
+                for signature in signatures:
+                    self.assertCountEqual(signature.args[1], [device.push_token for device in devices
+                                                              if device.client == signature.kwargs['client']])
+
+    def test_send_notification_to_devices_same_push_token(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        push_token = 'shared-push-token'
+        devices = [DeviceFactory(push_token=push_token, build_number=10) for _ in range(3)]
+        device_owners = [device.owner for device in devices]
+
+        with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+            self.assertCountEqual(send_notification_to_devices(message, device_owners), devices)
+            publish_tasks_mock.assert_called_once_with([send_notification_task.s(
+                message, push_token, client=DeviceTypeEnum.ANDROID.value)])
+
+        # Filtering by `NotificationType` is still done per owner
+        NotificationTypeFactory(name=message['type'], android=11)
+        devices[0].build_number = 11
+        devices[0].save(update_fields=['build_number'])
+        with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+            self.assertEqual(send_notification_to_devices(message, device_owners), [devices[0]])
+            publish_tasks_mock.assert_called_once_with([send_notification_task.s(
+                message, push_token, client=DeviceTypeEnum.ANDROID.value)])
+
+    def test_send_multicast_notification_task(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        push_tokens = ['test-123', 'test-456']
+
+        self.assertEqual(send_multicast_notification_task.delay(message, push_tokens).get(),
+                         {push_token: 'MockedResponse' for push_token in push_tokens})
+
+    def test_send_multicast_notification_task_retry(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        push_tokens = ['test-123', 'test-456', 'test-789']
+        with mock.patch.object(NotificationCoalescer, 'get_newest_push_tokens', return_value=push_tokens[1:]):
+            with mock.patch.object(NotificationService, 'send_multicast_notification',
+                                   side_effect=RetriableMessagingException('Unavailable')):
+                with mock.patch.object(send_multicast_notification_task, 'retry', side_effect=Retry) as retry_mock:
+                    send_multicast_notification_task.apply((message, push_tokens),
+                                                           {'collapse_key': 'safeCreation',
+                                                            'coalesce_id': 'coalesce-id'})
+                    retry_mock.assert_called_once()
+                    # Push tokens replaced by a newer notification are not retried
+                    self.assertEqual(retry_mock.call_args[1]['args'], (message, push_tokens[1:]))
+
+    def test_get_retry_countdown(self):
+        with self.settings(NOTIFICATION_RETRY_DELAY_SECONDS=10, NOTIFICATION_RETRY_MAX_DELAY_SECONDS=60):
+            for retries, (min_countdown, max_countdown) in enumerate([(5, 10), (10, 20), (20, 40), (30, 60),
+                                                                      (30, 60)]):
+                countdown = get_retry_countdown(retries)
+                self.assertGreaterEqual(countdown, min_countdown)
+                self.assertLessEqual(countdown, max_countdown)
+
+            # `Retry-After` is honored
+            self.assertEqual(get_retry_countdown(0, retry_after=120), 120)
+
+    def test_notification_outbox(self):
+        message = {
+            "type": 'safeCreation',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        devices = [DeviceFactory() for _ in range(3)]
+        device_owners = [device.owner for device in devices]
+
+        with self.settings(NOTIFICATION_OUTBOX=True):
+            with mock.patch.object(send_notification_task, 'run') as run_mock:
+                self.assertCountEqual(send_notification_to_devices(message, device_owners), devices)
+                run_mock.assert_not_called()
+                self.assertEqual(NotificationOutbox.objects.count(), 3)
+                outbox_task = NotificationOutbox.objects.first()
+                self.assertEqual(outbox_task.task_name, send_notification_task.name)
+                self.assertEqual(outbox_task.args[0], message)
+
+                self.assertEqual(relay_notification_outbox(2), 2)
+                self.assertEqual(relay_notification_outbox(2), 1)
+                self.assertEqual(relay_notification_outbox(2), 0)
+                self.assertEqual(run_mock.call_count, 3)
+                self.assertCountEqual([call[0][1] for call in run_mock.call_args_list],
+                                      [device.push_token for device in devices])
+                self.assertEqual(NotificationOutbox.objects.count(), 0)
+
+    def test_send_notification_to_devices_priority_queues(self):
+        message = {
+            "type": 'sendTransaction',
+            "address": "0x4D953115678b15CE0B0396bCF95Db68003f86FB5",
+        }
+        device = DeviceFactory()
+
+        with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+            send_notification_to_devices(message, [device.owner])
+            signature = publish_tasks_mock.call_args[0][0][0]
+            self.assertNotIn('queue', signature.options)
+
+            with self.settings(NOTIFICATION_PRIORITY_QUEUES=True):
+                send_notification_to_devices(message, [device.owner])
+                signature = publish_tasks_mock.call_args[0][0][0]
+                self.assertEqual(signature.options['queue'], NotificationPriorityEnum.NORMAL.queue)
+
+                NotificationTypeFactory(name=message['type'], android=0, ios=0, extension=0,
+                                        priority=NotificationPriorityEnum.HIGH.value)
+                send_notification_to_devices(message, [device.owner])
+                signature = publish_tasks_mock.call_args[0][0][0]
+                self.assertEqual(signature.options['queue'], 'notifications-high')
+
+    def test_verify_pending_push_tokens_task(self):
+        with self.settings(PUSH_TOKEN_VERIFICATION_BATCH_SIZE=2):
+            with mock.patch.object(AuthService, 'verify_pending_push_tokens',
+                                   side_effect=[2, 1]) as verify_pending_push_tokens_mock:
+                self.assertEqual(verify_pending_push_tokens_task.delay().get(), 3)
+                self.assertEqual(verify_pending_push_tokens_mock.call_count, 2)
+
+            # Task is retried if verification fails
+            with mock.patch.object(AuthService, 'verify_pending_push_tokens', side_effect=ConnectionError):
+                with mock.patch.object(verify_pending_push_tokens_task, 'retry', side_effect=Retry) as retry_mock:
+                    verify_pending_push_tokens_task.apply()
+                    retry_mock.assert_called_once()
+                    self.assertIsInstance(retry_mock.call_args[1]['exc'], ConnectionError)
+                    self.assertGreater(retry_mock.call_args[1]['countdown'], 0)
@@ -1,5 +1,7 @@
 import json
+from unittest import mock
 
+from django.conf import settings
 from django.urls import reverse
 
 from eth_account import Account
@@ -9,8 +11,11 @@ from rest_framework.test import APITestCase
 
 from safe_notification_service.ether.tests.factories import \
     get_eth_address_with_key
+from safe_notification_service.utils.redis import get_redis
 
 from ..models import Device, DevicePair
+from ..serializers import NotificationSerializer
+from ..tasks import dispatch_notification_task
 from .factories import (DeviceFactory, DevicePairFactory, get_auth_mock_data,
                         get_notification_mock_data, get_pairing_mock_data,
                         get_signature_json)
@@ -85,6 +90,23 @@ class TestViews(APITestCase):
         self.assertIsNone(Device.objects.get(owner=another_device_account.address).push_token)
         self.assertIsNone(Device.objects.get(owner=device_account.address).push_token)
 
+    def test_pairing_queries(self):
+        owner = Account.create().address
+        another_owner = DeviceFactory().owner
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                device_pair = DevicePair.objects.create_pairing(owner, another_owner)
+            self.assertEqual(device_pair.authorizing_device_id, owner)
+            self.assertEqual(device_pair.authorized_device_id, another_owner)
+            self.assertEqual(DevicePair.objects.count(), 2)
+        self.assertIsNone(Device.objects.get(owner=owner).push_token)
+        self.assertIsNotNone(Device.objects.get(owner=another_owner).push_token)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(DevicePair.objects.delete_pairing(another_owner, owner), 2)
+        self.assertEqual(DevicePair.objects.count(), 0)
+        self.assertEqual(Device.objects.count(), 2)
+
     def test_pairing_deletion(self):
         another_device_account = Account.create()
         device_account = Account.create()
@@ -168,3 +190,99 @@ class TestViews(APITestCase):
             data['password'] = 'test'
             response = self.client.post(reverse('v1:simple-notifications'), data=data, format='json')
             self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_notification_creation_dispatch_async(self):
+        data = get_notification_mock_data()
+        device_pair = DevicePairFactory()
+        simple_data = {
+            'devices': [device_pair.authorizing_device.owner],
+            'message': '{}',
+        }
+        with self.settings(NOTIFICATION_DISPATCH_ASYNC=True):
+            with mock.patch('safe_notification_service.safe.tasks.publish_tasks') as publish_tasks_mock:
+                # Devices are not resolved, so `404` is not returned
+                response = self.client.post(reverse('v1:notifications'), data=data, format='json',
+                                            HTTP_PREFER='respond-async')
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+                self.assertEqual(response['Preference-Applied'], 'respond-async')
+                publish_tasks_mock.assert_called_once_with([dispatch_notification_task.s(
+                    json.loads(data['message']), data['devices'], mock.ANY
+                )])
+
+                response = self.client.post(reverse('v1:simple-notifications'), data=simple_data, format='json',
+                                            HTTP_PREFER='return=minimal, respond-async; wait=0')
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+                publish_tasks_mock.assert_called_with([dispatch_notification_task.s({}, simple_data['devices'], None)])
+
+                # Callers not opting in keep the synchronous responses
+                response = self.client.post(reverse('v1:notifications'), data=data, format='json')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+                self.assertNotIn('Preference-Applied', response)
+                response = self.client.post(reverse('v1:simple-notifications'), data=simple_data, format='json')
+                self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+                response = self.client.post(reverse('v1:simple-notifications'),
+                                            data={**simple_data, 'devices': [Account.create().address]},
+                                            format='json')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # Asynchronous dispatch is only used if enabled
+        response = self.client.post(reverse('v1:notifications'), data=data, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertEqual(dispatch_notification_task(json.loads(data['message']), data['devices']), 0)
+        self.assertEqual(dispatch_notification_task({}, simple_data['devices']), 1)
+
+    def test_notification_throttling(self):
+        account = Account.create()
+        redis = get_redis()
+        redis.delete('rate-limit:ip:127.0.0.1', f'rate-limit:signer:{account.address}')
+        with self.settings(THROTTLE_IP_RATE='2/minute'):
+            for _ in range(2):
+                response = self.client.post(reverse('v1:notifications'), data=get_notification_mock_data(),
+                                            format='json')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            # Rejected before validating the request
+            with mock.patch.object(NotificationSerializer, 'is_valid') as is_valid_mock:
+                response = self.client.post(reverse('v1:notifications'), data=get_notification_mock_data(),
+                                            format='json')
+                is_valid_mock.assert_not_called()
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertGreater(int(response['Retry-After']), 0)
+        redis.delete('rate-limit:ip:127.0.0.1')
+
+        with self.settings(THROTTLE_SIGNER_RATE='2/minute'):
+            for _ in range(2):
+                response = self.client.post(reverse('v1:notifications'),
+                                            data=get_notification_mock_data(account=account), format='json')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.post(reverse('v1:notifications'),
+                                        data=get_notification_mock_data(account=account), format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn('Retry-After', response)
+            # Other signers are not throttled
+            response = self.client.post(reverse('v1:notifications'), data=get_notification_mock_data(),
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_notification_throttling_forwarded_for(self):
+        redis = get_redis()
+        redis.delete('rate-limit:ip:10.0.0.1', 'rate-limit:ip:127.0.0.1')
+        # By default `X-Forwarded-For` is ignored, as it could be spoofed if service is reached directly
+        with self.settings(THROTTLE_IP_RATE='2/minute'):
+            for _ in range(3):
+                response = self.client.post(reverse('v1:notifications'), data=get_notification_mock_data(),
+                                            format='json', HTTP_X_FORWARDED_FOR='1.1.1.1, 10.0.0.1')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertFalse(redis.exists('rate-limit:ip:10.0.0.1'))
+        redis.delete('rate-limit:ip:127.0.0.1')
+
+        with self.settings(THROTTLE_IP_RATE='2/minute', REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            # Values added to `X-Forwarded-For` by the client are ignored, only the one added by the proxy is used
+            for spoofed_ip in ('1.1.1.1', '2.2.2.2'):
+                response = self.client.post(reverse('v1:notifications'), data=get_notification_mock_data(),
+                                            format='json', HTTP_X_FORWARDED_FOR=f'{spoofed_ip}, 10.0.0.1')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.post(reverse('v1:notifications'), data=get_notification_mock_data(),
+                                        format='json', HTTP_X_FORWARDED_FOR='3.3.3.3, 10.0.0.1')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        redis.delete('rate-limit:ip:10.0.0.1')
@@ -0,0 +1,112 @@
+from typing import Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import BaseThrottle
+
+from .services.rate_limiter import RateLimiterProvider
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+
+
+def parse_rate(rate: str) -> Tuple[int, int]:
+    """
+    :param rate: `<requests>/<period>`, e.g. `60/minute`
+    :return: Tuple of number of requests and seconds of the period
+    :raises: ImproperlyConfigured if `rate` is not valid
+    """
+    try:
+        num_requests, period = rate.split('/')
+        num_requests, duration = int(num_requests), RATE_PERIODS[period[0]]
+    except (ValueError, KeyError, IndexError):
+        raise ImproperlyConfigured(f'Rate {rate} is not valid, it must be `<requests>/<period>` with period being '
+                                   f'`second`, `minute`, `hour` or `day`')
+    if num_requests <= 0:
+        raise ImproperlyConfigured(f'Rate {rate} is not valid, number of requests must be positive')
+    return num_requests, duration
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle requests using token buckets on Redis. Rate is configured as `<requests>/<period>` (period being
+    `second`, `minute`, `hour` or `day`, only first letter is checked). Every bucket allows bursts of `<requests>`
+    and is refilled at `<requests>/<period>`
+    """
+    scope: str
+    rate_setting: str
+
+    def __init__(self):
+        self._wait: Optional[float] = None
+
+    def get_rate(self) -> Optional[Tuple[int, float]]:
+        """
+        :return: Tuple of bucket capacity and tokens refilled per second, `None` if throttling is disabled
+        """
+        rate = getattr(settings, self.rate_setting, None)
+        if not rate:
+            return None
+        num_requests, duration = parse_rate(rate)
+        return num_requests, num_requests / duration
+
+    def consume(self, idents: Sequence[str]) -> Optional[float]:
+        """
+        :param idents: Identifiers of the clients, one token is taken from every one of them
+        :return: `None` if request is allowed, seconds to wait otherwise
+        """
+        rate = self.get_rate()
+        if not rate:
+            return None
+        capacity, refill_rate = rate
+        self._wait = RateLimiterProvider().consume([f'{self.scope}:{ident}' for ident in idents],
+                                                   capacity, refill_rate)
+        return self._wait
+
+    def wait(self) -> Optional[float]:
+        return self._wait
+
+
+class IPRateThrottle(TokenBucketThrottle):
+    """
+    Throttle requests per ip address. As it doesn't need the request to be validated, it's checked by DRF before
+    doing any work
+    """
+    scope = 'ip'
+    rate_setting = 'THROTTLE_IP_RATE'
+
+    def allow_request(self, request, view) -> bool:
+        return self.consume([self.get_ident(request)]) is None
+
+
+class SignerRateThrottle(TokenBucketThrottle):
+    """
+    Throttle requests per signer. Signers are only known after validating the request, so views must call
+    `check_signers` after that, before doing any other work
+    """
+    scope = 'signer'
+    rate_setting = 'THROTTLE_SIGNER_RATE'
+
+    def check_signers(self, signers: Sequence[str]):
+        """
+        :param signers: Addresses signing the request
+        :raises: Throttled if any of the signers is over the rate
+        """
+        wait = self.consume(signers)
+        if wait is not None:
+            raise Throttled(wait)
+
+
+def check_throttle_rates():
+    """
+    Validate the rates of every throttle, so a misconfiguration is detected on startup instead of failing every
+    request
+    :raises: ImproperlyConfigured if any rate is not valid
+    """
+    for throttle_class in (IPRateThrottle, SignerRateThrottle):
+        rate = getattr(settings, throttle_class.rate_setting, None)
+        if rate:
+            try:
+                parse_rate(rate)
+            except ImproperlyConfigured as exc:
+                raise ImproperlyConfigured(f'{throttle_class.rate_setting}: {exc}') from exc
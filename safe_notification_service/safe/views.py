@@ -11,6 +11,7 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView, exception_handler
 
+from safe_notification_service.ether.signer_cache import SignerCacheProvider
 from safe_notification_service.version import __version__
 
 from .models import Device, DevicePair
@@ -20,7 +21,9 @@ from .serializers import (AuthResponseSerializer, AuthSerializer,
                           SimpleNotificationSerializer)
 from .services.auth_service import AuthServiceException
 from .services.notification_service import NotificationServiceException
-from .tasks import send_notification_to_devices
+from .services.pairing_cache import PairingCacheProvider
+from .tasks import dispatch_notification, send_notification_to_devices
+from .throttling import IPRateThrottle, SignerRateThrottle
 
 logger = getLogger(__name__)
 
@@ -60,10 +63,15 @@ class AboutView(APIView):
             'settings': {
                 'ETH_HASH_PREFIX ': settings.ETH_HASH_PREFIX,
                 'FIREBASE_CREDENTIALS_PATH': settings.FIREBASE_CREDENTIALS_PATH,
+                'NOTIFICATION_DISPATCH_ASYNC': settings.NOTIFICATION_DISPATCH_ASYNC,
                 'NOTIFICATION_MAX_RETRIES': settings.NOTIFICATION_MAX_RETRIES,
+                'NOTIFICATION_MULTICAST': settings.NOTIFICATION_MULTICAST,
                 'NOTIFICATION_RETRY_DELAY_SECONDS': settings.NOTIFICATION_RETRY_DELAY_SECONDS,
                 'NOTIFICATION_SERVICE_PASS': bool(settings.NOTIFICATION_SERVICE_PASS),
-            }
+                'THROTTLE_IP_RATE': settings.THROTTLE_IP_RATE,
+                'THROTTLE_SIGNER_RATE': settings.THROTTLE_SIGNER_RATE,
+            },
+            'signer_cache': SignerCacheProvider().get_stats(),
         }
         return Response(content)
 
@@ -71,9 +79,11 @@ class AboutView(APIView):
 class AuthCreationView(CreateAPIView):
     permission_classes = (AllowAny,)
     serializer_class = AuthSerializer
+    throttle_classes = (IPRateThrottle,)
 
     @swagger_auto_schema(responses={201: AuthResponseSerializer(),
-                                    400: 'Invalid data'})
+                                    400: 'Invalid data',
+                                    429: 'Too many requests'})
     def post(self, request, *args, **kwargs):
         """
         Links a `push_token` to a `owner`. If this endpoint is called again with the same `owner`,
@@ -81,6 +91,7 @@ class AuthCreationView(CreateAPIView):
         """
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
+            SignerRateThrottle().check_signers([serializer.validated_data['signing_address']])
             device = serializer.save()
             response_serializer = AuthResponseSerializer(data={
                 'owner': device.owner,
@@ -95,6 +106,7 @@ class AuthCreationView(CreateAPIView):
 
 class PairingView(CreateAPIView):
     permission_classes = (AllowAny,)
+    throttle_classes = (IPRateThrottle,)
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -106,20 +118,22 @@ class PairingView(CreateAPIView):
         if isinstance(exc, Device.DoesNotExist):
             return Response(status=status.HTTP_422_UNPROCESSABLE_ENTITY)
         else:
-            raise exc
+            return super().handle_exception(exc)
 
     @swagger_auto_schema(responses={201: PairingResponseSerializer(),
-                                    400: 'Invalid data'})
+                                    400: 'Invalid data',
+                                    429: 'Too many requests'})
     def post(self, request, *args, **kwargs):
         """
         Pairs 2 devices
         """
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
+            SignerRateThrottle().check_signers([serializer.validated_data['signing_address']])
             instance = serializer.save()
             response_serializer = PairingResponseSerializer(data={
-                'device_pair': [instance.authorizing_device.owner,
-                                instance.authorized_device.owner]
+                'device_pair': [instance.authorizing_device_id,
+                                instance.authorized_device_id]
             })
             assert response_serializer.is_valid()
             return Response(status=status.HTTP_201_CREATED, data=response_serializer.data)
@@ -127,7 +141,8 @@ class PairingView(CreateAPIView):
             return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
 
     @swagger_auto_schema(responses={204: 'Pair was deleted',
-                                    400: 'Invalid data'})
+                                    400: 'Invalid data',
+                                    429: 'Too many requests'})
     def delete(self, request, *args, **kwargs):
         """
         Delete pairing between 2 devices
@@ -135,25 +150,44 @@ class PairingView(CreateAPIView):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
             signing_address = serializer.validated_data['signing_address']
+            SignerRateThrottle().check_signers([signing_address])
             device_address = serializer.validated_data['device']
 
-            DevicePair.objects.filter(authorizing_device__owner=signing_address,
-                                      authorized_device__owner=device_address).delete()
-            DevicePair.objects.filter(authorized_device__owner=signing_address,
-                                      authorizing_device__owner=device_address).delete()
+            DevicePair.objects.delete_pairing(signing_address, device_address)
+            PairingCacheProvider().invalidate([signing_address, device_address])
 
             return Response(status=status.HTTP_204_NO_CONTENT)
         else:
             return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
 
 
+def is_dispatch_async_requested(request) -> bool:
+    """
+    Callers opt in to asynchronous dispatch sending the `Prefer: respond-async` header (RFC 7240), so callers
+    relying on `404` when no pairing is found keep working
+    :param request:
+    :return: `True` if `NOTIFICATION_DISPATCH_ASYNC` is enabled and request prefers an asynchronous response
+    """
+    if not settings.NOTIFICATION_DISPATCH_ASYNC:
+        return False
+    preferences = request.headers.get('Prefer', '')
+    return any(preference.split(';')[0].strip().lower() == 'respond-async' for preference in preferences.split(','))
+
+
+def get_dispatch_async_response() -> Response:
+    return Response(status=status.HTTP_202_ACCEPTED, headers={'Preference-Applied': 'respond-async'})
+
+
 class NotificationView(CreateAPIView):
     permission_classes = (AllowAny,)
     serializer_class = NotificationSerializer
+    throttle_classes = (IPRateThrottle,)
 
-    @swagger_auto_schema(responses={204: 'Notification was queued',
+    @swagger_auto_schema(responses={202: 'Notification was accepted, `Prefer: respond-async` requested',
+                                    204: 'Notification was queued',
                                     400: 'Invalid data',
-                                    404: 'No pairing found'})
+                                    404: 'No pairing found',
+                                    429: 'Too many requests'})
     def post(self, request, *args, **kwargs):
         """
         Send notification to device/s
@@ -165,7 +199,12 @@ class NotificationView(CreateAPIView):
             message = json.loads(validated_data['message'])
             devices = validated_data['devices']
             signer_address = validated_data['signing_address']
-            if send_notification_to_devices(message, devices, signer_address):
+            SignerRateThrottle().check_signers([signer_address])
+            if is_dispatch_async_requested(request):
+                # Devices are resolved by the task, so it's not known if any pairing exists
+                dispatch_notification(message, devices, signer_address)
+                return get_dispatch_async_response()
+            elif send_notification_to_devices(message, devices, signer_address):
                 # At least one pairing found
                 return Response(status=status.HTTP_204_NO_CONTENT)
             else:
@@ -176,11 +215,14 @@ class NotificationView(CreateAPIView):
 
 class SimpleNotificationView(CreateAPIView):
     serializer_class = SimpleNotificationSerializer
+    throttle_classes = (IPRateThrottle,)
 
-    @swagger_auto_schema(responses={204: 'Notification was queued',
+    @swagger_auto_schema(responses={202: 'Notification was accepted, `Prefer: respond-async` requested',
+                                    204: 'Notification was queued',
                                     400: 'Invalid data',
                                     403: 'Invalid password',
-                                    404: 'No pairing found'})
+                                    404: 'No pairing found',
+                                    429: 'Too many requests'})
     def post(self, request, *args, **kwargs):
         """
         Send notification to device/s. This endpoint is password protected so users cannot abuse of it and send
@@ -196,7 +238,10 @@ class SimpleNotificationView(CreateAPIView):
             validated_data = serializer.validated_data
             message = json.loads(validated_data['message'])
             devices = validated_data['devices']
-            if send_notification_to_devices(message, devices):
+            if is_dispatch_async_requested(request):
+                dispatch_notification(message, devices)
+                return get_dispatch_async_response()
+            elif send_notification_to_devices(message, devices):
                 # At least one pairing found
                 return Response(status=status.HTTP_204_NO_CONTENT)
             else:
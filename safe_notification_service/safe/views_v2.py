@@ -5,14 +5,17 @@ from rest_framework.response import Response
 
 from .serializers import AuthV2ResponseSerializer, AuthV2Serializer
 from .services.auth_service import AuthServiceProvider
+from .throttling import IPRateThrottle, SignerRateThrottle
 
 
 class AuthCreationView(CreateAPIView):
     serializer_class = AuthV2Serializer
     response_serializer = AuthV2ResponseSerializer
+    throttle_classes = (IPRateThrottle,)
 
     @swagger_auto_schema(responses={201: response_serializer(),
-                                    400: 'Invalid data'})
+                                    400: 'Invalid data',
+                                    429: 'Too many requests'})
     def post(self, request, *args, **kwargs):
         """
         Links a `push_token` to one or more `owner` and register information of the device.
@@ -35,6 +38,7 @@ class AuthCreationView(CreateAPIView):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
             data = serializer.validated_data
+            SignerRateThrottle().check_signers(data['signing_addresses'])
             devices = AuthServiceProvider().create_auth(push_token=data['push_token'],
                                                         build_number=data['build_number'],
                                                         version_name=data['version_name'],
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from typing import Callable, List, Optional, Sequence, TypeVar
+
+from django.conf import settings
+
+logger = getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class VerificationProcessPoolProvider:
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            max_workers = (settings.VERIFICATION_PROCESS_POOL_SIZE or os.cpu_count()
+                           if settings.VERIFICATION_PROCESS_POOL else 0)
+            cls.instance = ProcessPool(max_workers)
+        return cls.instance
+
+    @classmethod
+    def del_singleton(cls):
+        if hasattr(cls, "instance"):
+            cls.instance.shutdown()
+            del cls.instance
+
+
+class ProcessPool:
+    """
+    Run CPU bound functions (like signature verification) on a pool of pre-started processes, so they don't block
+    the process calling them. On gunicorn gevent workers, everything is monkey patched, so waiting for the result
+    yields to the other greenlets instead of stalling the whole worker.
+    Processes are started using `spawn`, so they don't inherit the gevent hub or open connections. As a pool cannot
+    be shared after forking, a new one is started for every process using it
+    """
+    def __init__(self, max_workers: int):
+        """
+        :param max_workers: Number of processes. `0` disables the pool, functions will run on the calling process
+        """
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pid: Optional[int] = None
+
+    def start(self):
+        """
+        Start the pool for the current process if not started, with every process running. Call it when the
+        process starts (e.g. when a gunicorn worker loads the application), so requests don't pay for it
+        """
+        self._get_executor()
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        if not self.max_workers:
+            return None
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    logger.info('Starting process pool with %d processes', self.max_workers)
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                    # Processes are started on demand, wait for every one of them so the pool is ready
+                    for future in [self._executor.submit(os.getpid) for _ in range(self.max_workers)]:
+                        future.result()
+                    self._pid = pid
+        return self._executor
+
+    def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        Run `fn(*args)` on the pool and wait for the result. `fn` and `args` must be picklable, so `fn` must be
+        defined at module level. Exceptions raised by `fn` are raised again
+        :param fn:
+        :param args:
+        :return: Result of `fn(*args)`
+        """
+        if not self.max_workers:
+            return fn(*args)
+        return self._get_executor().submit(fn, *args).result()
+
+    def map(self, fn: Callable[..., T], args_list: Sequence[Sequence]) -> List[T]:
+        """
+        Run `fn(*args)` for every `args` of `args_list` on the pool at once, so they run in parallel, and wait for
+        every result. Same restrictions as `run` apply
+        :param fn:
+        :param args_list:
+        :return: Results, in the same order as `args_list`
+        """
+        if not self.max_workers:
+            return [fn(*args) for args in args_list]
+        executor = self._get_executor()
+        return [future.result() for future in [executor.submit(fn, *args) for args in args_list]]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+            self._pid = None
@@ -0,0 +1,14 @@
+from functools import lru_cache
+from logging import getLogger
+
+from django.conf import settings
+
+from redis import Redis
+
+logger = getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_redis() -> Redis:
+    logger.info('Opening connection to Redis')
+    return Redis.from_url(settings.REDIS_URL)
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+from django.test import TestCase
+
+from ..process_pool import ProcessPool
+
+
+class TestProcessPool(TestCase):
+    def test_run(self):
+        process_pool = ProcessPool(0)
+        self.assertEqual(process_pool.run(os.getpid), os.getpid())
+        self.assertEqual(process_pool.map(divmod, [(7, 2)]), [(3, 1)])
+
+        process_pool = ProcessPool(2)
+        try:
+            self.assertNotEqual(process_pool.run(os.getpid), os.getpid())
+            self.assertEqual(process_pool.run(divmod, 7, 2), (3, 1))
+            with self.assertRaises(ZeroDivisionError):
+                process_pool.run(divmod, 7, 0)
+            self.assertEqual(process_pool.map(divmod, [(7, 2), (9, 3)]), [(3, 1), (3, 0)])
+            self.assertEqual(process_pool.map(divmod, []), [])
+        finally:
+            process_pool.shutdown()
+
+    def test_run_gevent(self):
+        # Gevent cannot patch the test process, so it's run on a new one
+        script = textwrap.dedent("""
+            from gevent import monkey
+            monkey.patch_all()
+
+            import time
+
+            import gevent
+
+            from safe_notification_service.utils.process_pool import ProcessPool
+
+            ticks = []
+
+            def tick():
+                while True:
+                    ticks.append(time.monotonic())
+                    gevent.sleep(0.01)
+
+            process_pool = ProcessPool(1)
+            process_pool.start()
+            greenlet = gevent.spawn(tick)
+            try:
+                process_pool.run(time.sleep, 0.5)
+                process_pool.map(time.sleep, [(0.5,)])
+            finally:
+                greenlet.kill()
+                process_pool.shutdown()
+            # Other greenlets run while waiting for the results
+            assert len(ticks) > 20, len(ticks)
+        """)
+        project_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir))
+        result = subprocess.run([sys.executable, '-c', script], cwd=project_path, capture_output=True, text=True,
+                                timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
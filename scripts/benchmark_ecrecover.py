@@ -0,0 +1,46 @@
+"""
+Compare the ecrecover backends used to recover the signers of the requests.
+Run it from the root of the project: `python -m scripts.benchmark_ecrecover --iterations 2000`
+"""
+import argparse
+import os
+import timeit
+
+from ethereum import utils
+
+from safe_notification_service.ether.ecrecover import (
+    CoincurveEcrecoverBackend, LegacyEcrecoverBackend, coincurve)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    signatures = []
+    for _ in range(100):
+        message_hash = utils.sha3(os.urandom(32))
+        v, r, s = utils.ecsign(message_hash, utils.sha3(os.urandom(32)))
+        signatures.append((message_hash, v, r, s))
+
+    backends = [LegacyEcrecoverBackend()]
+    if coincurve:
+        backends.append(CoincurveEcrecoverBackend())
+    else:
+        print('coincurve is not installed, only legacy backend will be benchmarked')
+
+    for backend in backends:
+        def recover():
+            for signature in signatures:
+                backend.recover_public_key(*signature)
+
+        number = max(args.iterations // len(signatures), 1)
+        best = min(timeit.repeat(recover, number=number, repeat=args.repeat))
+        per_recovery = best / (number * len(signatures))
+        print('{:<10} {:>10.1f} us/recovery {:>10.0f} recoveries/s'.format(
+            backend.name, per_recovery * 1e6, 1 / per_recovery))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Measure latency of light requests (like `/check/`) on a gevent worker while other greenlets recover signers, running
+the recovery on the same process or on the verification process pool.
+Run it from the root of the project: `python -m scripts.benchmark_process_pool --duration 10`
+"""
+# isort:skip_file
+# gevent must patch the standard library before anything else is imported
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import statistics  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+from ethereum import utils  # noqa: E402
+
+from safe_notification_service.ether.ecrecover import (  # noqa: E402
+    CoincurveEcrecoverBackend, LegacyEcrecoverBackend, coincurve)
+from safe_notification_service.utils.process_pool import ProcessPool  # noqa: E402
+
+
+def light_requests(latencies, duration: float, interval: float):
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        gevent.sleep(interval)  # Simulate I/O
+        latencies.append(time.monotonic() - start - interval)
+
+
+def auth_requests(process_pool: ProcessPool, backend, signatures, duration: float, interval: float):
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for signature in signatures:
+            process_pool.run(backend.recover_public_key, *signature)
+            gevent.sleep(interval)
+
+
+def percentile(values, percent: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--light-greenlets', type=int, default=50)
+    parser.add_argument('--auth-greenlets', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    backend = CoincurveEcrecoverBackend() if coincurve else LegacyEcrecoverBackend()
+    signatures = []
+    for _ in range(20):
+        message_hash = utils.sha3(os.urandom(32))
+        v, r, s = utils.ecsign(message_hash, utils.sha3(os.urandom(32)))
+        signatures.append((message_hash, v, r, s))
+
+    print('Using {} ecrecover backend'.format(backend.name))
+    for processes in (0, args.processes):
+        process_pool = ProcessPool(processes)
+        process_pool.run(os.getpid)  # Start the pool before measuring
+        latencies = []
+        greenlets = [gevent.spawn(light_requests, latencies, args.duration, 0.005)
+                     for _ in range(args.light_greenlets)]
+        greenlets += [gevent.spawn(auth_requests, process_pool, backend, signatures, args.duration, 0.001)
+                      for _ in range(args.auth_greenlets)]
+        gevent.joinall(greenlets)
+        process_pool.shutdown()
+        print('processes={:<3} light requests={:<8} p50={:.2f}ms p99={:.2f}ms max={:.2f}ms'.format(
+            processes, len(latencies), statistics.median(latencies) * 1000, percentile(latencies, 99) * 1000,
+            max(latencies) * 1000))
+
+
+if __name__ == '__main__':
+    main()
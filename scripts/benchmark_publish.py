@@ -0,0 +1,61 @@
+"""
+Compare publishing one notification task per device with `delay` against publishing all of them as a group, which
+reuses the same producer and broker connection. Tasks are only published, no worker is needed.
+Run it from the root of the project: `python -m scripts.benchmark_publish --broker redis://localhost:6379/15`
+"""
+import argparse
+import statistics
+import time
+
+from celery import Celery, group
+
+app = Celery('benchmark_publish')
+
+
+@app.task(name='benchmark_publish.send_notification_task')
+def send_notification_task(message, push_token):
+    pass
+
+
+def publish_delay(message, push_tokens):
+    for push_token in push_tokens:
+        send_notification_task.delay(message, push_token)
+
+
+def publish_group(message, push_tokens):
+    group([send_notification_task.s(message, push_token) for push_token in push_tokens]).apply_async()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--broker', default='redis://localhost:6379/15')
+    parser.add_argument('--device-counts', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app.conf.broker_url = args.broker
+    app.conf.task_ignore_result = True
+    message = {'type': 'sendTransaction', 'address': '0x4D953115678b15CE0B0396bCF95Db68003f86FB5'}
+    publish_delay(message, ['warm-up'])  # Open broker connection before measuring
+
+    print('{:>8} {:>14} {:>14} {:>8}'.format('devices', 'delay (ms)', 'group (ms)', 'speedup'))
+    for device_count in args.device_counts:
+        push_tokens = ['push-token-{}'.format(i) for i in range(device_count)]
+        results = []
+        for publish in (publish_delay, publish_group):
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                publish(message, push_tokens)
+                timings.append(time.perf_counter() - start)
+            results.append(statistics.median(timings) * 1000)
+        print('{:>8} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(device_count, results[0], results[1],
+                                                           results[0] / results[1]))
+
+    # Remove published tasks
+    with app.connection_for_write() as connection:
+        connection.default_channel.queue_purge(app.conf.task_default_queue)
+
+
+if __name__ == '__main__':
+    main()